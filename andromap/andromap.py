@@ -10,13 +10,19 @@ import numpy as np
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 import aplpy
+from matplotlib.colors import LogNorm, Normalize
 
 from .imagelogfootprints import get_combined_image_footprint, \
-    get_phat_bricks, get_combined_phat_bricks, get_acs_halo_fields, \
-    get_image_footprints
-from .polytools import close_vertices, polygon_union
-from .constants import D_KPC, M31RA0, M31DEC0
-from .tanproj import tan_to_eq
+    get_image_footprints, get_field_centers
+from .footprintset import FootprintSet
+from .polytools import polygon_union
+from .spatialindex import get_footprint_index
+from .lod import pixel_scale, simplify_polygons
+from .prefetch import LayerPrefetcher
+from .constants import M31RA0, M31DEC0
+from .density import catalog_density, CHUNK_SIZE as DENSITY_CHUNK_SIZE
+from .ellipses import profile_ellipses, adaptive_vertex_counts, \
+    ellipse_polygons, ellipse_polygon, ellipse_generator
 
 
 class Andromap(object):
@@ -35,16 +41,34 @@ class Andromap(object):
         A length-3 list gives the matplotlib-style subplot index.
     figsize : tuple
         Size figure, inches, (width, height).
+    prefetch : list
+        Layer specs (see :mod:`andromap.prefetch`) whose geometry is fetched
+        on a thread pool while the image loads.
+    prefetch_threads : int
+        Number of threads prefetching layers.
+    lod_dpi : float
+        Resolution that the figure will be saved at. Polygons are simplified
+        to ``lod_tolerance`` device pixels at this dpi (see
+        :mod:`andromap.lod`) for the view at the time they are plotted.
+        ``None`` draws polygons at full resolution.
+    lod_tolerance : float
+        Simplification tolerance, in device pixels.
     kw :
         Arguments passed directly to the ``aplpy.FITSFigure`` constructor.
     """
     def __init__(self, dataset, fig=None, subplot=(1, 1, 1),
-                 figsize=(3.5, 3.5), **kw):
+                 figsize=(3.5, 3.5), prefetch=None, prefetch_threads=4,
+                 lod_dpi=300, lod_tolerance=0.5, **kw):
         super(Andromap, self).__init__()
         self.dataset = dataset
         self._figure = fig
         self._subplot = subplot
         self._log = logging.getLogger('andromap')
+        self.lod_dpi = lod_dpi
+        self.lod_tolerance = lod_tolerance
+        # Start layer queries before aplpy reads the image
+        self._prefetcher = LayerPrefetcher(prefetch or (),
+                                           processes=prefetch_threads)
 
         if self._figure is not None:
             # Put Aplpy axes into an existing axis
@@ -57,7 +81,8 @@ class Andromap(object):
 
         # Set up typography
         self._f.set_system_latex('True')
-        self._f.set_tick_labels_format(xformat='hh:mm', yformat='dd')
+        self._f.tick_labels.set_xformat('hh:mm')
+        self._f.tick_labels.set_yformat('dd')
 
     @property
     def fig(self):
@@ -70,7 +95,7 @@ class Andromap(object):
         if not path.endswith(format):
             path = path + "." + format
         dirname = os.path.dirname(path)
-        if dirname is not "" and not os.path.exists(dirname):
+        if dirname != "" and not os.path.exists(dirname):
             os.makedirs(dirname)
         if self._figure is not None:
             # Save through matplotlib
@@ -81,9 +106,24 @@ class Andromap(object):
                          adjust_bbox=adjust_bbox,
                          max_dpi=max_dpi, format=format)
 
+    def prefetch(self, specs):
+        """Fetch the geometry of layers on a thread pool so that later
+        ``plot_*`` calls only draw. See :mod:`andromap.prefetch` for the
+        layer specs.
+        """
+        self._prefetcher.submit(specs)
+
+    def prefetch_report(self):
+        """Log and return how long each drawn layer took to fetch and how
+        long drawing waited for it.
+        """
+        report = self._prefetcher.report()
+        self._log.info("Layer timings:\n" + report)
+        return self._prefetcher.timings
+
     def add_label(self, ra, dec, txt, **args):
         """Add a text label at the world coordinates."""
-        print ra, dec
+        print(ra, dec)
         self._f.add_label(ra, dec, txt, **args)
 
     def plot_box(self, ra, dec, width, height,
@@ -97,58 +137,132 @@ class Andromap(object):
 
         Returns a SkyCoord.
         """
-        polydict = get_image_footprints(sel)
-        x_centers = []
-        y_centers = []
-        for name, poly in polydict.iteritems():
-            xs = [p[0] for p in poly]
-            ys = [p[1] for p in poly]
-            xi = 0.5 * (max(xs) + min(xs))
-            yi = 0.5 * (max(ys) + min(ys))
-            x_centers.append(xi)
-            y_centers.append(yi)
-        xc = np.array(x_centers).mean()
-        yc = np.array(y_centers).mean()
-        return SkyCoord(xc * u.deg, yc * u.deg)
+        center = get_field_centers(sel)[None]
+        return SkyCoord(center['ra'] * u.deg, center['dec'] * u.deg)
+
+    def compute_mean_coordinates(self, sel, group_by='OBJECT'):
+        """Compute the mean coordinate of each group of selected fields
+        (e.g. each ``OBJECT``) with a single query.
+
+        Returns a dictionary of group values mapping to SkyCoords.
+        """
+        centers = get_field_centers(sel, group_by=group_by)
+        return {value: SkyCoord(c['ra'] * u.deg, c['dec'] * u.deg)
+                for value, c in centers.items()}
 
     def plot_fields(self, sel, layer=False, zorder=None, **mpl):
         """Plot individual image footprints."""
-        polydict = get_image_footprints(sel)
-        polygons = [p for n, p in polydict.iteritems()]
-        if polygons is None:
+        footprints = self._prefetcher.get('fields', sel)
+        if footprints is None:
             return
+        self._show_polygons(footprints.polygons(), layer=layer,
+                            zorder=zorder, **mpl)
+
+    def _axes(self):
+        return getattr(self._f, 'ax', None) or self._f._ax1
+
+    def _show_polygons(self, polygons, layer=False, zorder=None,
+                       simplify=True, **mpl):
+        """Draw polygons, simplified to the device pixel scale unless
+        ``lod_dpi`` is ``None`` or ``simplify`` is False.
+        """
+        if simplify and self.lod_dpi is not None:
+            scale = pixel_scale(self._f, self._axes(), self.lod_dpi)
+            polygons = simplify_polygons(polygons,
+                                         self.lod_tolerance * scale)
         self._f.show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
 
+    def view_polygon(self, n_edge=16):
+        """RA, Dec vertices outlining the current view of the axes (e.g. as
+        set by ``fig.recenter``), sampling ``n_edge`` points along each edge.
+        """
+        ax = self._axes()
+        x0, x1 = ax.get_xlim()
+        y0, y1 = ax.get_ylim()
+        t = np.linspace(0., 1., num=n_edge, endpoint=False)
+        xs = np.concatenate([x0 + (x1 - x0) * t, np.repeat(x1, n_edge),
+                             x1 - (x1 - x0) * t, np.repeat(x0, n_edge)])
+        ys = np.concatenate([np.repeat(y0, n_edge), y0 + (y1 - y0) * t,
+                             np.repeat(y1, n_edge), y1 - (y1 - y0) * t])
+        ra, dec = self._f.pixel2world(xs, ys)
+        return np.column_stack([ra, dec])
+
+    def plot_fields_in_view(self, sel, layer=False, zorder=None, **mpl):
+        """Plot the image footprints that intersect the current view.
+
+        Footprints are looked up in a spatial index (see
+        :mod:`andromap.spatialindex`), so only visible fields are drawn.
+        Call after ``fig.recenter``.
+
+        Returns
+        -------
+        footprints : :class:`andromap.footprintset.FootprintSet`
+            The footprints plotted.
+        """
+        footprints = get_footprint_index(sel).query(self.view_polygon())
+        if len(footprints) == 0:
+            return footprints
+        self._show_polygons(footprints.polygons(), layer=layer,
+                            zorder=zorder, **mpl)
+        return footprints
+
     def plot_field_labels(self, sel, **args):
         """Plot the names for individual fields"""
-        polydict = get_image_footprints(sel)
-        for name, poly in polydict.iteritems():
-            xs = [p[0] for p in poly]
-            ys = [p[1] for p in poly]
-            xi = 0.5 * (max(xs) + min(xs))
-            yi = 0.5 * (max(ys) + min(ys))
-            self.add_label(xi, yi, name, **args)
-
-    def plot_combined_fields(self, sel, layer=False, zorder=None, **mpl):
-        """Plot unions of image footprints."""
-        polygons = get_combined_image_footprint(sel)
+        centers = get_field_centers(sel, group_by='_id')
+        for name, c in centers.items():
+            self.add_label(c['ra'], c['dec'], name, **args)
+
+    def plot_combined_fields(self, sel, layer=False, zorder=None,
+                             processes=1, **mpl):
+        """Plot unions of image footprints. With ``processes`` greater than
+        one, large unions are computed on a process pool.
+        """
+        polygons = self._prefetcher.get('combined_fields', sel,
+                                        processes=processes)
         if polygons is None:
             return None
-        self._f.show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
+        self._show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
+
+    def plot_combined_fields_grouped(self, base_sel, group_by='OBJECT',
+                                     values=None, layer=False, zorder=None,
+                                     **mpl):
+        """Plot the union of image footprints of each group (e.g. each field
+        when grouping by ``OBJECT``) with a single query and draw call.
+
+        Parameters
+        ----------
+        base_sel : dict
+            Mongo selector shared by all groups.
+        group_by : str
+            Document field that footprints are grouped by.
+        values : list
+            Values of ``group_by`` to plot. If ``None``, every group matching
+            ``base_sel`` is plotted.
+
+        Returns
+        -------
+        unions : dict
+            Dictionary of group values mapping to the lists of union vertex
+            arrays that were plotted.
+        """
+        unions = self._prefetcher.get('combined_fields_grouped', base_sel,
+                                      group_by=group_by, values=values)
+        polygons = [p for value, polys in unions.items() for p in polys]
+        if len(polygons) == 0:
+            return unions
+        self._show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
+        return unions
 
     def plot_phat(self, union=True, layer=False, zorder=None, **mpl):
         """Plot the PHAT footprint."""
-        if union:
-            polygons = get_combined_phat_bricks()
-        else:
-            polydict = get_phat_bricks()
-            polygons = [p for n, p in polydict.iteritems()]
+        polygons = self._prefetcher.get('phat', union=union)
         if polygons is None:
             return None
-        self._f.show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
+        self._show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
 
     def plot_phat_fields(self, band="F160W", bricks=None, fields=None,
-                         union=True, layer=False, zorder=None, **mpl):
+                         union=True, layer=False, zorder=None, processes=1,
+                         **mpl):
         """Plot the PHAT footprint from individual field footprints rather than
         brick-by-brick.
 
@@ -160,6 +274,8 @@ class Andromap(object):
             List of brick numbers (integers) to plot
         fields : list
             List of field number (integers) from bricks to plot.
+        processes : int
+            Number of processes computing the union.
         """
         sel = {"survey": "PHAT", "FILTER": band}
         if bricks is not None:
@@ -167,98 +283,161 @@ class Andromap(object):
         if fields is not None:
             sel['field'] = {"$in": fields}
         if union:
-            polygons = get_combined_image_footprint(sel)
+            polygons = get_combined_image_footprint(sel, processes=processes)
             if polygons is None:
                 return None
-            self._f.show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
+            self._show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
         else:
             footprints = get_image_footprints(sel)
-            polys = [v for k, v in footprints.iteritems()]
-            self._f.show_polygons(polys, layer=layer, zorder=zorder, **mpl)
+            self._show_polygons(footprints.polygons(), layer=layer,
+                                zorder=zorder, **mpl)
+
+    def plot_layer(self, region, holes=True, layer=False, zorder=None,
+                   **mpl):
+        """Plot the outline of a :class:`andromap.layeralgebra.Layer`, e.g.
+        the difference of two survey layers, including the outlines of its
+        holes if ``holes``.
+        """
+        if region.is_empty:
+            return
+        self._show_polygons(region.polygons(holes=holes), layer=layer,
+                            zorder=zorder, **mpl)
+
+    def plot_moc(self, moc, holes=True, layer=False, zorder=None, **mpl):
+        """Plot the outline of a HEALPix coverage map
+        (:class:`andromap.moc.MOC`).
+        """
+        self.plot_layer(moc.to_layer(), holes=holes, layer=layer,
+                        zorder=zorder, **mpl)
+
+    def plot_depth(self, depth, levels=None, cmap='viridis', layer=False,
+                   **mpl):
+        """Plot a coverage-depth map (:class:`andromap.coverage.DepthMap`)
+        as filled contours in a colormap; pixels of zero depth are left
+        transparent.
+
+        Parameters
+        ----------
+        depth : :class:`andromap.coverage.DepthMap`
+            Depth map, on any WCS grid.
+        levels : list
+            Contour levels. By default exposure counts get a level between
+            each count, and other depths ten levels up to their maximum.
+        cmap : str
+            Matplotlib colormap.
+        """
+        if levels is None:
+            top = depth.max()
+            if top <= 0:
+                return
+            if depth.data.dtype.kind in 'iu':
+                levels = np.arange(0.5, top + 1.)
+            else:
+                levels = np.linspace(0., top, 11)
+                levels[0] = 1e-6 * top
+        self._f.show_contour(depth.to_hdu(), levels=levels, filled=True,
+                             cmap=cmap, layer=layer, **mpl)
+
+    def plot_catalog_density(self, ra, dec, weights=None, stretch='log',
+                             cmap='Greys', vmin=None, vmax=None, alpha=1.,
+                             zorder=None, chunk_size=DENSITY_CHUNK_SIZE):
+        """Plot the density of a point catalog (e.g. resolved stars) as an
+        image on the basemap's pixel grid, instead of a marker per point.
+        Empty pixels are transparent.
+
+        Parameters
+        ----------
+        ra, dec : ndarray
+            Coordinates, degrees; may be memory-mapped, as points are binned
+            in chunks (see :func:`andromap.density.bin_catalog`).
+        weights : ndarray
+            Optional weight of each point; pixels show summed weights.
+        stretch : str
+            ``'log'`` or ``'linear'``.
+        cmap : str
+            Matplotlib colormap.
+        vmin, vmax : float
+            Limits of the stretch; by default the range of the image.
+
+        Returns
+        -------
+        image : :class:`matplotlib.image.AxesImage`
+        """
+        if stretch == 'log':
+            norm = LogNorm(vmin=vmin, vmax=vmax)
+        elif stretch == 'linear':
+            norm = Normalize(vmin=vmin, vmax=vmax)
+        else:
+            raise ValueError("Unknown stretch %s" % stretch)
+        density, wcs = catalog_density(ra, dec, self.dataset,
+                                       weights=weights,
+                                       chunk_size=chunk_size)
+        # Place the image by the centres of its corner pixels, in the pixel
+        # convention of the figure
+        ny, nx = density.shape
+        ras, decs = wcs.wcs_pix2world([0., nx - 1.], [0., ny - 1.], 0)
+        x, y = self._f.world2pixel(ras, decs)
+        extent = (x[0] - 0.5, x[1] + 0.5, y[0] - 0.5, y[1] + 0.5)
+        ax = self._axes()
+        xlim, ylim = ax.get_xlim(), ax.get_ylim()
+        image = ax.imshow(np.ma.masked_equal(density, 0.), origin='lower',
+                          extent=extent, cmap=cmap, norm=norm, alpha=alpha,
+                          interpolation='nearest', zorder=zorder)
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+        return image
 
     def plot_hst_halo(self, union=True, layer=False, zorder=None,
                       label=None, **mpl):
         """Plot the Brown et al HST/ACS halo footprints."""
-        polydict = get_acs_halo_fields()
-        polygons = [p for n, p in polydict.iteritems()]
-        if polygons is None:
+        fields = self._prefetcher.get('hst_halo')
+        if fields is None:
             return
-        self._f.show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
+        self._show_polygons(fields.polygons(), layer=layer, zorder=zorder,
+                            **mpl)
         if label:
-            for name, poly in polydict.iteritems():
-                x = np.array([v[0] for v in poly]).mean()
-                y = np.array([v[1] for v in poly]).mean()
+            centroids = fields.centroids()
+            for name, (x, y) in zip(fields.names, centroids):
                 self._f.add_label(x, y - 0.05, name, size=7,
                                   verticalalignment='top')
 
     def plot_narrowband_fields(self, names, union=True, layer=False,
                                zorder=None, **mpl):
         """Plot named narrowband fields."""
-        if isinstance(names, str) or isinstance(names, unicode):
+        if isinstance(names, str):
             names = [names]
         data_path = os.path.join(os.path.abspath(os.path.dirname(__file__)),
                                  "data/narrowband_fields.json")
         self._log.debug("Data path: {path}".format(path=data_path))
         with open(data_path) as f:
             field_data = json.loads(f.read())
-        polygons = [field_data[n] for n in names]
+        polygons = FootprintSet.from_polygons(
+            names, [field_data[n] for n in names]).normalize()
         if union:
-            polygons = [close_vertices(p) for p in polygons]
             polygons = polygon_union(polygons)
-        self._f.show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
+        else:
+            polygons = polygons.polygons()
+        self._show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
 
     def plot_xvista_profile_ellipse_grid(self, prof, radii,
                                          layer=False, zorder=None, **mpl):
         """Plot ellipses from an XVISTA SB profile at a specified grid of
         radii (given in kiloparsecs).
-        """
-        R = D_KPC * np.tan(prof['R'] / 3600. * np.pi / 180.)
-        # print R
-        PA = prof['PA']
-        ELL = prof['ELL']
-        # print prof['ELL']
-        print prof['KPC', 'ELL'][::50]
-
-        polygons = []
-        for r_kpc, pa, ell in ellipse_generator(R, PA, ELL, radii):
-            r_deg = np.arctan(r_kpc / D_KPC) * 180. / np.pi
-            b_deg = (1. - ell) * r_deg  # semi-minor axis
-            print r_kpc, r_deg, b_deg, ell, pa
-            # XVISTA pa is from +x axis (which points rightwards), out
-            # PA must be CCW from north
-            pa = 90. - pa  # THIS WORKS
-            poly = ellipse_polygon(r_deg, b_deg, pa, M31RA0, M31DEC0,
-                                   n_verts=1000)
-            polygons.append(poly)
-
-        self._f.show_polygons(polygons, layer=layer, zorder=zorder, **mpl)
-
 
-def ellipse_generator(R, PA, ELL, radii):
-    """Generate interpolated ellipses at the given radii (kpc).
-
-    The generate will continue to make ellipses past the profile by maintaining
-    PA and ellipticity from the last profile ellipse.
-    """
-    for r0 in radii:
-        if r0 < R.max():
-            pa = np.interp(r0, R, PA)
-            ell = np.interp(r0, R, ELL)
-            yield r0, pa, ell
+        The ellipses of all radii are built and projected together (see
+        :mod:`andromap.ellipses`). Unless ``lod_dpi`` is ``None``, each gets
+        as many vertices as it needs to be drawn to ``lod_tolerance``
+        device pixels in the current view.
+        """
+        a_deg, b_deg, pa = profile_ellipses(prof, radii)
+        if self.lod_dpi is None:
+            n_verts = 1000
         else:
-            yield r0, pa, ell
-
-
-def ellipse_polygon(r_deg, b_deg, pa, ra0, dec0, n_verts=1000):
-    """Make a polygon with RA,Dec vertices from an ellipse."""
-    # Parametric angle
-    t = np.linspace(0., 2. * np.pi, num=n_verts, endpoint=False)
-    # Transform PA to radians
-    p = pa * np.pi / 180.
-    # Parametric equation for an ellipse centered at origin
-    # note that the x-axis is reverse; increases to left
-    X = - (r_deg * np.cos(t) * np.cos(p) - b_deg * np.sin(t) * np.sin(p))
-    Y = r_deg * np.cos(t) * np.sin(p) + b_deg * np.sin(t) * np.cos(p)
-    ras, decs = tan_to_eq(X, Y, ra0Deg=ra0, dec0Deg=dec0)
-    verts = np.vstack([ras, decs]).T
-    return verts
+            scale = pixel_scale(self._f, self._axes(), self.lod_dpi)
+            n_verts = adaptive_vertex_counts(a_deg, scale,
+                                             tolerance=self.lod_tolerance)
+        self._log.debug("Plotting %i profile ellipses" % len(a_deg))
+        polygons = ellipse_polygons(a_deg, b_deg, pa, M31RA0, M31DEC0,
+                                    n_verts=n_verts)
+        self._show_polygons(polygons, layer=layer, zorder=zorder,
+                            simplify=False, **mpl)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Shared MongoDB connection for the image log.
+
+A single pooled ``MongoClient`` is reused by every query made through
+:mod:`andromap.imagelogfootprints`. Use :func:`configure` to point andromap
+at a different server or database, or the :func:`connection` context manager
+to scope a connection to a block of code.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from pymongo import MongoClient
+
+
+class MongoConnection(object):
+    """A lazily-opened, pooled connection to the image log database.
+
+    Parameters
+    ----------
+    host : str
+        Hostname of the MongoDB server.
+    port : int
+        Port of the MongoDB server.
+    db : str
+        Name of the database holding the image log.
+    images : str
+        Name of the collection of image documents.
+    footprints : str
+        Name of the collection of survey footprint documents (e.g., PHAT).
+    client_kw :
+        Arguments passed directly to the ``MongoClient`` constructor (e.g.,
+        ``maxPoolSize``).
+    """
+    def __init__(self, host='localhost', port=27017, db='m31',
+                 images='images', footprints='footprints', **client_kw):
+        super(MongoConnection, self).__init__()
+        self.host = host
+        self.port = port
+        self.db_name = db
+        self.collection_names = {'images': images, 'footprints': footprints}
+        self._client_kw = client_kw
+        self._client = None
+        self._lock = threading.Lock()
+        self._n_opened = 0
+        self._n_reused = 0
+        self._log = logging.getLogger('andromap')
+
+    @property
+    def client(self):
+        """The pooled ``MongoClient``, opened on first use."""
+        with self._lock:
+            if self._client is None:
+                self._log.debug("Opening MongoDB connection to %s:%i"
+                                % (self.host, self.port))
+                self._client = MongoClient(host=self.host, port=self.port,
+                                           **self._client_kw)
+                self._n_opened += 1
+            else:
+                self._n_reused += 1
+            return self._client
+
+    @property
+    def db(self):
+        """The image log ``Database``."""
+        return self.client[self.db_name]
+
+    def collection(self, kind):
+        """Get a collection by its role, either ``'images'`` or
+        ``'footprints'``.
+        """
+        return self.db[self.collection_names[kind]]
+
+    @property
+    def stats(self):
+        """Dictionary with the number of clients ``opened`` and the number of
+        times an open client was ``reused``.
+        """
+        return {'opened': self._n_opened, 'reused': self._n_reused}
+
+    def close(self):
+        """Close the client; it will be reopened if used again."""
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+_connection = MongoConnection()
+
+
+def get_connection():
+    """Get the module-level :class:`MongoConnection`."""
+    return _connection
+
+
+def configure(**kwargs):
+    """Replace the module-level connection with one built from ``kwargs``
+    (see :class:`MongoConnection`). The previous connection is closed.
+    """
+    global _connection
+    old = _connection
+    _connection = MongoConnection(**kwargs)
+    old.close()
+    return _connection
+
+
+def connection_stats():
+    """Connection usage counts of the module-level connection."""
+    return _connection.stats
+
+
+@contextmanager
+def connection(**kwargs):
+    """Context manager that installs a new module-level connection for the
+    duration of the block, then closes it and restores the previous one.
+
+    Example::
+
+        with connection(host='dbhost') as conn:
+            m.plot_combined_fields(sel)
+        print(conn.stats)
+    """
+    global _connection
+    previous = _connection
+    conn = MongoConnection(**kwargs)
+    _connection = conn
+    try:
+        yield conn
+    finally:
+        _connection = previous
+        conn.close()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Coverage-depth maps: the number of exposures (or the summed exposure time)
+covering each pixel of a WCS grid, such as the basemap's::
+
+    depth = image_depth({"INSTRUME": "MegaPrime"}, fitspath)
+    depth.write('megacam_depth.fits')
+    m.plot_depth(depth)
+
+Footprints are filled by scanlines. All vertices are projected to pixel
+coordinates at once; for every footprint edge, the rows whose pixel centres
+it spans are found and the column at which it crosses each row is
+interpolated. A crossing adds the footprint's weight to a difference array
+at that column if the edge runs down the row, and subtracts it if the edge
+runs up (the other way around for footprints wound the other way in
+pixels), so that a cumulative sum along each row gives the nonzero winding
+number of every pixel times the weight. Nothing is tested per pixel, and
+the crossings of all footprints in a chunk are accumulated with a single
+``bincount``.
+"""
+
+import os
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from .footprintset import FootprintSet
+from .imagelogfootprints import fetch_polygons
+
+
+# Footprints whose scanline crossings are held at once
+CHUNK_SIZE = 1000
+
+
+def tan_wcs(ra0, dec0, pix_scale, shape):
+    """A gnomonic (TAN) WCS centred on ``ra0``, ``dec0``, with square pixels
+    of ``pix_scale`` degrees and north up, for an image of ``shape``
+    (ny, nx).
+    """
+    ny, nx = shape
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra0, dec0]
+    wcs.wcs.crpix = [0.5 * (nx + 1), 0.5 * (ny + 1)]
+    wcs.wcs.cdelt = [-pix_scale, pix_scale]
+    return wcs
+
+
+def basemap_wcs(dataset):
+    """The WCS and (ny, nx) shape of a FITS basemap, given as a path or an
+    HDU (as passed to :class:`andromap.andromap.Andromap`).
+    """
+    if isinstance(dataset, str):
+        header = fits.getheader(os.path.expanduser(dataset))
+    else:
+        header = dataset.header
+    wcs = WCS(header).celestial
+    return wcs, (header['NAXIS2'], header['NAXIS1'])
+
+
+def _crossings(footprints, weights, wcs, shape):
+    """Flat difference array indices and values of the scanline crossings
+    of a FootprintSet.
+    """
+    ny, nx = shape
+    starts = footprints.offsets[:-1]
+    counts = footprints.counts
+    ring = np.repeat(np.arange(len(footprints)), counts)
+    vertices = footprints.vertices[starts[0]:footprints.offsets[-1]]
+    x, y = wcs.all_world2pix(vertices[:, 0], vertices[:, 1], 0)
+
+    # Orientation of each ring in pixel space, from the shoelace formula
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    same_ring = ring[:-1] == ring[1:]
+    signed_area = np.bincount(ring[:-1][same_ring], weights=cross[same_ring],
+                              minlength=len(footprints))
+    ring_weight = np.where(signed_area < 0., -weights, weights)
+
+    # Edges within rings (rings are closed), with the pixel rows whose
+    # centres they span: ceil(y0) <= row < ceil(y1)
+    x0, y0, x1, y1 = x[:-1][same_ring], y[:-1][same_ring], \
+        x[1:][same_ring], y[1:][same_ring]
+    edge_weight = ring_weight[ring[:-1][same_ring]]
+    up = y1 > y0
+    edge_weight = np.where(up, -edge_weight, edge_weight)
+    row0 = np.clip(np.ceil(np.minimum(y0, y1)), 0, ny).astype(np.intp)
+    row1 = np.clip(np.ceil(np.maximum(y0, y1)), 0, ny).astype(np.intp)
+    n_rows = row1 - row0
+    keep = n_rows > 0
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+    edge_weight, row0, n_rows = edge_weight[keep], row0[keep], n_rows[keep]
+
+    # One crossing per edge and row
+    edge = np.repeat(np.arange(len(n_rows)), n_rows)
+    offsets = np.zeros(len(n_rows) + 1, dtype=np.intp)
+    np.cumsum(n_rows, out=offsets[1:])
+    rows = row0[edge] + np.arange(offsets[-1]) - offsets[:-1][edge]
+    slope = (x1 - x0) / (y1 - y0)
+    cols = x0[edge] + (rows - y0[edge]) * slope[edge]
+    cols = np.clip(np.ceil(cols), 0, nx).astype(np.intp)
+    return rows * (nx + 1) + cols, edge_weight[edge]
+
+
+def rasterize_depth(polygons, wcs, shape, weights=None,
+                    chunk_size=CHUNK_SIZE):
+    """Count the polygons covering each pixel of a WCS grid.
+
+    Parameters
+    ----------
+    polygons : list
+        Nx2 RA, Dec vertex arrays, a dictionary of them or a
+        :class:`andromap.footprintset.FootprintSet`.
+    wcs : :class:`astropy.wcs.WCS`
+        Celestial WCS of the grid.
+    shape : tuple
+        Image shape, (ny, nx).
+    weights : ndarray
+        Optional weight of each polygon (e.g. its exposure time); by default
+        each polygon counts once.
+    chunk_size : int
+        Number of polygons filled at once; bounds the memory held by
+        scanline crossings.
+
+    Returns
+    -------
+    depth : ndarray
+        ``shape`` image of the summed weights of the polygons covering each
+        pixel centre.
+    """
+    if isinstance(polygons, FootprintSet):
+        footprints = polygons
+    elif isinstance(polygons, dict):
+        footprints = FootprintSet.from_dict(polygons)
+    else:
+        footprints = FootprintSet.from_polygons(range(len(polygons)),
+                                                polygons)
+    if weights is None:
+        weights = np.ones(len(footprints))
+    weights = np.asarray(weights, dtype=np.float64)
+    footprints = footprints.normalize()
+    has_area = footprints.counts >= 4
+    footprints = footprints.subset(has_area)
+    weights = weights[has_area]
+
+    ny, nx = shape
+    diff = np.zeros((ny, nx + 1))
+    flat = diff.ravel()
+    for i0 in range(0, len(footprints), chunk_size):
+        chunk = footprints.subset(slice(i0, i0 + chunk_size))
+        index, values = _crossings(chunk, weights[i0:i0 + chunk_size],
+                                   wcs, shape)
+        if len(index) == 0:
+            continue
+        lo = index.min()
+        flat[lo:index.max() + 1] += np.bincount(index - lo, weights=values)
+    depth = np.cumsum(diff, axis=1)[:, :nx]
+    # Weights cancel at the far edges of polygons; clear rounding residue
+    if len(weights) > 0:
+        depth[np.abs(depth) < 1e-9 * np.abs(weights).max()] = 0.
+    return depth
+
+
+class DepthMap(object):
+    """An image of coverage depth on a WCS grid.
+
+    Parameters
+    ----------
+    data : ndarray
+        Depth of each pixel.
+    wcs : :class:`astropy.wcs.WCS`
+        Celestial WCS of the image.
+    unit : str
+        What the depth counts, e.g. ``'exposures'`` or ``'s'`` for summed
+        exposure time.
+    """
+    def __init__(self, data, wcs, unit='exposures'):
+        super(DepthMap, self).__init__()
+        self.data = data
+        self.wcs = wcs
+        self.unit = unit
+
+    @classmethod
+    def from_polygons(cls, polygons, wcs, shape, weights=None,
+                      unit='exposures', chunk_size=CHUNK_SIZE):
+        """Rasterize polygons; see :func:`rasterize_depth`."""
+        data = rasterize_depth(polygons, wcs, shape, weights=weights,
+                               chunk_size=chunk_size)
+        if weights is None:
+            data = np.rint(data).astype(np.int32)
+        return cls(data, wcs, unit=unit)
+
+    @classmethod
+    def read(cls, path):
+        """Read a depth map written by :meth:`write`."""
+        with fits.open(path) as hdus:
+            hdu = hdus[0]
+            return cls(hdu.data.copy(), WCS(hdu.header),
+                       unit=hdu.header.get('BUNIT', 'exposures'))
+
+    def __repr__(self):
+        return "<DepthMap of %i x %i pixels, max %g %s>" % (
+            self.shape[1], self.shape[0], self.max(), self.unit)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def max(self):
+        """Greatest depth."""
+        if self.data.size == 0:
+            return 0
+        return self.data.max()
+
+    def to_hdu(self):
+        """A FITS primary HDU of the depth map."""
+        header = self.wcs.to_header()
+        header['BUNIT'] = self.unit
+        return fits.PrimaryHDU(data=self.data, header=header)
+
+    def write(self, path, overwrite=False):
+        """Write the depth map as a FITS image."""
+        dirname = os.path.dirname(path)
+        if dirname != "" and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.to_hdu().writeto(path, overwrite=overwrite)
+
+
+def image_depth(sel, dataset, exptime=False, chunk_size=CHUNK_SIZE):
+    """Depth of the image log footprints matching a selector, on the grid
+    of a FITS basemap.
+
+    Parameters
+    ----------
+    sel : dict
+        Mongo selector.
+    dataset : str or HDU
+        FITS basemap, as passed to :class:`andromap.andromap.Andromap`,
+        whose WCS grid the depth is rasterized on.
+    exptime : bool
+        Sum the ``EXPTIME`` of the images covering each pixel instead of
+        counting them.
+    """
+    wcs, shape = basemap_wcs(dataset)
+    if not exptime:
+        footprints = fetch_polygons('images', sel)
+        return DepthMap.from_polygons(footprints, wcs, shape,
+                                      chunk_size=chunk_size)
+    groups = fetch_polygons('images', sel, group_by='EXPTIME')
+    exptimes = [t for t in groups if t is not None]
+    footprints = FootprintSet.concatenate([groups[t] for t in exptimes])
+    weights = np.repeat(np.asarray(exptimes, dtype=np.float64),
+                        [len(groups[t]) for t in exptimes])
+    return DepthMap.from_polygons(footprints, wcs, shape, weights=weights,
+                                  unit='s', chunk_size=chunk_size)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Density maps of point catalogs on a WCS grid.
+
+Catalogs of resolved stars are far too large to draw a marker per star.
+Instead, points are binned onto the pixels of a WCS grid (usually the
+basemap's), chunk by chunk so that memory-mapped catalogs of any length
+can be binned::
+
+    counts = bin_catalog(ra, dec, wcs, shape)
+    m.plot_catalog_density(ra, dec, stretch='log')
+
+For gnomonic (TAN) grids without distortions, points are projected with
+:class:`andromap.tanproj.TangentProjection` about the reference point and
+mapped to pixels by the inverse of the WCS's linear transformation; other
+grids go through astropy. Each chunk of pixel indices is counted (or
+summed with weights) with one ``bincount``.
+"""
+
+import numpy as np
+
+from .coverage import basemap_wcs
+from .tanproj import TangentProjection
+
+
+# Points binned at once
+CHUNK_SIZE = 1 << 22
+
+
+def _is_plain_tan(wcs):
+    """Whether the pixel coordinates of a WCS are a linear transformation
+    of the tangent-plane coordinates about its reference point.
+    """
+    ctype = [c.upper() for c in wcs.wcs.ctype]
+    return ctype[0].startswith('RA--') and ctype[0].endswith('-TAN') \
+        and ctype[1].startswith('DEC-') and ctype[1].endswith('-TAN') \
+        and not wcs.has_distortion and wcs.wcs.lonpole == 180.
+
+
+class _PixelMapper(object):
+    """Maps RA, Dec to 0-based pixel coordinates of a WCS."""
+    def __init__(self, wcs):
+        super(_PixelMapper, self).__init__()
+        self.wcs = wcs
+        wcs.wcs.set()
+        self._tan = _is_plain_tan(wcs)
+        if self._tan:
+            ra0, dec0 = wcs.wcs.crval
+            self._projection = TangentProjection(ra0, dec0)
+            self._inverse = np.linalg.inv(wcs.pixel_scale_matrix)
+            self._crpix = wcs.wcs.crpix - 1.
+
+    def __call__(self, ra, dec):
+        if not self._tan:
+            return self.wcs.wcs_world2pix(ra, dec, 0)
+        xi, eta = self._projection.forward(ra, dec)
+        (m00, m01), (m10, m11) = self._inverse
+        x = xi * m00
+        x += eta * m01
+        x += self._crpix[0]
+        eta *= m11
+        eta += xi * m10
+        eta += self._crpix[1]
+        return x, eta
+
+
+def bin_catalog(ra, dec, wcs, shape, weights=None, chunk_size=CHUNK_SIZE):
+    """Count catalog points in each pixel of a WCS grid.
+
+    Parameters
+    ----------
+    ra, dec : ndarray
+        Coordinates, degrees. They may be memory-mapped; only
+        ``chunk_size`` points are read at a time, and float32 columns are
+        projected in float32.
+    wcs : :class:`astropy.wcs.WCS`
+        Celestial WCS of the grid.
+    shape : tuple
+        Image shape, (ny, nx).
+    weights : ndarray
+        Optional weight of each point.
+    chunk_size : int
+        Number of points binned at once.
+
+    Returns
+    -------
+    image : ndarray
+        ``shape`` image of the counts (or summed weights) of the points
+        falling in each pixel.
+    """
+    ny, nx = shape
+    mapper = _PixelMapper(wcs)
+    image = np.zeros(ny * nx)
+    for i0 in range(0, len(ra), chunk_size):
+        sl = slice(i0, i0 + chunk_size)
+        x, y = mapper(np.asarray(ra[sl]), np.asarray(dec[sl]))
+        # Pixel centres are at integer coordinates
+        ix = np.floor(x + 0.5).astype(np.intp)
+        iy = np.floor(y + 0.5).astype(np.intp)
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        index = iy[inside] * nx + ix[inside]
+        if len(index) == 0:
+            continue
+        w = None
+        if weights is not None:
+            w = np.asarray(weights[sl])[inside]
+        lo = index.min()
+        image[lo:index.max() + 1] += np.bincount(index - lo, weights=w)
+    return image.reshape(shape)
+
+
+def catalog_density(ra, dec, dataset, weights=None, chunk_size=CHUNK_SIZE):
+    """Bin a catalog onto the grid of a FITS basemap (a path or an HDU).
+
+    Returns the image and the basemap's WCS. See :func:`bin_catalog`.
+    """
+    wcs, shape = basemap_wcs(dataset)
+    image = bin_catalog(ra, dec, wcs, shape, weights=weights,
+                        chunk_size=chunk_size)
+    return image, wcs
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Grids of ellipses from surface brightness profiles.
+
+The position angle and ellipticity of an XVISTA profile are interpolated
+to every radius of a grid at once, the parametric ellipses of all radii are
+laid out in one packed tangent-plane vertex buffer, and the buffer is
+projected to RA, Dec in one call (see
+:meth:`andromap.tanproj.TangentProjection.inverse_polygons`)::
+
+    a, b, pa = profile_ellipses(prof, np.arange(5., 60., 0.25))
+    n = adaptive_vertex_counts(a, pix_scale)
+    polygons = ellipse_polygons(a, b, pa, M31RA0, M31DEC0, n_verts=n)
+
+Vertex counts can be chosen per ellipse so that the polygon departs from
+the ellipse by less than a fraction of an output pixel.
+
+:class:`IsophoteModel` inverts the same family of ellipses, giving the
+elliptical galactocentric radius of catalog sources::
+
+    model = IsophoteModel.from_profile(prof)
+    r_kpc = model.radius(catalog['ra'], catalog['dec'])
+"""
+
+import numpy as np
+
+from .constants import D_KPC, M31RA0, M31DEC0
+from .tanproj import TangentProjection, tan_to_eq_polygons
+
+
+# Bounds on adaptive vertex counts
+MIN_VERTICES = 32
+MAX_VERTICES = 4096
+# Points whose radii are solved at once
+CHUNK_SIZE = 65536
+
+
+def interp_ellipses(R, PA, ELL, radii):
+    """Interpolate the PA and ellipticity of a profile to radii.
+
+    Both are interpolated with one ``np.interp`` call, for the fractional
+    position of each radius in the profile. Past the end of the profile the
+    last profile ellipse is kept.
+
+    Parameters
+    ----------
+    R : ndarray
+        Increasing radii of the profile.
+    PA, ELL : ndarray
+        Position angle and ellipticity at each profile radius.
+    radii : ndarray
+        Radii to interpolate to, in the units of ``R``.
+
+    Returns
+    -------
+    pa, ell : ndarray
+        Position angle and ellipticity at each radius.
+    """
+    R = np.asarray(R, dtype=float)
+    table = np.vstack([PA, ELL]).astype(float)
+    pos = np.interp(radii, R, np.arange(len(R), dtype=float))
+    i = np.clip(np.floor(pos).astype(np.intp), 0, len(R) - 2)
+    w = pos - i
+    values = table[:, i] * (1. - w) + table[:, i + 1] * w
+    return values[0], values[1]
+
+
+def profile_radii(prof):
+    """Semi-major axes of an XVISTA profile's ellipses, kpc."""
+    return D_KPC * np.tan(np.asarray(prof['R']) / 3600. * np.pi / 180.)
+
+
+def profile_ellipses(prof, radii):
+    """Ellipses of an XVISTA surface brightness profile at radii in kpc.
+
+    Parameters
+    ----------
+    prof : table
+        Profile with columns ``R`` (semi-major axis, arcsec), ``PA``
+        (XVISTA position angle, degrees from the +x axis) and ``ELL``.
+    radii : ndarray
+        Semi-major axes, kpc.
+
+    Returns
+    -------
+    a_deg, b_deg : ndarray
+        Semi-major and semi-minor axes, degrees.
+    pa : ndarray
+        Position angle, degrees counter-clockwise from north.
+    """
+    R = profile_radii(prof)
+    radii = np.atleast_1d(np.asarray(radii, dtype=float))
+    pa, ell = interp_ellipses(R, prof['PA'], prof['ELL'], radii)
+    a_deg = np.arctan(radii / D_KPC) * 180. / np.pi
+    b_deg = (1. - ell) * a_deg
+    # XVISTA pa is from +x axis (which points rightwards), out
+    # PA must be CCW from north
+    return a_deg, b_deg, 90. - pa
+
+
+def adaptive_vertex_counts(a_deg, pix_scale, tolerance=0.5,
+                           min_verts=MIN_VERTICES, max_verts=MAX_VERTICES):
+    """Number of vertices that ellipses of semi-major axes ``a_deg`` need
+    to be drawn to within ``tolerance`` pixels of ``pix_scale`` degrees.
+
+    With vertices at even steps ``dt`` of the parametric angle, chords
+    depart furthest from an ellipse at the ends of its major axis, by
+    ``a dt**2 / 8`` whatever its minor axis. The count is therefore the
+    perimeter of the circle of radius ``a`` over the chord
+    ``sqrt(8 a tol)`` that departs from it by the tolerance.
+    """
+    a_deg = np.asarray(a_deg, dtype=float)
+    tol = tolerance * pix_scale
+    n = np.ceil(2. * np.pi * a_deg / np.sqrt(8. * a_deg * tol))
+    return np.clip(n, min_verts, max_verts).astype(np.intp)
+
+
+def ellipse_grid(a_deg, b_deg, pa, n_verts=1000):
+    """Lay out the tangent-plane vertices of many ellipses in one buffer.
+
+    Parameters
+    ----------
+    a_deg, b_deg : ndarray
+        Semi-major and semi-minor axes, degrees.
+    pa : ndarray
+        Position angles, degrees counter-clockwise from north.
+    n_verts : int or ndarray
+        Vertices of every ellipse, or of each one.
+
+    Returns
+    -------
+    vertices : ndarray
+        ``(N, 2)`` xi, eta vertices of all ellipses, degrees.
+    offsets : ndarray
+        Ellipse ``i`` is ``vertices[offsets[i]:offsets[i + 1]]``.
+    """
+    a_deg, b_deg, pa = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(a_deg, dtype=float)),
+        np.atleast_1d(np.asarray(b_deg, dtype=float)),
+        np.atleast_1d(np.asarray(pa, dtype=float)))
+    counts = np.broadcast_to(np.asarray(n_verts, dtype=np.intp),
+                             a_deg.shape)
+    offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+    np.cumsum(counts, out=offsets[1:])
+    p = pa * np.pi / 180.
+    cos_p, sin_p = np.cos(p), np.sin(p)
+    if len(counts) > 0 and (counts == counts[0]).all():
+        # A (n_ellipses, n_verts) grid of one set of parametric angles
+        t = np.arange(counts[0]) * (2. * np.pi / counts[0])
+        cos_t, sin_t = np.cos(t)[None, :], np.sin(t)[None, :]
+        a, b = a_deg[:, None], b_deg[:, None]
+        cos_p, sin_p = cos_p[:, None], sin_p[:, None]
+    else:
+        ellipse = np.repeat(np.arange(len(counts)), counts)
+        # Parametric angle of each vertex
+        t = (np.arange(offsets[-1]) - offsets[:-1][ellipse]) \
+            * (2. * np.pi / counts[ellipse])
+        cos_t, sin_t = np.cos(t), np.sin(t)
+        a, b = a_deg[ellipse], b_deg[ellipse]
+        cos_p, sin_p = cos_p[ellipse], sin_p[ellipse]
+    vertices = np.empty((offsets[-1], 2))
+    # Parametric equation for an ellipse centered at origin
+    # note that the x-axis is reverse; increases to left
+    vertices[:, 0] = -(a * cos_t * cos_p - b * sin_t * sin_p).ravel()
+    vertices[:, 1] = (a * cos_t * sin_p + b * sin_t * cos_p).ravel()
+    return vertices, offsets
+
+
+def ellipse_polygons(a_deg, b_deg, pa, ra0=M31RA0, dec0=M31DEC0,
+                     n_verts=1000):
+    """Make polygons with RA, Dec vertices from many ellipses centred on
+    ``ra0``, ``dec0``, projected in one call.
+
+    See :func:`ellipse_grid` for the parameters. Returns ``(n, 2)`` views
+    of one vertex buffer.
+    """
+    vertices, offsets = ellipse_grid(a_deg, b_deg, pa, n_verts=n_verts)
+    return tan_to_eq_polygons(vertices, offsets, ra0=ra0, dec0=dec0)
+
+
+def ellipse_tan_vertices(r_deg, b_deg, pa, n_verts=1000):
+    """Make a polygon with xi, eta vertices (degrees) from an ellipse
+    centred on the tangent point.
+    """
+    return ellipse_grid(r_deg, b_deg, pa, n_verts=n_verts)[0]
+
+
+def ellipse_polygon(r_deg, b_deg, pa, ra0, dec0, n_verts=1000):
+    """Make a polygon with RA,Dec vertices from an ellipse."""
+    return ellipse_polygons(r_deg, b_deg, pa, ra0=ra0, dec0=dec0,
+                            n_verts=n_verts)[0]
+
+
+def ellipse_generator(R, PA, ELL, radii):
+    """Generate interpolated ellipses at the given radii (kpc).
+
+    The generate will continue to make ellipses past the profile by maintaining
+    PA and ellipticity from the last profile ellipse.
+    """
+    pa, ell = interp_ellipses(R, PA, ELL, radii)
+    for r0, p, e in zip(radii, pa, ell):
+        yield r0, p, e
+
+
+class IsophoteModel(object):
+    """Elliptical galactocentric radii from a radius-dependent family of
+    ellipses, as drawn by :func:`profile_ellipses`.
+
+    A point's radius is the semi-major axis ``r`` of the family's ellipse
+    passing through it, found where
+    ``h(r) = a(r) - sqrt(u**2 + (v / (1 - ell(r)))**2)`` changes sign,
+    ``u`` and ``v`` being the point's tangent-plane coordinates along the
+    axes of the ellipse at ``r``. PA and ellipticity are linear between
+    profile radii and held constant beyond them, as in
+    :func:`interp_ellipses`. Roots are found for all points at once: by
+    bisection over the profile radii, comparing with the ellipses tabulated
+    there, then by regula falsi within the bracketing interval. Radii are
+    unique where the ellipses are nested, i.e. where their semi-minor axes
+    grow with radius and position angles twist slowly.
+
+    Parameters
+    ----------
+    R : ndarray
+        Increasing semi-major axes of the profile ellipses, kpc.
+    PA : ndarray
+        Position angles, degrees counter-clockwise from north.
+    ELL : ndarray
+        Ellipticities.
+    ra0, dec0 : float
+        Centre of the ellipses, degrees.
+    max_radius : float
+        Radii are solved up to this semi-major axis, kpc; points further
+        out get NaN.
+    """
+    def __init__(self, R, PA, ELL, ra0=M31RA0, dec0=M31DEC0,
+                 max_radius=None):
+        super(IsophoteModel, self).__init__()
+        R = np.asarray(R, dtype=float)
+        PA = np.asarray(PA, dtype=float)
+        ELL = np.asarray(ELL, dtype=float)
+        if max_radius is None:
+            max_radius = max(10. * R[-1], D_KPC * np.tan(np.radians(30.)))
+        self.ra0 = ra0
+        self.dec0 = dec0
+        self.max_radius = max_radius
+        self._projection = TangentProjection(ra0, dec0)
+        # Node table, from the centre to max_radius
+        self._r = np.concatenate([[0.], R, [max(max_radius, R[-1])]])
+        self._pa = np.radians(np.concatenate([PA[:1], PA, PA[-1:]]))
+        self._ell = np.concatenate([ELL[:1], ELL, ELL[-1:]])
+        self._a = np.degrees(np.arctan(self._r / D_KPC))
+        self._cos = np.cos(self._pa)
+        self._sin = np.sin(self._pa)
+        self._stretch = 1. / (1. - self._ell)
+
+    @classmethod
+    def from_profile(cls, prof, **kwargs):
+        """Model of an XVISTA profile (see :func:`profile_ellipses`)."""
+        return cls(profile_radii(prof), 90. - np.asarray(prof['PA']),
+                   prof['ELL'], **kwargs)
+
+    def radius(self, ra, dec, tolerance=1e-4, chunk_size=CHUNK_SIZE,
+               out=None):
+        """Elliptical radius of points, kpc.
+
+        Parameters
+        ----------
+        ra, dec : ndarray
+            Coordinates, degrees; may be memory-mapped.
+        tolerance : float
+            Precision of the radii, kpc.
+        chunk_size : int
+            Points solved at once; bounds the memory used.
+        out : ndarray
+            Optional float64 array that radii are written into.
+        """
+        ra = np.asarray(ra).reshape(-1)
+        dec = np.asarray(dec).reshape(-1)
+        if out is None:
+            out = np.empty(len(ra))
+        for i0 in range(0, len(ra), chunk_size):
+            sl = slice(i0, i0 + chunk_size)
+            out[sl] = self._solve(ra[sl], dec[sl], tolerance)
+        return out
+
+    def iter_radius(self, chunks, tolerance=1e-4):
+        """Radii of a stream of ``(ra, dec)`` chunks, one array per chunk,
+        e.g. read from a catalog too large to hold.
+        """
+        for ra, dec in chunks:
+            yield self._solve(np.asarray(ra, dtype=float),
+                              np.asarray(dec, dtype=float), tolerance)
+
+    def xi_eta_radius(self, xi, eta, tolerance=1e-4):
+        """Elliptical radius (kpc) of tangent-plane coordinates, degrees."""
+        xi = np.asarray(xi, dtype=float)
+        eta = np.asarray(eta, dtype=float)
+        # The ellipse through a point at distance d has a semi-major axis
+        # between d and d / (1 - ell), which brackets the profile nodes
+        d = np.hypot(xi, eta)
+        n_nodes = len(self._r)
+        lo = np.clip(np.searchsorted(self._a, d, side='right') - 1,
+                     0, n_nodes - 2)
+        hi = np.clip(np.searchsorted(self._a, d * self._stretch.max()),
+                     lo + 1, n_nodes - 1)
+        beyond = self._h_nodes(hi, xi, eta) < 0.
+        # Bisect the bracket down to neighbouring nodes
+        while True:
+            open_ = hi - lo > 1
+            if not open_.any():
+                break
+            mid = (lo + hi) // 2
+            below = self._h_nodes(mid, xi, eta) <= 0.
+            np.copyto(lo, mid, where=open_ & below)
+            np.copyto(hi, mid, where=open_ & ~below)
+        dr = self._r[lo + 1] - self._r[lo]
+        w = self._solve_interval(lo, dr, xi, eta, tolerance)
+        r = self._r[lo] + w * dr
+        r[beyond] = np.nan
+        return r
+
+    def _solve_interval(self, k, dr, xi, eta, tolerance, max_iter=100):
+        """Find the fraction of the way between nodes ``k`` and ``k + 1``
+        at which ``h`` changes sign, by regula falsi with the Illinois
+        modification. Only points that have not converged are evaluated.
+
+        A point has converged once its bracket is narrower than
+        ``tolerance``, or once ``h`` is within a small fraction of the angle
+        that ``tolerance`` subtends; ``h`` changes about as fast as the
+        semi-major axis.
+        """
+        h_tol = 1e-3 * np.degrees(tolerance / D_KPC)
+        w_out = np.zeros(xi.shape)
+        # State of the points still being solved
+        index = np.arange(xi.size)
+        xi, eta, k, dr = xi.ravel(), eta.ravel(), k.ravel(), dr.ravel()
+        wl = np.zeros(xi.size)
+        wh = np.ones(xi.size)
+        hl = self._h_nodes(k, xi, eta)
+        hh = self._h_nodes(k + 1, xi, eta)
+        side = np.zeros(xi.size, dtype=np.int8)
+        for i in range(max_iter):
+            done = (wh - wl) * dr <= tolerance
+            n_done = np.count_nonzero(done)
+            if n_done == len(index):
+                break
+            if n_done > len(index) // 4:
+                # Drop converged points once there are enough of them
+                w_out.flat[index[done]] = 0.5 * (wl[done] + wh[done])
+                keep = ~done
+                index, xi, eta, k, dr = index[keep], xi[keep], eta[keep], \
+                    k[keep], dr[keep]
+                wl, wh, hl, hh, side = wl[keep], wh[keep], hl[keep], \
+                    hh[keep], side[keep]
+            span = hh - hl
+            w = wl - hl * (wh - wl) / np.where(span > 0., span, 1.)
+            # Keep the estimate inside the bracket
+            w = np.where(span > 0., np.clip(w, wl, wh), 0.5 * (wl + wh))
+            h = self._h_interval(k, w, xi, eta)
+            below = h <= 0.
+            # Halve the end kept twice in a row (Illinois)
+            hh[below & (side == 1)] *= 0.5
+            hl[~below & (side == -1)] *= 0.5
+            above = ~below
+            np.copyto(wl, w, where=below)
+            np.copyto(hl, h, where=below)
+            np.copyto(wh, w, where=above)
+            np.copyto(hh, h, where=above)
+            side = np.where(below, 1, -1).astype(np.int8)
+            # Points on their root are done
+            close = np.abs(h) < h_tol
+            wl[close] = w[close]
+            wh[close] = w[close]
+        w_out.flat[index] = 0.5 * (wl + wh)
+        return w_out
+
+    def _solve(self, ra, dec, tolerance):
+        xi, eta = self._projection.forward(ra, dec)
+        return self.xi_eta_radius(xi, eta, tolerance=tolerance)
+
+    def _h_nodes(self, k, xi, eta):
+        """``h`` at profile node ``k`` of each point."""
+        return self._h(self._a[k], self._cos[k], self._sin[k],
+                       self._stretch[k], xi, eta)
+
+    def _h_interval(self, k, w, xi, eta):
+        """``h`` a fraction ``w`` of the way from node ``k`` to the next."""
+        r = self._r[k] + w * (self._r[k + 1] - self._r[k])
+        pa = self._pa[k] + w * (self._pa[k + 1] - self._pa[k])
+        ell = self._ell[k] + w * (self._ell[k + 1] - self._ell[k])
+        a = np.degrees(np.arctan(r / D_KPC))
+        return self._h(a, np.cos(pa), np.sin(pa), 1. / (1. - ell), xi, eta)
+
+    @staticmethod
+    def _h(a, cos_p, sin_p, stretch, xi, eta):
+        u = eta * sin_p
+        u -= xi * cos_p
+        v = xi * sin_p
+        v += eta * cos_p
+        v *= stretch
+        u *= u
+        v *= v
+        u += v
+        np.sqrt(u, out=u)
+        return np.subtract(a, u, out=u)
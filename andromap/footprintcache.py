@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+In-process memoization of image log footprint queries.
+
+Results are keyed by a canonical form of the Mongo selector, so selectors that
+differ only in dictionary order or in the order of ``$in``/``$nin`` lists share
+a cache entry. Entries expire after a TTL and the least-recently used entries
+are evicted once the cache holds more than a set number of vertices. Cached
+vertex arrays are read-only.
+"""
+
+import time
+import logging
+import threading
+import functools
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Operators whose list arguments are sets, so their order is irrelevant.
+SET_OPERATORS = ('$in', '$nin', '$all')
+
+
+def canonical_selector(sel):
+    """Make a hashable, order-independent key from a Mongo selector (or any
+    nesting of dicts, lists, arrays and scalars).
+    """
+    if isinstance(sel, np.ndarray):
+        return canonical_selector(sel.tolist())
+    if isinstance(sel, dict):
+        items = []
+        for k, v in sel.items():
+            if k in SET_OPERATORS and isinstance(v, (list, tuple, set)):
+                members = [canonical_selector(x) for x in v]
+                items.append((k, ('$set',) + tuple(sorted(set(members),
+                                                          key=repr))))
+            else:
+                items.append((k, canonical_selector(v)))
+        return ('$dict',) + tuple(sorted(items, key=lambda kv: kv[0]))
+    elif isinstance(sel, (list, tuple)):
+        return ('$list',) + tuple(canonical_selector(x) for x in sel)
+    elif isinstance(sel, set):
+        return ('$set',) + tuple(sorted((canonical_selector(x) for x in sel),
+                                        key=repr))
+    return sel
+
+
+def _freeze(result):
+    """Mark the vertex arrays of a query result (nested dicts and lists of
+    arrays) read-only and count their vertices. Other objects are counted by
+    their ``n_vertices`` attribute, if any.
+    """
+    if isinstance(result, np.ndarray):
+        result.setflags(write=False)
+        return result, len(result)
+    if hasattr(result, 'n_vertices'):
+        return result, result.n_vertices
+    n_verts = 0
+    if isinstance(result, dict):
+        for value in result.values():
+            n_verts += _freeze(value)[1]
+    elif isinstance(result, (list, tuple)):
+        for value in result:
+            n_verts += _freeze(value)[1]
+    return result, n_verts
+
+
+def _copy_result(result):
+    """Copy the containers (not the arrays) of a query result so that
+    callers may add/remove names without changing the cached result.
+    """
+    if isinstance(result, dict):
+        return dict((k, _copy_result(v)) for k, v in result.items())
+    elif isinstance(result, list):
+        return [_copy_result(v) for v in result]
+    return result
+
+
+class FootprintCache(object):
+    """LRU cache of footprint query results bounded by total vertex count.
+
+    Parameters
+    ----------
+    max_vertices : int
+        Maximum number of vertices held across all cached results.
+    ttl : float
+        Lifetime of a cache entry, in seconds. ``None`` disables expiry.
+    enabled : bool
+        If ``False`` queries always go to the database.
+    """
+    def __init__(self, max_vertices=5000000, ttl=3600., enabled=True):
+        super(FootprintCache, self).__init__()
+        self.max_vertices = max_vertices
+        self.ttl = ttl
+        self.enabled = enabled
+        self._entries = OrderedDict()  # key: (timestamp, n_verts, value)
+        self._n_vertices = 0
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        self._log = logging.getLogger('andromap')
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def n_vertices(self):
+        """Number of vertices currently held."""
+        return self._n_vertices
+
+    @property
+    def stats(self):
+        """Dictionary of cache ``hits``, ``misses``, ``entries`` and
+        ``vertices``.
+        """
+        return {'hits': self._hits, 'misses': self._misses,
+                'entries': len(self._entries),
+                'vertices': self._n_vertices}
+
+    def get(self, key):
+        """Get a cached value, or raise ``KeyError`` if the key is absent or
+        expired.
+        """
+        with self._lock:
+            try:
+                timestamp, n_verts, value = self._entries[key]
+            except KeyError:
+                self._misses += 1
+                raise
+            if self.ttl is not None and time.time() - timestamp > self.ttl:
+                self._discard(key)
+                self._misses += 1
+                raise KeyError(key)
+            # Move to the most-recently used end
+            del self._entries[key]
+            self._entries[key] = (timestamp, n_verts, value)
+            self._hits += 1
+            return value
+
+    def put(self, key, value, n_vertices):
+        """Insert a value that holds ``n_vertices`` vertices."""
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            if n_vertices > self.max_vertices:
+                self._log.debug("Not caching result with %i vertices"
+                                % n_vertices)
+                return
+            self._entries[key] = (time.time(), n_vertices, value)
+            self._n_vertices += n_vertices
+            while self._n_vertices > self.max_vertices:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+
+    def invalidate(self, key=None):
+        """Drop one entry, or every entry if ``key`` is ``None``."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._n_vertices = 0
+            elif key in self._entries:
+                self._discard(key)
+
+    def _discard(self, key):
+        timestamp, n_verts, value = self._entries.pop(key)
+        self._n_vertices -= n_verts
+
+
+_cache = FootprintCache()
+
+
+def get_cache():
+    """Get the module-level :class:`FootprintCache`."""
+    return _cache
+
+
+def configure_cache(**kwargs):
+    """Set ``max_vertices``, ``ttl`` or ``enabled`` on the module-level cache.
+    """
+    for k, v in kwargs.items():
+        if k not in ('max_vertices', 'ttl', 'enabled'):
+            raise TypeError("Unknown cache option %s" % k)
+        setattr(_cache, k, v)
+    if not _cache.enabled:
+        _cache.invalidate()
+
+
+def invalidate(func=None, *args, **kwargs):
+    """Invalidate cached footprint queries.
+
+    With no arguments the whole cache is cleared. Otherwise only the entry for
+    calling the cached function ``func`` with ``args`` and ``kwargs`` is
+    dropped, e.g. ``invalidate(get_image_footprints, sel)``.
+    """
+    if func is None:
+        _cache.invalidate()
+    else:
+        name = getattr(func, '__wrapped__', func).__name__
+        _cache.invalidate(_make_key(name, args, kwargs))
+
+
+def _make_key(name, args, kwargs):
+    return (name, canonical_selector(list(args)),
+            canonical_selector(kwargs))
+
+
+def cached_query(func):
+    """Decorator memoizing a footprint query function that returns ``None``,
+    (nested dictionaries and lists of) vertex arrays, or an object with an
+    ``n_vertices`` attribute such as a footprint index.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _cache.enabled:
+            return func(*args, **kwargs)
+        key = _make_key(func.__name__, args, kwargs)
+        try:
+            return _copy_result(_cache.get(key))
+        except KeyError:
+            pass
+        value, n_verts = _freeze(func(*args, **kwargs))
+        _cache.put(key, value, n_verts)
+        return _copy_result(value)
+    wrapper.__wrapped__ = func
+    return wrapper
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Packed, ragged storage of named footprints.
+
+A :class:`FootprintSet` holds the vertices of every footprint in one
+contiguous ``(N, 2)`` float64 array, with an offsets array delimiting each
+footprint and a list of names. Per-footprint quantities (bounding boxes,
+centres, centroids, areas) are computed for the whole set with vectorized
+reductions, and each footprint is available as a zero-copy view.
+:func:`normalize_rings` puts every footprint of a packed buffer into one
+canonical form (closed, without repeated vertices, consistently oriented)
+in a few array operations.
+
+A FootprintSet also behaves as a read-only dictionary of names mapping to
+``(n, 2)`` vertex arrays, so code written against the original dictionaries
+keeps working.
+"""
+
+import numpy as np
+
+
+def normalize_rings(vertices, offsets, orientation='ccw'):
+    """Normalize packed polygon rings.
+
+    Consecutive duplicate vertices are dropped, as is a closing vertex, and
+    rings wound the wrong way are reversed (keeping their first vertex);
+    every ring is then closed by repeating its first vertex. The result is
+    already normalized, so normalizing again returns the same rings.
+    Rings with no vertices are left empty.
+
+    Parameters
+    ----------
+    vertices : ndarray
+        ``(N, 2)`` array of the vertices of all rings.
+    offsets : ndarray
+        Length ``n + 1`` array; ring ``i`` is
+        ``vertices[offsets[i]:offsets[i + 1]]``.
+    orientation : str
+        ``'ccw'`` for counter-clockwise rings (positive area in the x, y
+        plane, as shapely orients exteriors), ``'cw'`` for clockwise, or
+        ``None`` to keep the winding of each ring.
+
+    Returns
+    -------
+    vertices : ndarray
+        New ``(M, 2)`` vertex array.
+    offsets : ndarray
+        New offsets of the rings.
+    """
+    if orientation not in ('ccw', 'cw', None):
+        raise ValueError("orientation must be 'ccw', 'cw' or None")
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=np.intp)
+    vertices = vertices[offsets[0]:offsets[-1]]
+    offsets = offsets - offsets[0]
+    n = len(offsets) - 1
+    counts = np.diff(offsets)
+    ring = np.repeat(np.arange(n), counts)
+
+    # Drop vertices repeating the previous vertex of their ring
+    keep = np.ones(len(vertices), dtype=bool)
+    keep[1:] = np.any(vertices[1:] != vertices[:-1], axis=1)
+    keep[offsets[:-1][counts > 0]] = True
+    vertices = vertices[keep]
+    ring = ring[keep]
+    counts = np.bincount(ring, minlength=n)
+    # Drop a closing vertex
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    closed = counts > 1
+    closed[closed] = np.all(vertices[ends[closed] - 1]
+                            == vertices[starts[closed]], axis=1)
+    keep = np.ones(len(vertices), dtype=bool)
+    keep[ends[closed] - 1] = False
+    vertices = vertices[keep]
+    ring = ring[keep]
+    counts = counts - closed
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    # Position of each vertex around its ring, and of the vertex it would
+    # take after reversal (the first vertex stays first)
+    rank = np.arange(len(vertices)) - starts[ring]
+    m = counts[ring]
+    if orientation is not None and len(vertices):
+        nxt = np.arange(1, len(vertices) + 1)
+        nxt[ends[counts > 0] - 1] = starts[counts > 0]
+        x = vertices[:, 0]
+        y = vertices[:, 1]
+        area = np.bincount(ring, weights=x * y[nxt] - x[nxt] * y,
+                           minlength=n)
+        flip = area < 0 if orientation == 'ccw' else area > 0
+        src = np.where(flip[ring], starts[ring] + (m - rank) % m,
+                       np.arange(len(vertices)))
+        vertices = vertices[src]
+
+    # Lay the rings out again with room for a closing vertex each
+    new_counts = counts + (counts > 0)
+    new_offsets = np.zeros(n + 1, dtype=np.intp)
+    np.cumsum(new_counts, out=new_offsets[1:])
+    out = np.empty((new_offsets[-1], 2))
+    out[new_offsets[:-1][ring] + rank] = vertices
+    has = counts > 0
+    out[new_offsets[1:][has] - 1] = out[new_offsets[:-1][has]]
+    return out, new_offsets
+
+
+class FootprintSet(object):
+    """Named footprints packed into one vertex buffer.
+
+    Parameters
+    ----------
+    vertices : ndarray
+        ``(N, 2)`` array of RA, Dec vertices of all footprints.
+    offsets : ndarray
+        Length ``n + 1`` array; footprint ``i`` is
+        ``vertices[offsets[i]:offsets[i + 1]]``. Every footprint must have at
+        least one vertex.
+    names : list
+        Name of each footprint.
+    """
+    def __init__(self, vertices, offsets, names):
+        super(FootprintSet, self).__init__()
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        self.vertices = vertices.view()
+        self.vertices.setflags(write=False)
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+        self.names = list(names)
+        if len(self.offsets) != len(self.names) + 1:
+            raise ValueError("Need one more offset than names")
+        self._index = None
+
+    @classmethod
+    def from_polygons(cls, names, polygons):
+        """Pack a sequence of ``(n, 2)`` vertex arrays."""
+        polygons = [np.asarray(p, dtype=np.float64).reshape(-1, 2)
+                    for p in polygons]
+        offsets = np.zeros(len(polygons) + 1, dtype=np.intp)
+        np.cumsum([len(p) for p in polygons], out=offsets[1:])
+        if len(polygons) == 0:
+            vertices = np.zeros((0, 2))
+        else:
+            vertices = np.concatenate(polygons)
+        return cls(vertices, offsets, names)
+
+    @classmethod
+    def from_ranges(cls, vertices, starts, ends, names):
+        """Gather the footprints ``vertices[starts[i]:ends[i]]`` of a larger
+        buffer into a new FootprintSet.
+        """
+        starts = np.asarray(starts, dtype=np.intp)
+        counts = np.asarray(ends, dtype=np.intp) - starts
+        offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+        np.cumsum(counts, out=offsets[1:])
+        # Position of each output vertex in the input buffer
+        rows = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1],
+                                                  counts)
+        return cls(vertices[rows], offsets, names)
+
+    @classmethod
+    def from_dict(cls, polygons):
+        """Pack a dictionary of names mapping to vertex arrays. A
+        FootprintSet is returned unchanged.
+        """
+        if isinstance(polygons, FootprintSet):
+            return polygons
+        names = list(polygons.keys())
+        return cls.from_polygons(names, [polygons[n] for n in names])
+
+    @classmethod
+    def concatenate(cls, sets):
+        """Join several FootprintSets into one."""
+        sets = list(sets)
+        if len(sets) == 0:
+            return cls.from_polygons([], [])
+        vertices = np.concatenate([s.vertices[s.offsets[0]:s.offsets[-1]]
+                                   for s in sets])
+        offsets = [np.zeros(1, dtype=np.intp)]
+        start = 0
+        names = []
+        for s in sets:
+            offsets.append(s.offsets[1:] - s.offsets[0] + start)
+            start += s.offsets[-1] - s.offsets[0]
+            names.extend(s.names)
+        return cls(vertices, np.concatenate(offsets), names)
+
+    # Dictionary interface
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self._name_index
+
+    def __getitem__(self, name):
+        return self.polygon(self._name_index[name])
+
+    def __repr__(self):
+        return "<FootprintSet of %i footprints, %i vertices>" % (
+            len(self), self.n_vertices)
+
+    @property
+    def _name_index(self):
+        if self._index is None:
+            self._index = dict((n, i) for i, n in enumerate(self.names))
+        return self._index
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def keys(self):
+        return list(self.names)
+
+    def values(self):
+        return self.polygons()
+
+    def items(self):
+        return list(zip(self.names, self.polygons()))
+
+    def iterkeys(self):
+        return iter(self.names)
+
+    def itervalues(self):
+        return iter(self.polygons())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    # Packed access
+
+    @property
+    def n_vertices(self):
+        """Total number of vertices."""
+        return len(self.vertices)
+
+    @property
+    def counts(self):
+        """Number of vertices of each footprint."""
+        return np.diff(self.offsets)
+
+    def polygon(self, i):
+        """Zero-copy view of the vertices of the ``i``-th footprint."""
+        return self.vertices[self.offsets[i]:self.offsets[i + 1]]
+
+    def polygons(self):
+        """List of zero-copy views of every footprint's vertices."""
+        v = self.vertices
+        return [v[i0:i1] for i0, i1
+                in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
+
+    def subset(self, index):
+        """Make a FootprintSet of the footprints at ``index`` (integer
+        indices or a boolean mask), copying their vertices.
+        """
+        index = np.arange(len(self))[index]
+        return FootprintSet.from_ranges(self.vertices, self.offsets[index],
+                                        self.offsets[index + 1],
+                                        [self.names[i] for i in index])
+
+    def groupby(self, values):
+        """Split into a dictionary of group values mapping to FootprintSets,
+        given the group value of each footprint.
+        """
+        groups = {}
+        for i, value in enumerate(values):
+            groups.setdefault(value, []).append(i)
+        return dict((value, self.subset(index))
+                    for value, index in groups.items())
+
+    def normalize(self, orientation='ccw'):
+        """Make a FootprintSet of closed, consistently oriented footprints
+        without repeated vertices (see :func:`normalize_rings`).
+        """
+        vertices, offsets = normalize_rings(self.vertices, self.offsets,
+                                            orientation=orientation)
+        return FootprintSet(vertices, offsets, self.names)
+
+    def _starts(self):
+        return self.offsets[:-1]
+
+    def bboxes(self):
+        """``(n, 4)`` array of each footprint's ``ra_min``, ``ra_max``,
+        ``dec_min`` and ``dec_max``.
+        """
+        if len(self) == 0:
+            return np.zeros((0, 4))
+        starts = self._starts()
+        x = self.vertices[:, 0]
+        y = self.vertices[:, 1]
+        return np.column_stack([np.minimum.reduceat(x, starts),
+                                np.maximum.reduceat(x, starts),
+                                np.minimum.reduceat(y, starts),
+                                np.maximum.reduceat(y, starts)])
+
+    def centers(self):
+        """``(n, 2)`` array of the centres of each footprint's bounding box.
+        """
+        b = self.bboxes()
+        return np.column_stack([0.5 * (b[:, 0] + b[:, 1]),
+                                0.5 * (b[:, 2] + b[:, 3])])
+
+    def center(self):
+        """Mean of the footprints' bounding box centres, as ``(ra, dec)``
+        (the centre :func:`andromap.imagelogfootprints.get_field_centers`
+        reports).
+        """
+        c = self.centers()
+        return float(c[:, 0].mean()), float(c[:, 1].mean())
+
+    def _shoelace(self):
+        """Signed areas and area-weighted centroid sums of each footprint,
+        with RA scaled by cos(Dec) at the footprint's centre.
+        """
+        starts = self._starts()
+        n = self.n_vertices
+        # Index of the next vertex around each footprint's ring
+        nxt = np.arange(1, n + 1)
+        nxt[self.offsets[1:] - 1] = starts
+        scale = np.cos(np.radians(np.repeat(self.centers()[:, 1],
+                                            self.counts)))
+        x = self.vertices[:, 0] * scale
+        y = self.vertices[:, 1]
+        cross = x * y[nxt] - x[nxt] * y
+        area = 0.5 * np.add.reduceat(cross, starts)
+        cx = np.add.reduceat((x + x[nxt]) * cross, starts)
+        cy = np.add.reduceat((y + y[nxt]) * cross, starts)
+        return area, cx, cy, scale[starts]
+
+    def areas(self):
+        """Area of each footprint in square degrees, in the small-footprint
+        approximation (RA scaled by cos(Dec) at the footprint's centre).
+        """
+        if len(self) == 0:
+            return np.zeros(0)
+        return np.abs(self._shoelace()[0])
+
+    def centroids(self):
+        """``(n, 2)`` array of the RA, Dec area centroid of each footprint.
+        Degenerate (zero-area) footprints give their bounding box centre.
+        """
+        if len(self) == 0:
+            return np.zeros((0, 2))
+        area, cx, cy, scale = self._shoelace()
+        centroids = self.centers()
+        ok = area != 0.
+        centroids[ok, 0] = cx[ok] / (6. * area[ok]) / scale[ok]
+        centroids[ok, 1] = cy[ok] / (6. * area[ok])
+        return centroids
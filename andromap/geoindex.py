@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Server-side geospatial queries of the image log through 2dsphere indexes.
+
+:func:`build_geo_index` stores a GeoJSON copy of each document's polygon
+(``footprint`` in ``images``, ``radec_poly`` in ``footprints``) in a
+``<field>_geo`` field and indexes it. Queries given a ``region`` then become
+``$geoIntersects`` (or ``$geoWithin``) selectors, so only documents in the
+region are transferred.
+
+GeoJSON longitudes run from -180 to 180 degrees, so RAs above 180 degrees
+are stored as ``RA - 360``. Polygon edges are great circles, as they are for
+footprint vertices on the sky.
+"""
+
+import logging
+
+import numpy as np
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .connection import get_connection
+from .snapshot import POLY_KEYS
+
+
+def geo_key(poly_key):
+    """Name of the GeoJSON field mirroring the ``poly_key`` field."""
+    return poly_key + '_geo'
+
+
+def ra_to_longitude(ra):
+    """Convert RA (degrees) to GeoJSON longitude in [-180, 180]."""
+    lon = np.mod(ra, 360.)
+    return np.where(lon > 180., lon - 360., lon)
+
+
+def geojson_polygon(vertices):
+    """Make a GeoJSON Polygon from RA, Dec vertices (degrees).
+
+    The ring is closed and repeated consecutive vertices are dropped.
+    Returns ``None`` if fewer than three distinct vertices remain.
+    """
+    v = np.asarray(vertices, dtype=float).reshape(-1, 2)
+    ring = np.column_stack([ra_to_longitude(v[:, 0]), v[:, 1]])
+    keep = np.ones(len(ring), dtype=bool)
+    keep[1:] = np.any(ring[1:] != ring[:-1], axis=1)
+    ring = ring[keep]
+    if len(ring) > 1 and np.all(ring[0] == ring[-1]):
+        ring = ring[:-1]
+    if len(ring) < 3:
+        return None
+    ring = np.vstack([ring, ring[:1]])
+    return {'type': 'Polygon', 'coordinates': [ring.tolist()]}
+
+
+def box_region(ra_min, ra_max, dec_min, dec_max, n_edge=16):
+    """RA, Dec vertices of a box, with ``n_edge`` vertices along each edge so
+    that lines of constant Dec are followed closely.
+    """
+    t = np.linspace(0., 1., num=n_edge, endpoint=False)
+    ra = np.concatenate([ra_min + (ra_max - ra_min) * t,
+                         np.repeat(ra_max, n_edge),
+                         ra_max - (ra_max - ra_min) * t,
+                         np.repeat(ra_min, n_edge)])
+    dec = np.concatenate([np.repeat(dec_min, n_edge),
+                          dec_min + (dec_max - dec_min) * t,
+                          np.repeat(dec_max, n_edge),
+                          dec_max - (dec_max - dec_min) * t])
+    return np.column_stack([ra, dec])
+
+
+def cone_region(ra, dec, radius, n_verts=64):
+    """RA, Dec vertices of a polygon enclosing a cone of ``radius`` degrees.
+
+    The vertices lie on a slightly larger small circle so that the polygon's
+    edges do not cut into the cone.
+    """
+    r = np.radians(radius) / np.cos(np.pi / n_verts)
+    d0 = np.radians(dec)
+    bearing = np.linspace(0., 2. * np.pi, num=n_verts, endpoint=False)
+    d = np.arcsin(np.sin(d0) * np.cos(r)
+                  + np.cos(d0) * np.sin(r) * np.cos(bearing))
+    dra = np.arctan2(np.sin(bearing) * np.sin(r) * np.cos(d0),
+                     np.cos(r) - np.sin(d0) * np.sin(d))
+    return np.column_stack([ra + np.degrees(dra), np.degrees(d)])
+
+
+def region_selector(region, poly_key='footprint', within=False):
+    """Make a Mongo selector matching documents whose polygon intersects
+    (or, if ``within``, lies inside) a region.
+
+    Parameters
+    ----------
+    region : ndarray
+        RA, Dec vertices of the region, e.g. from :func:`box_region` or
+        :func:`cone_region`.
+    poly_key : str
+        Document field holding the polygon vertices.
+    within : bool
+        Use ``$geoWithin`` rather than ``$geoIntersects``.
+    """
+    geometry = geojson_polygon(region)
+    if geometry is None:
+        raise ValueError("A region needs at least three distinct vertices")
+    op = '$geoWithin' if within else '$geoIntersects'
+    return {geo_key(poly_key): {op: {'$geometry': geometry}}}
+
+
+def build_geo_index(kinds=('images', 'footprints'), batch_size=1000):
+    """Store GeoJSON polygons in the image log and build 2dsphere indexes.
+
+    The index is created first so that documents with invalid polygons
+    (e.g. self-intersecting ones) are rejected individually rather than
+    failing the index build. Re-running the routine refreshes every
+    document.
+
+    Parameters
+    ----------
+    kinds : list
+        Collection roles to index (see :mod:`andromap.connection`).
+    batch_size : int
+        Number of updates sent per bulk write.
+
+    Returns
+    -------
+    counts : dict
+        Dictionary of collection roles mapping to the number of documents
+        ``converted``, ``skipped`` (degenerate polygons) and ``rejected`` by
+        the server.
+    """
+    log = logging.getLogger('andromap')
+    conn = get_connection()
+    counts = {}
+    for kind in kinds:
+        poly_key = POLY_KEYS[kind]
+        geo = geo_key(poly_key)
+        c = conn.collection(kind)
+        c.create_index([(geo, '2dsphere')])
+        n = {'converted': 0, 'skipped': 0, 'rejected': 0}
+        ops = []
+        docs = c.find({poly_key: {'$exists': True}}, projection=[poly_key])
+        for doc in docs:
+            geometry = geojson_polygon(doc[poly_key])
+            if geometry is None:
+                n['skipped'] += 1
+                continue
+            ops.append(UpdateOne({'_id': doc['_id']},
+                                 {'$set': {geo: geometry}}))
+            if len(ops) == batch_size:
+                _write(c, ops, n, log)
+                ops = []
+        if ops:
+            _write(c, ops, n, log)
+        log.info("Indexed %s.%s: %i converted, %i skipped, %i rejected"
+                 % (kind, geo, n['converted'], n['skipped'], n['rejected']))
+        counts[kind] = n
+    return counts
+
+
+def _write(c, ops, n, log):
+    try:
+        c.bulk_write(ops, ordered=False)
+        n['converted'] += len(ops)
+    except BulkWriteError as e:
+        errors = e.details['writeErrors']
+        for error in errors:
+            log.warning("Rejected polygon of %s: %s"
+                        % (error['op']['q']['_id'], error['errmsg']))
+        n['rejected'] += len(errors)
+        n['converted'] += len(ops) - len(errors)
@@ -8,35 +8,374 @@ Get footprints from the image log
 
 import logging
 
-from pymongo import MongoClient
 import numpy as np
 
-from .polytools import close_vertices, polygon_union
+from .connection import get_connection
+from .footprintcache import cached_query, invalidate
+from .geoindex import region_selector
+from .indexadvisor import record_selector
+from .polytools import close_vertices, polygon_union, stream_union, \
+    exterior_vertices
+from .footprintset import FootprintSet
+from .rawbson import VertexBuffer, decode_vertex_batch
 
 
-def get_image_footprints(sel):
+# Documents requested per server round trip. Footprint documents are small,
+# so large batches keep the number of getMore calls down.
+BATCH_SIZE = 5000
+# Footprints held at once when streaming a union from the cursor.
+STREAM_CHUNK_SIZE = 1000
+
+
+class MongoBackend(object):
+    """Image log backend that queries MongoDB through the shared connection
+    of :mod:`andromap.connection`.
+
+    Parameters
+    ----------
+    batch_size : int
+        Number of documents per cursor batch.
+    """
+    def __init__(self, batch_size=BATCH_SIZE):
+        super(MongoBackend, self).__init__()
+        self.batch_size = batch_size
+
+    def fetch_polygons(self, kind, sel, poly_key='footprint',
+                       name_key='_id', group_by=None, region=None,
+                       within=False):
+        """Stream polygons from the image log in a single pass over the
+        cursor.
+
+        Each raw BSON batch is decoded straight into one float64 vertex
+        buffer, which is normalized in bulk (see
+        :func:`andromap.footprintset.normalize_rings`). A ``region``
+        is pushed down to the server as a geospatial selector (see
+        :mod:`andromap.geoindex`). See :func:`fetch_polygons` for the
+        parameters.
+        """
+        log = logging.getLogger('andromap')
+        c = get_connection().collection(kind)
+        sel = self._selector(kind, sel, poly_key, region, within)
+        key_fields = [name_key]
+        if group_by is not None:
+            key_fields.append(group_by)
+        projection = dict((k, True) for k in key_fields + [poly_key])
+        buf = VertexBuffer()
+        keys = []
+        counts = []
+        for batch in c.find_raw_batches(sel, projection=projection,
+                                        batch_size=self.batch_size):
+            k, n = decode_vertex_batch(batch, poly_key, key_fields, buf,
+                                       close=False)
+            keys.extend(k)
+            counts.extend(n)
+        log.debug("Found %i footprints" % len(keys))
+        buf.compact()
+        offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+        np.cumsum(counts, out=offsets[1:])
+        footprints = FootprintSet(buf.vertices, offsets,
+                                  [k[0] for k in keys]).normalize()
+        if group_by is None:
+            return footprints
+        return footprints.groupby([k[1] for k in keys])
+
+    def _selector(self, kind, sel, poly_key, region, within):
+        """Add the region to a selector, and log and record it."""
+        if region is not None:
+            sel = dict(sel)
+            sel.update(region_selector(region, poly_key=poly_key,
+                                       within=within))
+        logging.getLogger('andromap').debug(
+            "Looking for footprints from %s" % str(sel))
+        record_selector(kind, sel)
+        return sel
+
+    def iter_polygons(self, kind, sel, poly_key='footprint', name_key='_id',
+                      chunk_size=STREAM_CHUNK_SIZE, region=None,
+                      within=False):
+        """Iterate over polygons in chunks of at most ``chunk_size``.
+
+        Each cursor batch holds ``chunk_size`` documents and is decoded into
+        its own vertex buffer, so only one chunk is held at a time. See
+        :func:`iter_polygons`.
+        """
+        c = get_connection().collection(kind)
+        sel = self._selector(kind, sel, poly_key, region, within)
+        projection = {name_key: True, poly_key: True}
+        batches = c.find_raw_batches(sel, projection=projection,
+                                     batch_size=chunk_size)
+        for chunk in decode_polygon_chunks(batches, poly_key=poly_key,
+                                           name_key=name_key):
+            yield chunk
+
+    def field_centers(self, sel, group_by=None, poly_key='footprint'):
+        """Aggregate footprint centres and bounding boxes on the server.
+
+        A single aggregation pipeline computes the bounding box of every
+        matching footprint and reduces them per group, so no vertex arrays
+        are transferred. See :func:`get_field_centers`.
+        """
+        log = logging.getLogger('andromap')
+        c = get_connection().collection('images')
+        if group_by is None:
+            group = {'$literal': None}
+        else:
+            group = '$' + group_by
+        poly = '$' + poly_key
+
+        def coord(i):
+            return {'$map': {'input': poly, 'as': 'v',
+                             'in': {'$arrayElemAt': ['$$v', i]}}}
+
+        def center(lo, hi):
+            return {'$avg': {'$multiply': [0.5, {'$add': [lo, hi]}]}}
+
+        pipeline = [
+            {'$match': sel},
+            {'$match': {poly_key: {'$exists': True}}},
+            {'$project': {'group': group, 'x': coord(0), 'y': coord(1)}},
+            {'$project': {'group': True,
+                          'xmin': {'$min': '$x'}, 'xmax': {'$max': '$x'},
+                          'ymin': {'$min': '$y'}, 'ymax': {'$max': '$y'}}},
+            {'$group': {'_id': '$group',
+                        'ra': center('$xmin', '$xmax'),
+                        'dec': center('$ymin', '$ymax'),
+                        'ra_min': {'$min': '$xmin'},
+                        'ra_max': {'$max': '$xmax'},
+                        'dec_min': {'$min': '$ymin'},
+                        'dec_max': {'$max': '$ymax'},
+                        'count': {'$sum': 1}}}]
+        log.debug("Aggregating field centers from %s" % str(sel))
+        record_selector('images', sel)
+        centers = {}
+        for d in c.aggregate(pipeline):
+            centers[d.pop('_id')] = d
+        log.debug("Found %i field centers" % len(centers))
+        return centers
+
+
+def decode_polygon_chunks(batches, poly_key='footprint', name_key='_id'):
+    """Decode raw BSON batches one at a time.
+
+    Yields a normalized :class:`andromap.footprintset.FootprintSet` per
+    batch. Each batch gets its own vertex buffer, which is released once the
+    caller drops the chunk.
+    """
+    for batch in batches:
+        buf = VertexBuffer()
+        keys, counts = decode_vertex_batch(batch, poly_key, [name_key], buf,
+                                           close=False)
+        offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+        np.cumsum(counts, out=offsets[1:])
+        yield FootprintSet(buf.vertices, offsets,
+                           [k[0] for k in keys]).normalize()
+
+
+_backend = MongoBackend()
+
+
+def get_backend():
+    """Get the backend that image log queries are answered by."""
+    return _backend
+
+
+def use_backend(backend):
+    """Answer image log queries with ``backend``, e.g. a
+    :class:`andromap.snapshot.SnapshotBackend`, or a :class:`MongoBackend`
+    to go back to the database. Cached query results are dropped.
+
+    Returns the previous backend.
+    """
+    global _backend
+    previous = _backend
+    _backend = backend
+    invalidate()
+    return previous
+
+
+def fetch_polygons(kind, sel, poly_key='footprint', name_key='_id',
+                   group_by=None, region=None, within=False):
+    """Fetch polygons from the image log through the current backend.
+
+    Parameters
+    ----------
+    kind : str
+        Collection role, ``'images'`` or ``'footprints'``.
+    sel : dict
+        Mongo selector.
+    poly_key : str
+        Document field holding the polygon vertices.
+    name_key : str
+        Document field used to name each polygon.
+    group_by : str
+        Optional (possibly dotted) document field to group polygons by.
+    region : ndarray
+        Optional RA, Dec vertices of a region (see
+        :func:`andromap.geoindex.box_region` and
+        :func:`andromap.geoindex.cone_region`); only polygons intersecting
+        it are fetched. With MongoDB this needs the 2dsphere indexes of
+        :func:`andromap.geoindex.build_geo_index`.
+    within : bool
+        Only fetch polygons lying inside ``region``.
+
+    Returns
+    -------
+    polygons : :class:`andromap.footprintset.FootprintSet`
+        Closed, counter-clockwise Nx2 vertex arrays without repeated
+        vertices, by name (see
+        :func:`andromap.footprintset.normalize_rings`). If ``group_by`` is
+        set, a dictionary of group values mapping to FootprintSets.
+    """
+    return _backend.fetch_polygons(kind, sel, poly_key=poly_key,
+                                   name_key=name_key, group_by=group_by,
+                                   region=region, within=within)
+
+
+def iter_polygons(kind, sel, poly_key='footprint', name_key='_id',
+                  chunk_size=STREAM_CHUNK_SIZE, region=None, within=False):
+    """Iterate over polygons from the image log in chunks, through the
+    current backend, without holding the whole selection.
+
+    Parameters
+    ----------
+    chunk_size : int
+        Maximum number of polygons per chunk.
+
+    See :func:`fetch_polygons` for the other parameters.
+
+    Yields
+    ------
+    chunk : :class:`andromap.footprintset.FootprintSet`
+        Normalized Nx2 vertex arrays by name, as :func:`fetch_polygons`
+        returns.
+    """
+    return _backend.iter_polygons(kind, sel, poly_key=poly_key,
+                                  name_key=name_key, chunk_size=chunk_size,
+                                  region=region, within=within)
+
+
+def fetch_polygons_legacy(kind, sel, poly_key='footprint', name_key='_id'):
+    """Fetch polygons by decoding full documents into Python objects.
+
+    This is the original query path, kept as a reference for
+    :func:`fetch_polygons` in benchmarks.
+    """
+    c = get_connection().collection(kind)
+    docs = c.find(sel, projection=[poly_key, name_key])
+    return {d[name_key]: close_vertices(d[poly_key]) for d in docs}
+
+
+@cached_query
+def get_image_footprints(sel, region=None, within=False):
     """Get image footprints.
+
+    Parameters
+    ----------
+    sel : dict
+        Mongo selector.
+    region : ndarray
+        Optional RA, Dec vertices of a region that footprints must intersect
+        (or lie within, if ``within``). The test is done by the server; see
+        :mod:`andromap.geoindex`.
     
     Returns
     -------
-    footprints : dict
-        Dictionary of names mapping to footprints (as numpy vertex arrays).
+    footprints : :class:`andromap.footprintset.FootprintSet`
+        Footprints by name (it behaves as a dictionary of names mapping to
+        numpy vertex arrays), or ``None`` if nothing matched. Results are
+        cached (see :mod:`andromap.footprintcache`) and the
+        vertex arrays are read-only.
     """
-    log = logging.getLogger('andromap')
-    client = MongoClient(host='localhost', port=27017)
-    c = client.m31.images
-    docs = c.find(sel, projection=['footprint'])
-    log.debug("Looking for footprints from %s" % str(sel))
-    log.debug("Found %i footprints" % docs.count())
-    if docs.count() == 0:
+    footprints = fetch_polygons('images', sel, region=region, within=within)
+    if len(footprints) == 0:
         return None
-    footprints = {d['_id']: np.array(close_vertices(d['footprint']))
-        for d in docs}
     return footprints
 
 
-def get_combined_image_footprint(sel):
+@cached_query
+def get_grouped_image_footprints(base_sel, group_by='OBJECT', values=None):
+    """Get image footprints for several groups (e.g. fields) in one query.
+
+    Parameters
+    ----------
+    base_sel : dict
+        Mongo selector shared by all groups.
+    group_by : str
+        Document field that the footprints are grouped by.
+    values : list
+        Values of ``group_by`` to select. If ``None``, every group matching
+        ``base_sel`` is returned.
+
+    Returns
+    -------
+    groups : dict
+        Dictionary of group values mapping to FootprintSets. Groups without
+        footprints are absent.
+    """
+    sel = dict(base_sel)
+    if values is not None:
+        sel[group_by] = {"$in": list(values)}
+    return fetch_polygons('images', sel, group_by=group_by)
+
+
+def get_combined_image_footprints(base_sel, group_by='OBJECT', values=None):
+    """Get the union of image footprints of each group (e.g. field) from a
+    single query.
+
+    See :func:`get_grouped_image_footprints` for the parameters.
+
+    Returns
+    -------
+    unions : dict
+        Dictionary of group values mapping to lists of one or more Nx2 numpy
+        arrays of the vertices of the group's union.
+    """
+    groups = get_grouped_image_footprints(base_sel, group_by=group_by,
+                                          values=values)
+    return {value: polygon_union(list(footprints.values()))
+            for value, footprints in groups.items()}
+
+
+@cached_query
+def get_field_centers(sel, group_by=None, poly_key='footprint'):
+    """Get the centres and bounding boxes of groups of image footprints.
+
+    With the :class:`MongoBackend` a single aggregation pipeline computes
+    the bounding box of every matching footprint on the server and reduces
+    them per group, so no vertex arrays are transferred.
+
+    Parameters
+    ----------
+    sel : dict
+        Mongo selector.
+    group_by : str
+        Document field to group by, e.g. ``'OBJECT'``, or ``'_id'`` for one
+        group per image. If ``None``, all matching footprints form a single
+        group keyed by ``None``.
+    poly_key : str
+        Document field holding the footprint vertices.
+
+    Returns
+    -------
+    centers : dict
+        Dictionary of group values mapping to dictionaries with the mean of
+        the footprints' bounding box centres (``ra``, ``dec``), the bounding
+        box of the whole group (``ra_min``, ``ra_max``, ``dec_min``,
+        ``dec_max``) and the number of footprints (``count``).
+    """
+    return _backend.field_centers(sel, group_by=group_by, poly_key=poly_key)
+
+
+def get_combined_image_footprint(sel, processes=1):
     """Get image footprints and combine them.
+
+    Parameters
+    ----------
+    sel : dict
+        Mongo selector.
+    processes : int
+        Number of processes computing the union (see
+        :func:`andromap.polytools.parallel_union`).
     
     Returns
     -------
@@ -45,34 +384,45 @@ def get_combined_image_footprint(sel):
         positions of the vertices in world coordinates.
     """
     footprints = get_image_footprints(sel)
-    polygons = [footprint for k, footprint in footprints.iteritems()]
-    return polygon_union(polygons)
+    return polygon_union(footprints, processes=processes)
+
+
+def stream_combined_image_footprint(sel, chunk_size=STREAM_CHUNK_SIZE):
+    """Combine image footprints while streaming them from the image log.
+
+    Footprints are read in chunks of ``chunk_size``, and each chunk is
+    folded into a running union, so at most one chunk of raw footprints is
+    held at a time. Results are not cached.
+
+    Returns
+    -------
+    verts : list
+        A list of one or more Nx2 Numpy arrays which contain the [x, y]
+        positions of the vertices in world coordinates, as
+        :func:`get_combined_image_footprint` returns.
+    """
+    chunks = iter_polygons('images', sel, chunk_size=chunk_size)
+    return exterior_vertices(stream_union(
+        list(chunk.values()) for chunk in chunks))
 
 
+@cached_query
 def get_phat_bricks(bricks=None):
     """Get polygons for PHAT bricks.
     
     Returns
     -------
-    fields : dict
-        Dictionary of {field number : polygon vertices}.
+    fields : :class:`andromap.footprintset.FootprintSet`
+        Polygon vertices by field number.
     bricks : list
         List of PHAT brick numbers (1 -- 23).
     """
-    log = logging.getLogger('andromap')
     sel = {"kind": "ph2", "instrument": "PHAT"}
     if bricks is not None:
         fieldsel = {str(n): {"$exists": 1} for n in bricks}
         sel.update(fieldsel)
-    client = MongoClient(host='localhost', port=27017)
-    c = client.m31.footprints
-    docs = c.find(sel)
-    log.debug("Looking for footprints from %s" % str(sel))
-    log.debug("Found %i footprints" % docs.count())
-    polygons = {}
-    for d in docs:
-        polygons[d['field']] = np.array(close_vertices(d['radec_poly']))
-    return polygons
+    return fetch_polygons('footprints', sel, poly_key='radec_poly',
+                          name_key='field')
 
 
 def get_combined_phat_bricks(bricks=None):
@@ -84,27 +434,18 @@ def get_combined_phat_bricks(bricks=None):
         A list of one or more Nx2 Numpy arrays which contain the [x, y]
         positions of the vertices in world coordinates.
     """
-    polys = get_phat_bricks(bricks=bricks)
-    polylist = [p for name, p in polys.iteritems()]
-    return polygon_union(polylist)
+    return polygon_union(get_phat_bricks(bricks=bricks))
 
 
+@cached_query
 def get_acs_halo_fields():
     """Get polygons for the Brown et al HST halo fields.
 
     Returns
     -------
-    fields : dict
-        Dictionary of {field number : polygon vertices}.
+    fields : :class:`andromap.footprintset.FootprintSet`
+        Polygon vertices by field number.
     """
-    log = logging.getLogger('andromap')
     sel = {"survey": "brown"}
-    client = MongoClient(host='localhost', port=27017)
-    c = client.m31.images
-    docs = c.find(sel)
-    log.debug("Looking for footprints from %s" % str(sel))
-    log.debug("Found %i footprints" % docs.count())
-    polygons = {}
-    for d in docs:
-        polygons[d['field']] = np.array(close_vertices(d['footprint']))
-    return polygons
+    return fetch_polygons('images', sel, poly_key='footprint',
+                          name_key='field')
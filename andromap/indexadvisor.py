@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Query-plan reports and compound index advice for image log selectors.
+
+Every selector that :mod:`andromap.imagelogfootprints` sends to MongoDB is
+recorded. :func:`explain_selector` runs ``explain()`` on a selector and
+summarizes the winning plan (``COLLSCAN`` or the index used) with the
+documents examined versus returned; :func:`recommend_indexes` derives
+compound indexes from the recorded selectors following the
+equality-sort-range rule: fields matched by equality or ``$in`` lead the key,
+range-matched fields follow. :func:`index_report` ties these together::
+
+    ... render maps ...
+    print(format_report(index_report(create=True)))
+"""
+
+import json
+import logging
+import threading
+
+from .connection import get_connection
+from .footprintcache import canonical_selector
+
+
+# Operators that select a range of index keys
+RANGE_OPERATORS = ('$gt', '$gte', '$lt', '$lte')
+# Operators that an index can answer as (a union of) point lookups
+EQUALITY_OPERATORS = ('$eq', '$in')
+
+
+class SelectorLog(object):
+    """Thread-safe record of the distinct selectors issued per collection,
+    with how often each was issued.
+    """
+    def __init__(self):
+        super(SelectorLog, self).__init__()
+        self._entries = {}  # key: [kind, sel, count]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, kind, sel):
+        """Record that ``sel`` was issued against the ``kind`` collection."""
+        key = (kind, canonical_selector(sel))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = [kind, sel, 1]
+            else:
+                entry[2] += 1
+
+    def entries(self):
+        """List of ``(kind, selector, count)``, most frequent first."""
+        with self._lock:
+            entries = [tuple(e) for e in self._entries.values()]
+        return sorted(entries, key=lambda e: -e[2])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def save(self, path):
+        """Write the recorded selectors to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump([{'kind': k, 'selector': s, 'count': n}
+                       for k, s, n in self.entries()], f, indent=2)
+
+    def load(self, path):
+        """Add the selectors of a JSON file written by :meth:`save`."""
+        with open(path) as f:
+            for e in json.load(f):
+                for i in range(e.get('count', 1)):
+                    self.record(e['kind'], e['selector'])
+
+
+_selector_log = SelectorLog()
+
+
+def get_selector_log():
+    """Get the module-level :class:`SelectorLog`."""
+    return _selector_log
+
+
+def record_selector(kind, sel):
+    """Record a selector issued against the ``kind`` collection."""
+    _selector_log.record(kind, sel)
+
+
+def _plan_stages(plan):
+    """Yield every stage of an explain() plan tree."""
+    if not isinstance(plan, dict):
+        return
+    if 'queryPlan' in plan:  # slot-based execution engine
+        plan = plan['queryPlan']
+    yield plan
+    children = list(plan.get('inputStages', []))
+    if 'inputStage' in plan:
+        children.append(plan['inputStage'])
+    for child in children:
+        for stage in _plan_stages(child):
+            yield stage
+
+
+def explain_selector(kind, sel):
+    """Explain a selector and summarize its winning plan.
+
+    Returns
+    -------
+    summary : dict
+        With ``stage`` (``'COLLSCAN'``, ``'IXSCAN'`` or the winning stage),
+        ``index`` (name of the index used, or ``None``), ``docs_examined``,
+        ``keys_examined``, ``returned`` and ``millis``.
+    """
+    c = get_connection().collection(kind)
+    explain = c.find(sel).explain()
+    stages = list(_plan_stages(explain['queryPlanner']['winningPlan']))
+    names = [s.get('stage') for s in stages]
+    index = None
+    for s in stages:
+        if s.get('stage') == 'IXSCAN':
+            index = s.get('indexName')
+            break
+    if 'COLLSCAN' in names:
+        stage = 'COLLSCAN'
+    elif index is not None:
+        stage = 'IXSCAN'
+    else:
+        stage = names[0] if names else None
+    stats = explain.get('executionStats', {})
+    return {'stage': stage, 'index': index,
+            'docs_examined': stats.get('totalDocsExamined'),
+            'keys_examined': stats.get('totalKeysExamined'),
+            'returned': stats.get('nReturned'),
+            'millis': stats.get('executionTimeMillis')}
+
+
+def _field_conditions(sel):
+    """Yield ``(field, condition)`` for the ANDed conditions of a selector.
+    Branches of ``$or`` and ``$nor`` are left out.
+    """
+    for name, cond in sel.items():
+        if name == '$and':
+            for s in cond:
+                for item in _field_conditions(s):
+                    yield item
+        elif not name.startswith('$'):
+            yield name, cond
+
+
+def _classify(cond):
+    """Classify a field condition as ``'equality'``, ``'range'`` or ``None``
+    (not selective enough, or not answerable by an ascending index).
+    """
+    if not (isinstance(cond, dict) and cond
+            and all(k.startswith('$') for k in cond)):
+        return 'equality'
+    ops = set(cond.keys())
+    if ops & set(EQUALITY_OPERATORS):
+        return 'equality'
+    if ops & set(RANGE_OPERATORS):
+        return 'range'
+    return None
+
+
+def index_fields(sel):
+    """Compound index fields for a selector, as ``(equality, range)`` lists
+    of field names sorted by name. ``$exists``, ``$ne``, ``$nin`` and
+    geospatial conditions are left to the other fields.
+    """
+    equality = set()
+    ranges = set()
+    for name, cond in _field_conditions(sel):
+        kind = _classify(cond)
+        if kind == 'equality':
+            equality.add(name)
+        elif kind == 'range':
+            ranges.add(name)
+    return sorted(equality), sorted(ranges - equality)
+
+
+def recommend_indexes(entries):
+    """Recommend compound indexes for recorded selectors.
+
+    Equality fields are ordered by how many selectors use them (then by
+    name) so that indexes share prefixes; a recommendation that is a prefix
+    of another for the same collection is dropped.
+
+    Parameters
+    ----------
+    entries : list
+        List of ``(kind, selector, count)``, e.g. from
+        :meth:`SelectorLog.entries`.
+
+    Returns
+    -------
+    recommendations : dict
+        Dictionary of collection roles mapping to lists of index keys,
+        each a list of ``(field, 1)``.
+    """
+    usage = {}
+    fields = []
+    for kind, sel, count in entries:
+        equality, ranges = index_fields(sel)
+        fields.append((kind, equality, ranges))
+        for name in equality:
+            usage[(kind, name)] = usage.get((kind, name), 0) + count
+    keys = {}
+    for kind, equality, ranges in fields:
+        if not equality and not ranges:
+            continue
+        equality = sorted(equality, key=lambda n: (-usage[(kind, n)], n))
+        key = tuple(equality + ranges)
+        if key not in keys.setdefault(kind, []):
+            keys[kind].append(key)
+    recommendations = {}
+    for kind, kind_keys in keys.items():
+        kept = [k for k in kind_keys
+                if not any(len(o) > len(k) and o[:len(k)] == k
+                           for o in kind_keys)]
+        recommendations[kind] = [[(name, 1) for name in k] for k in kept]
+    return recommendations
+
+
+def _is_covered(key, existing):
+    """Whether an existing index key starts with the fields of ``key``."""
+    fields = [name for name, direction in key]
+    for index_key in existing:
+        prefix = [name for name, direction in index_key[:len(fields)]]
+        if prefix == fields:
+            return True
+    return False
+
+
+def index_report(entries=None, create=False):
+    """Explain recorded selectors and recommend (or create) indexes.
+
+    Parameters
+    ----------
+    entries : list
+        List of ``(kind, selector, count)``. Defaults to the selectors
+        recorded so far in this process.
+    create : bool
+        Create the recommended indexes that do not exist yet, then explain
+        the selectors again.
+
+    Returns
+    -------
+    report : dict
+        With ``queries``, a list of dictionaries holding the ``kind``,
+        ``selector`` and ``count`` of each selector and its explain summary
+        (see :func:`explain_selector`) under ``before`` (and ``after`` if
+        indexes were created), and ``indexes``, a list of dictionaries with
+        the ``kind``, recommended ``key`` and whether it already ``exists``
+        or was ``created``.
+    """
+    log = logging.getLogger('andromap')
+    if entries is None:
+        entries = _selector_log.entries()
+    conn = get_connection()
+    queries = [{'kind': kind, 'selector': sel, 'count': count,
+                'before': explain_selector(kind, sel)}
+               for kind, sel, count in entries]
+    indexes = []
+    for kind, keys in sorted(recommend_indexes(entries).items()):
+        c = conn.collection(kind)
+        existing = [info['key'] for info in c.index_information().values()]
+        for key in keys:
+            exists = _is_covered(key, existing)
+            created = False
+            if create and not exists:
+                log.info("Creating index %s on %s" % (key, kind))
+                c.create_index(key)
+                created = True
+            indexes.append({'kind': kind, 'key': key, 'exists': exists,
+                            'created': created})
+    if any(i['created'] for i in indexes):
+        for q in queries:
+            q['after'] = explain_selector(q['kind'], q['selector'])
+    return {'queries': queries, 'indexes': indexes}
+
+
+def _format_plan(plan):
+    if plan['index'] is not None:
+        stage = 'IXSCAN %s' % plan['index']
+    else:
+        stage = plan['stage']
+    return "%s: %s docs examined, %s returned, %s ms" % (
+        stage, plan['docs_examined'], plan['returned'], plan['millis'])
+
+
+def format_report(report):
+    """Format a report from :func:`index_report` as text."""
+    lines = []
+    n_scans = sum(1 for q in report['queries']
+                  if q['before']['stage'] == 'COLLSCAN')
+    lines.append("%i selectors, %i collection scans"
+                 % (len(report['queries']), n_scans))
+    for q in report['queries']:
+        lines.append("")
+        lines.append("%s x%i %s" % (q['kind'], q['count'],
+                                    json.dumps(q['selector'],
+                                               sort_keys=True)))
+        lines.append("  before: " + _format_plan(q['before']))
+        if 'after' in q:
+            lines.append("  after:  " + _format_plan(q['after']))
+    lines.append("")
+    lines.append("Recommended indexes:")
+    for i in report['indexes']:
+        if i['created']:
+            status = 'created'
+        elif i['exists']:
+            status = 'exists'
+        else:
+            status = 'missing'
+        key = ", ".join(name for name, direction in i['key'])
+        lines.append("  %-10s %-8s (%s)" % (i['kind'], status, key))
+    return "\n".join(lines)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Boolean algebra and areas of survey layers.
+
+A :class:`Layer` is the union of a set of footprints, held as its isolated
+polygonal parts in an STRtree. Intersections and differences between
+layers only compare parts whose bounding boxes overlap, and parts are
+tested against each other as prepared geometries before any overlay is
+computed, so layers of thousands of footprints combine quickly::
+
+    megacam = image_layer({"INSTRUME": "MegaPrime"})
+    uncovered = megacam - phat_layer()
+    print(uncovered.area(), uncovered.area_kpc2())
+    m.plot_layer(uncovered, edgecolor='r')
+
+Areas are measured in the plane tangent at M31, in square degrees and in
+square kiloparsecs at the distance of M31.
+"""
+
+import numpy as np
+from shapely.geometry import Polygon, MultiPolygon
+from shapely.ops import transform, unary_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from .constants import D_KPC, M31RA0, M31DEC0
+from .footprintset import FootprintSet
+from .imagelogfootprints import get_image_footprints, get_phat_bricks
+from .polytools import parallel_union
+from .tanproj import eq_to_tan
+
+
+def _polygon_parts(geometry):
+    """List the polygons of a (multi)polygon or geometry collection, leaving
+    out points and lines left over from overlays.
+    """
+    if geometry.is_empty:
+        return []
+    if geometry.geom_type == 'Polygon':
+        return [geometry]
+    if hasattr(geometry, 'geoms'):
+        parts = []
+        for g in geometry.geoms:
+            parts.extend(_polygon_parts(g))
+        return parts
+    return []
+
+
+class Layer(object):
+    """A region of the sky, with RA, Dec vertices.
+
+    Parameters
+    ----------
+    geometry : shapely geometry
+        The region, e.g. a union of footprints. Only its polygons are kept.
+    """
+    def __init__(self, geometry=None):
+        super(Layer, self).__init__()
+        if geometry is None:
+            geometry = Polygon()
+        self.parts = _polygon_parts(geometry)
+        self._tree = None
+        self._prepared = None
+
+    @classmethod
+    def from_polygons(cls, polygons, processes=1):
+        """Make a layer from the union of Nx2 vertex arrays, a dictionary of
+        them or a :class:`andromap.footprintset.FootprintSet`.
+
+        With ``processes`` greater than one, the union is computed by
+        :func:`andromap.polytools.parallel_union`.
+        """
+        if isinstance(polygons, dict):
+            polygons = list(polygons.values())
+        elif isinstance(polygons, FootprintSet):
+            polygons = polygons.polygons()
+        if processes is None or processes > 1:
+            return cls(parallel_union(polygons, processes=processes))
+        shapes = []
+        for p in polygons:
+            poly = Polygon(p)
+            if not poly.is_valid:
+                poly = poly.buffer(0)
+            shapes.append(poly)
+        return cls(unary_union(shapes))
+
+    @classmethod
+    def _from_parts(cls, geometries):
+        """Make a layer from geometries whose polygons do not overlap, such
+        as pieces cut from the disjoint parts of a layer.
+        """
+        layer = cls()
+        for g in geometries:
+            layer.parts.extend(_polygon_parts(g))
+        return layer
+
+    def __len__(self):
+        return len(self.parts)
+
+    def __repr__(self):
+        return "<Layer of %i parts, %.3f deg2>" % (len(self), self.area())
+
+    @property
+    def geometry(self):
+        """The layer as a shapely (multi)polygon."""
+        if len(self.parts) == 1:
+            return self.parts[0]
+        return MultiPolygon(self.parts)
+
+    @property
+    def is_empty(self):
+        return len(self.parts) == 0
+
+    def _build(self):
+        """Make the STRtree and prepared geometries of the parts."""
+        if self._tree is None and self.parts:
+            self._tree = STRtree(self.parts)
+            self._prepared = [prep(p) for p in self.parts]
+
+    def _candidates(self, geometry):
+        """Indices of parts whose bounding boxes intersect ``geometry``."""
+        self._build()
+        if not self.parts:
+            return []
+        hits = self._tree.query(geometry)
+        if isinstance(hits, np.ndarray) and hits.dtype.kind in 'iu':
+            return hits.tolist()
+        index = dict((id(p), i) for i, p in enumerate(self.parts))
+        return [index[id(p)] for p in hits]
+
+    def _pairs(self, other):
+        """Dictionary of the indices of this layer's parts that intersect
+        parts of ``other`` mapping to the indices of those parts.
+
+        The tree of the larger layer is queried with the parts of the
+        smaller one, so parts far from the other layer cost nothing.
+        """
+        pairs = {}
+        if self.is_empty or other.is_empty:
+            return pairs
+        self._build()
+        other._build()
+        if len(self) <= len(other):
+            for i, part in enumerate(self.parts):
+                for j in other._candidates(part):
+                    if other._prepared[j].intersects(part):
+                        pairs.setdefault(i, []).append(j)
+        else:
+            for j, part in enumerate(other.parts):
+                for i in self._candidates(part):
+                    if self._prepared[i].intersects(part):
+                        pairs.setdefault(i, []).append(j)
+        return pairs
+
+    def intersection(self, other):
+        """The region covered by both layers."""
+        pieces = []
+        for i, js in self._pairs(other).items():
+            part = self.parts[i]
+            # Parts of a layer are disjoint, so the intersections of this
+            # part with each of the other layer's parts are too
+            for j in js:
+                if other._prepared[j].contains(part):
+                    pieces.append(part)
+                elif self._prepared[i].contains(other.parts[j]):
+                    pieces.append(other.parts[j])
+                else:
+                    pieces.append(part.intersection(other.parts[j]))
+        return Layer._from_parts(pieces)
+
+    def difference(self, other):
+        """The region covered by this layer but not by ``other``."""
+        return self._difference(other, self._pairs(other))
+
+    def _difference(self, other, pairs):
+        pieces = []
+        for i, part in enumerate(self.parts):
+            js = pairs.get(i)
+            if js is None:
+                pieces.append(part)
+            elif any(other._prepared[j].contains(part) for j in js):
+                continue
+            elif len(js) == 1:
+                pieces.append(part.difference(other.parts[js[0]]))
+            else:
+                pieces.append(part.difference(
+                    MultiPolygon([other.parts[j] for j in js])))
+        return Layer._from_parts(pieces)
+
+    def symmetric_difference(self, other):
+        """The region covered by exactly one of the layers."""
+        pairs = self._pairs(other)
+        inverse = {}
+        for i, js in pairs.items():
+            for j in js:
+                inverse.setdefault(j, []).append(i)
+        return Layer._from_parts(self._difference(other, pairs).parts
+                                 + other._difference(self, inverse).parts)
+
+    def union(self, other):
+        """The region covered by either layer."""
+        return Layer(unary_union(self.parts + other.parts))
+
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
+    __or__ = union
+
+    def area(self, ra0=M31RA0, dec0=M31DEC0):
+        """Area in square degrees, measured in the plane tangent at ``ra0``,
+        ``dec0``.
+        """
+        if self.is_empty:
+            return 0.
+        projected = transform(lambda ra, dec: eq_to_tan(ra, dec, ra0=ra0,
+                                                         dec0=dec0),
+                              self.geometry)
+        return projected.area
+
+    def area_kpc2(self):
+        """Projected area in square kiloparsecs at the distance of M31."""
+        kpc_per_deg = D_KPC * np.pi / 180.
+        return self.area() * kpc_per_deg ** 2
+
+    def polygons(self, holes=True):
+        """List the vertices of the exterior (and, with ``holes``, interior)
+        rings of every part as Nx2 numpy arrays.
+        """
+        rings = []
+        for part in self.parts:
+            rings.append(np.array(part.exterior.coords))
+            if holes:
+                rings.extend(np.array(r.coords) for r in part.interiors)
+        return rings
+
+
+def image_layer(sel, processes=1):
+    """Layer covered by the image log footprints matching a selector."""
+    footprints = get_image_footprints(sel)
+    if footprints is None:
+        return Layer()
+    return Layer.from_polygons(footprints, processes=processes)
+
+
+def phat_layer(bricks=None):
+    """Layer covered by PHAT bricks (all bricks by default)."""
+    return Layer.from_polygons(get_phat_bricks(bricks))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Level-of-detail simplification of polygons for rendering.
+
+Unions of many footprints and finely sampled ellipses carry far more
+vertices than a printed figure can resolve. Polygons are simplified with
+shapely's topology-preserving Douglas-Peucker to a tolerance of a fraction
+of a device pixel, worked out from the figure's WCS, size and output dpi.
+Tolerances are rounded down to a power of two so that figures of similar
+scale share the simplified polygons, which are cached per tolerance.
+"""
+
+import hashlib
+
+import numpy as np
+from shapely.geometry import Polygon
+
+from .footprintcache import FootprintCache
+
+
+# Polygons with fewer vertices are drawn as they are
+LOD_MIN_VERTICES = 64
+
+_lod_cache = FootprintCache(max_vertices=2000000, ttl=None)
+
+
+def get_lod_cache():
+    """Get the :class:`andromap.footprintcache.FootprintCache` of simplified
+    polygons.
+    """
+    return _lod_cache
+
+
+def _angular_separation(ra1, dec1, ra2, dec2):
+    """Great circle distance between points, in degrees."""
+    ra1, dec1, ra2, dec2 = [np.radians(a) for a in (ra1, dec1, ra2, dec2)]
+    h = np.sin(0.5 * (dec2 - dec1)) ** 2 \
+        + np.cos(dec1) * np.cos(dec2) * np.sin(0.5 * (ra2 - ra1)) ** 2
+    return np.degrees(2. * np.arcsin(np.sqrt(h)))
+
+
+def pixel_scale(ffig, ax, dpi):
+    """Size of a device pixel, in degrees, of an aplpy FITSFigure drawn at
+    ``dpi``.
+
+    The angular width and height of the axes' current view are divided by
+    the number of device pixels they span; the finer of the two scales is
+    returned.
+    """
+    x0, x1 = ax.get_xlim()
+    y0, y1 = ax.get_ylim()
+    xc = 0.5 * (x0 + x1)
+    yc = 0.5 * (y0 + y1)
+    ra, dec = ffig.pixel2world(np.array([x0, x1, xc, xc]),
+                               np.array([yc, yc, y0, y1]))
+    width = _angular_separation(ra[0], dec[0], ra[1], dec[1])
+    height = _angular_separation(ra[2], dec[2], ra[3], dec[3])
+    bbox = ax.get_position()
+    fig_width, fig_height = ax.figure.get_size_inches()
+    n_x = bbox.width * fig_width * dpi
+    n_y = bbox.height * fig_height * dpi
+    return min(width / n_x, height / n_y)
+
+
+def quantize_tolerance(tolerance):
+    """Round a tolerance down to a power of two."""
+    return 2. ** np.floor(np.log2(tolerance))
+
+
+def simplify_polygon(vertices, tolerance):
+    """Simplify an Nx2 array of RA, Dec vertices to ``tolerance`` degrees on
+    the sky, preserving topology.
+
+    RA is scaled by cos(Dec) at the polygon's mean declination while
+    simplifying. The polygon is returned unchanged if simplification would
+    leave it degenerate.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    scale = np.cos(np.radians(vertices[:, 1].mean()))
+    xy = np.column_stack([vertices[:, 0] * scale, vertices[:, 1]])
+    simple = Polygon(xy).simplify(tolerance, preserve_topology=True)
+    if simple.is_empty or simple.geom_type != 'Polygon':
+        return vertices
+    coords = np.array(simple.exterior.coords)
+    if len(coords) < 4:
+        return vertices
+    coords[:, 0] /= scale
+    return coords
+
+
+def simplify_polygons(polygons, tolerance, min_vertices=LOD_MIN_VERTICES):
+    """Simplify a list of Nx2 RA, Dec vertex arrays for drawing.
+
+    Polygons with fewer than ``min_vertices`` vertices are passed through.
+    Others are simplified to ``tolerance`` (degrees, rounded down to a power
+    of two) and cached by their vertices and the tolerance, so redrawing
+    the same geometry at the same scale is free.
+    """
+    tolerance = quantize_tolerance(tolerance)
+    simplified = []
+    for vertices in polygons:
+        vertices = np.asarray(vertices, dtype=np.float64)
+        if len(vertices) < min_vertices:
+            simplified.append(vertices)
+            continue
+        key = (hashlib.sha1(np.ascontiguousarray(vertices)).hexdigest(),
+               tolerance)
+        try:
+            simple = _lod_cache.get(key)
+        except KeyError:
+            simple = np.array(simplify_polygon(vertices, tolerance))
+            simple.setflags(write=False)
+            _lod_cache.put(key, simple, len(simple))
+        simplified.append(simple)
+    return simplified
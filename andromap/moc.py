@@ -0,0 +1,671 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+HEALPix Multi-Order Coverage maps (MOCs) of survey footprints.
+
+A :class:`MOC` is a set of cells of the NESTED HEALPix tessellation, stored
+as sorted, disjoint ranges of cell indices at its maximum order. Unions,
+intersections, differences and areas are then operations on integer
+ranges, however many exposures went into the coverage::
+
+    moc = image_moc({"INSTRUME": "MegaPrime"}, max_order=12)
+    both = moc & narrowband_moc()
+    print(both.area())
+    both.write('megacam_narrowband.fits')
+    m.plot_moc(both)
+
+Footprints are rasterized by refining HEALPix cells from order 0: cells
+lying inside a footprint are kept whole, cells clear of it are dropped and
+cells on its edge are split, down to ``max_order``, where an edge cell is
+kept if its centre is inside the footprint. The HEALPix functions below
+follow Gorski et al. (2005) and the reference HEALPix library.
+
+MOCs are written as FITS MOCs (IVOA MOC 1.1, ``NUNIQ`` ordering).
+"""
+
+import os
+import json
+
+import numpy as np
+from astropy.io import fits
+from shapely.geometry import MultiLineString
+from shapely.ops import linemerge, polygonize
+
+from .constants import D_KPC
+from .footprintset import FootprintSet
+from .imagelogfootprints import get_image_footprints
+from .layeralgebra import Layer
+from .tanproj import eq_to_tan
+
+
+# Resolution of coverage maps, unless set; order 12 cells are 52 arcsec
+DEFAULT_MAX_ORDER = 12
+# Deepest order that indices fit an int64 at
+MAX_ORDER = 29
+# Order from which footprints are tested against cells in their own tangent
+# plane; coarser cells are only compared by distance
+PLANE_ORDER = 5
+# Footprints rasterized together
+CHUNK_SIZE = 1000
+
+try:
+    from shapely import linestrings as _make_linestrings  # Shapely >= 2
+except ImportError:
+    _make_linestrings = None
+
+# Ring and longitude indices of the corners of the 12 base faces
+_JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+_JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+
+def _spread_bits(x):
+    """Move the bits of ``x`` to the even bit positions."""
+    x = np.asarray(x, dtype=np.int64)
+    x = (x | (x << 16)) & 0x0000FFFF0000FFFF
+    x = (x | (x << 8)) & 0x00FF00FF00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x << 2)) & 0x3333333333333333
+    x = (x | (x << 1)) & 0x5555555555555555
+    return x
+
+
+def _compress_bits(x):
+    """Collect the even bits of ``x``."""
+    x = np.asarray(x, dtype=np.int64) & 0x5555555555555555
+    x = (x | (x >> 1)) & 0x3333333333333333
+    x = (x | (x >> 2)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x >> 4)) & 0x00FF00FF00FF00FF
+    x = (x | (x >> 8)) & 0x0000FFFF0000FFFF
+    x = (x | (x >> 16)) & 0x00000000FFFFFFFF
+    return x
+
+
+def nest_to_xyf(order, ipix):
+    """Split NESTED indices into face-local ``ix``, ``iy`` and the face."""
+    ipix = np.asarray(ipix, dtype=np.int64)
+    face = ipix >> (2 * order)
+    local = ipix & ((1 << (2 * order)) - 1)
+    return _compress_bits(local), _compress_bits(local >> 1), face
+
+
+def xyf_to_nest(order, ix, iy, face):
+    """NESTED indices of face-local cell coordinates."""
+    return (np.asarray(face, dtype=np.int64) << (2 * order)) \
+        + _spread_bits(ix) + (_spread_bits(iy) << 1)
+
+
+def ang_to_nest(order, ra, dec):
+    """NESTED indices of the cells of ``order`` holding RA, Dec points
+    (degrees).
+    """
+    nside = 1 << order
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+    z = np.sin(np.radians(dec))
+    tt = np.mod(ra, 360.) / 90.
+    tt = np.where(tt >= 4., 0., tt)
+    ix = np.empty(len(z), dtype=np.int64)
+    iy = np.empty(len(z), dtype=np.int64)
+    face = np.empty(len(z), dtype=np.int64)
+
+    eq = np.abs(z) <= 2. / 3.
+    # Equatorial belt
+    t1 = nside * (0.5 + tt[eq])
+    t2 = nside * (0.75 * z[eq])
+    jp = (t1 - t2).astype(np.int64)  # index of the ascending edge line
+    jm = (t1 + t2).astype(np.int64)  # index of the descending edge line
+    ifp = jp >> order
+    ifm = jm >> order
+    face[eq] = np.where(ifp == ifm, ifp | 4,
+                        np.where(ifp < ifm, ifp, ifm + 8))
+    ix[eq] = jm & (nside - 1)
+    iy[eq] = nside - (jp & (nside - 1)) - 1
+    # Polar caps
+    pol = ~eq
+    ntt = np.minimum(tt[pol].astype(np.int64), 3)
+    tp = tt[pol] - ntt
+    tmp = nside * np.sqrt(3. * (1. - np.abs(z[pol])))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1. - tp) * tmp).astype(np.int64), nside - 1)
+    north = z[pol] >= 0.
+    face[pol] = np.where(north, ntt, ntt + 8)
+    ix[pol] = np.where(north, nside - jm - 1, jp)
+    iy[pol] = np.where(north, nside - jp - 1, jm)
+    return xyf_to_nest(order, ix, iy, face)
+
+
+def xyf_to_ang(x, y, face):
+    """RA, Dec (degrees) of points given by face-local coordinates ``x``,
+    ``y`` in [0, 1] on base ``face``.
+    """
+    face = np.asarray(face)
+    jr = _JRLL[face] - x - y
+    r = np.where(jr < 1., jr, np.where(jr > 3., 4. - jr, 1.))
+    z = np.where(jr < 1., 1. - r * r / 3.,
+                 np.where(jr > 3., r * r / 3. - 1., (2. - jr) * 2. / 3.))
+    tmp = np.mod(_JPLL[face] * r + x - y, 8.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        phi = np.where(r < 1e-15, 0., 45. * tmp / r)
+    return phi, np.degrees(np.arcsin(np.clip(z, -1., 1.)))
+
+
+def cell_centers(order, ipix):
+    """RA, Dec (degrees) of the centres of NESTED cells."""
+    ix, iy, face = nest_to_xyf(order, ipix)
+    nside = float(1 << order)
+    return xyf_to_ang((ix + 0.5) / nside, (iy + 0.5) / nside, face)
+
+
+def cell_corners(order, ipix, step=1, scale_order=None):
+    """RA, Dec (degrees) of points around the boundaries of NESTED cells.
+
+    Parameters
+    ----------
+    step : int
+        Points per cell edge; the corners alone with ``step=1``.
+    scale_order : int
+        Compute face coordinates in units of cells of this (deeper) order,
+        so that the corners that cells of different orders share come out
+        identical.
+
+    Returns
+    -------
+    ra, dec : ndarray
+        ``(n, 4 * step)`` arrays, going around each cell from its north
+        corner.
+    """
+    ipix = np.atleast_1d(ipix)
+    ix, iy, face = nest_to_xyf(order, ipix)
+    if scale_order is None:
+        scale_order = order
+    unit = 1 << (scale_order - order)
+    nside = float(1 << scale_order)
+    i = np.arange(step) * unit / float(step)
+    x0 = (ix * unit)[:, np.newaxis]
+    y0 = (iy * unit)[:, np.newaxis]
+    ones = np.ones((1, step))
+    # Edges: north-west, south-west, south-east, north-east
+    xs = np.hstack([x0 + unit - i, x0 * ones, x0 + i, (x0 + unit) * ones])
+    ys = np.hstack([(y0 + unit) * ones, y0 + unit - i, y0 * ones, y0 + i])
+    ra, dec = xyf_to_ang(xs / nside, ys / nside, face[:, np.newaxis])
+    # Keep each cell's RAs on the branch of its first corner
+    offset = ra - ra[:, :1]
+    ra = np.where(offset > 180., ra - 360.,
+                  np.where(offset < -180., ra + 360., ra))
+    return ra, dec
+
+
+def _unit_vectors(ra, dec):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra),
+                     np.sin(dec)], axis=-1)
+
+
+def _cell_radii(order, ipix, ra, dec):
+    """Angular distance (degrees) from cell centres to their furthest
+    corner.
+    """
+    cra, cdec = cell_corners(order, ipix)
+    dots = np.einsum('ij,ikj->ik', _unit_vectors(ra, dec),
+                     _unit_vectors(cra, cdec))
+    return np.degrees(np.arccos(np.clip(dots.min(axis=1), -1., 1.)))
+
+
+def _merge_ranges(ranges):
+    """Sort ranges and merge those that overlap or touch."""
+    ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+    ranges = ranges[ranges[:, 1] > ranges[:, 0]]
+    if len(ranges) == 0:
+        return ranges
+    ranges = ranges[np.argsort(ranges[:, 0], kind='mergesort')]
+    ends = np.maximum.accumulate(ranges[:, 1])
+    new = np.ones(len(ranges), dtype=bool)
+    new[1:] = ranges[1:, 0] > ends[:-1]
+    starts = ranges[new, 0]
+    last = np.append(np.nonzero(new)[0][1:] - 1, len(ranges) - 1)
+    return np.column_stack([starts, ends[last]])
+
+
+def _combine_ranges(a, b, op):
+    """Combine two sets of disjoint, sorted ranges with a boolean ``op`` of
+    membership in ``a`` and in ``b``.
+    """
+    bounds = np.unique(np.concatenate([a.ravel(), b.ravel()]))
+    if len(bounds) < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+    starts = bounds[:-1]
+    in_a = np.searchsorted(a.ravel(), starts, side='right') % 2 == 1
+    in_b = np.searchsorted(b.ravel(), starts, side='right') % 2 == 1
+    keep = op(in_a, in_b)
+    return _merge_ranges(np.column_stack([starts[keep], bounds[1:][keep]]))
+
+
+def _expand(starts, counts):
+    """Concatenate ``arange(s, s + n)`` for each start and count."""
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+
+
+class MOC(object):
+    """Multi-Order Coverage map: a set of HEALPix cells.
+
+    Parameters
+    ----------
+    ranges : ndarray
+        ``(n, 2)`` array of half-open ranges of NESTED cell indices at
+        ``max_order``.
+    max_order : int
+        Deepest order of the cells.
+    """
+    def __init__(self, ranges=None, max_order=DEFAULT_MAX_ORDER):
+        super(MOC, self).__init__()
+        if not 0 <= max_order <= MAX_ORDER:
+            raise ValueError("max_order must be within 0 -- %i" % MAX_ORDER)
+        self.max_order = max_order
+        if ranges is None:
+            ranges = np.zeros((0, 2), dtype=np.int64)
+        self.ranges = _merge_ranges(ranges)
+
+    @classmethod
+    def from_cells(cls, orders, ipix, max_order=DEFAULT_MAX_ORDER):
+        """Make a MOC from NESTED cells of (up to) ``max_order``. Cells
+        deeper than ``max_order`` are coarsened to their parent.
+        """
+        orders = np.asarray(orders, dtype=np.int64)
+        ipix = np.asarray(ipix, dtype=np.int64)
+        deeper = orders > max_order
+        ipix = np.where(deeper, ipix >> (2 * (orders - max_order)), ipix)
+        orders = np.minimum(orders, max_order)
+        shift = 2 * (max_order - orders)
+        return cls(np.column_stack([ipix << shift, (ipix + 1) << shift]),
+                   max_order=max_order)
+
+    @classmethod
+    def from_uniq(cls, uniq, max_order=None):
+        """Make a MOC from NUNIQ cell indices (``4 * 4**order + ipix``)."""
+        uniq = np.asarray(uniq, dtype=np.int64)
+        orders = np.zeros(len(uniq), dtype=np.int64)
+        for k in range(1, MAX_ORDER + 1):
+            orders[uniq >= 4 << (2 * k)] = k
+        ipix = uniq - (4 << (2 * orders))
+        if max_order is None:
+            max_order = int(orders.max()) if len(orders) else 0
+        return cls.from_cells(orders, ipix, max_order=max_order)
+
+    @classmethod
+    def from_polygons(cls, polygons, max_order=DEFAULT_MAX_ORDER,
+                      chunk_size=CHUNK_SIZE):
+        """Rasterize polygons with RA, Dec vertices.
+
+        Parameters
+        ----------
+        polygons : list
+            Nx2 vertex arrays, a dictionary of them or a
+            :class:`andromap.footprintset.FootprintSet`. Polygons should
+            span less than about 45 degrees.
+        max_order : int
+            Deepest HEALPix order; cells on footprint edges are kept at this
+            order if their centres are inside.
+        chunk_size : int
+            Number of polygons rasterized together.
+        """
+        if isinstance(polygons, FootprintSet):
+            footprints = polygons
+        elif isinstance(polygons, dict):
+            footprints = FootprintSet.from_dict(polygons)
+        else:
+            footprints = FootprintSet.from_polygons(range(len(polygons)),
+                                                    polygons)
+        footprints = footprints.normalize()
+        footprints = footprints.subset(footprints.counts >= 4)
+        ranges = [np.zeros((0, 2), dtype=np.int64)]
+        for i0 in range(0, len(footprints), chunk_size):
+            chunk = footprints.subset(slice(i0, i0 + chunk_size))
+            orders, ipix = _rasterize(chunk, max_order)
+            ranges.append(cls.from_cells(orders, ipix, max_order).ranges)
+        return cls(np.concatenate(ranges), max_order=max_order)
+
+    @classmethod
+    def read(cls, path):
+        """Read a FITS MOC."""
+        with fits.open(path) as hdus:
+            hdu = hdus[1]
+            uniq = np.asarray(hdu.data.field(0), dtype=np.int64)
+            max_order = hdu.header.get('MOCORDER')
+        return cls.from_uniq(uniq, max_order=max_order)
+
+    def write(self, path, overwrite=False):
+        """Write the MOC as a FITS MOC (IVOA MOC 1.1, ``NUNIQ`` ordering)."""
+        orders, ipix = self.cells()
+        uniq = np.sort((4 << (2 * orders)) + ipix)
+        col = fits.Column(name='UNIQ', format='K', array=uniq)
+        hdu = fits.BinTableHDU.from_columns([col])
+        hdu.header['PIXTYPE'] = 'HEALPIX'
+        hdu.header['ORDERING'] = 'NUNIQ'
+        hdu.header['COORDSYS'] = 'C'
+        hdu.header['MOCVERS'] = '1.1'
+        hdu.header['MOCDIM'] = 'SPACE'
+        hdu.header['MOCORDER'] = self.max_order
+        hdu.header['MOCTOOL'] = 'andromap'
+        dirname = os.path.dirname(path)
+        if dirname != "" and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        hdu.writeto(path, overwrite=overwrite)
+
+    def __repr__(self):
+        return "<MOC of order %i, %i cells, %.3f deg2>" % (
+            self.max_order, len(self.cells()[0]), self.area())
+
+    def __eq__(self, other):
+        return (isinstance(other, MOC) and self.max_order == other.max_order
+                and np.array_equal(self.ranges, other.ranges))
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def is_empty(self):
+        return len(self.ranges) == 0
+
+    @property
+    def n_cells(self):
+        """Number of ``max_order`` cells covered."""
+        return int((self.ranges[:, 1] - self.ranges[:, 0]).sum())
+
+    def degrade(self, max_order):
+        """Coarsen to a shallower ``max_order``; partly covered cells are
+        kept.
+        """
+        if max_order >= self.max_order:
+            return self
+        shift = 2 * (self.max_order - max_order)
+        ranges = np.column_stack([self.ranges[:, 0] >> shift,
+                                  -((-self.ranges[:, 1]) >> shift)])
+        return MOC(ranges, max_order=max_order)
+
+    def _match(self, other):
+        order = min(self.max_order, other.max_order)
+        return self.degrade(order), other.degrade(order), order
+
+    def union(self, other):
+        a, b, order = self._match(other)
+        return MOC(np.concatenate([a.ranges, b.ranges]), max_order=order)
+
+    def intersection(self, other):
+        a, b, order = self._match(other)
+        return MOC(_combine_ranges(a.ranges, b.ranges, np.logical_and),
+                   max_order=order)
+
+    def difference(self, other):
+        a, b, order = self._match(other)
+        return MOC(_combine_ranges(a.ranges, b.ranges,
+                                   lambda x, y: x & ~y),
+                   max_order=order)
+
+    def symmetric_difference(self, other):
+        a, b, order = self._match(other)
+        return MOC(_combine_ranges(a.ranges, b.ranges, np.logical_xor),
+                   max_order=order)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
+
+    def contains(self, ra, dec):
+        """Whether RA, Dec points (degrees) lie in the coverage."""
+        ipix = ang_to_nest(self.max_order, ra, dec)
+        return np.searchsorted(self.ranges.ravel(), ipix, side='right') \
+            % 2 == 1
+
+    def sky_fraction(self):
+        """Fraction of the sky covered."""
+        return self.n_cells / (12. * 4. ** self.max_order)
+
+    def area(self):
+        """Area covered, in square degrees on the sphere."""
+        return self.sky_fraction() * 4. * np.pi * (180. / np.pi) ** 2
+
+    def area_kpc2(self):
+        """Area covered in square kiloparsecs at the distance of M31."""
+        return self.sky_fraction() * 4. * np.pi * D_KPC ** 2
+
+    def cells(self):
+        """The covered cells at their coarsest orders.
+
+        Returns
+        -------
+        orders, ipix : ndarray
+            Order and NESTED index of each cell, coarsest cells first.
+        """
+        all_orders = []
+        all_ipix = []
+        starts = self.ranges[:, 0]
+        ends = self.ranges[:, 1]
+        for k in range(self.max_order + 1):
+            shift = 2 * (self.max_order - k)
+            # Order k cells inside each range, and those inside the range's
+            # order k - 1 cells
+            lo = -((-starts) >> shift)
+            hi = ends >> shift
+            if k == 0:
+                plo, phi = lo, lo
+            else:
+                plo = (-((-starts) >> (shift + 2))) << 2
+                phi = (ends >> (shift + 2)) << 2
+            has_parent = plo < phi
+            # Cells before and after the parents' span
+            n1 = np.where(has_parent, plo - lo, hi - lo).clip(0)
+            n2 = np.where(has_parent, hi - phi, 0).clip(0)
+            ipix = np.concatenate([_expand(lo, n1), _expand(phi, n2)])
+            all_ipix.append(ipix)
+            all_orders.append(np.repeat(k, len(ipix)))
+        return np.concatenate(all_orders), np.concatenate(all_ipix)
+
+    def uniq(self):
+        """Sorted NUNIQ indices of the cells."""
+        orders, ipix = self.cells()
+        return np.sort((4 << (2 * orders)) + ipix)
+
+    def to_layer(self):
+        """Outline the coverage as a :class:`andromap.layeralgebra.Layer`.
+
+        Cell edges are cut at every ``max_order`` cell corner, computed on
+        a common grid, so that neighbouring cells of any order share them.
+        Edges shared by two cells cancel; the rest are polygonized and the
+        faces inside the coverage kept.
+        """
+        edges = []
+        orders, ipix = self.cells()
+        for k in np.unique(orders):
+            step = 1 << (self.max_order - int(k))
+            ra, dec = cell_corners(int(k), ipix[orders == k], step=step,
+                                   scale_order=self.max_order)
+            verts = np.round(np.dstack([ra, dec]), 10)
+            ends = np.roll(verts, -1, axis=1)
+            edges.append(np.concatenate([verts, ends], axis=2)
+                         .reshape(-1, 4))
+        if not edges:
+            return Layer()
+        edges = np.concatenate(edges)
+        # Orient every edge the same way so that shared edges match
+        flip = (edges[:, 0] > edges[:, 2]) \
+            | ((edges[:, 0] == edges[:, 2]) & (edges[:, 1] > edges[:, 3]))
+        edges[flip] = edges[flip][:, [2, 3, 0, 1]]
+        edges, counts = np.unique(edges, axis=0, return_counts=True)
+        lines = _linestrings(edges[counts == 1].reshape(-1, 2, 2))
+        # Faces are disjoint; keep those inside the coverage (not holes)
+        faces = [f for f in polygonize(linemerge(lines))
+                 if self.contains(*_point_coords(f))[0]]
+        return Layer._from_parts(faces)
+
+    def polygons(self, holes=True):
+        """Outlines of the coverage as Nx2 RA, Dec vertex arrays (see
+        :meth:`andromap.layeralgebra.Layer.polygons`).
+        """
+        return self.to_layer().polygons(holes=holes)
+
+
+def _linestrings(segments):
+    """Make a MultiLineString of ``(n, 2, 2)`` segments."""
+    if _make_linestrings is not None:
+        return MultiLineString(list(_make_linestrings(segments)))
+    return MultiLineString([tuple(map(tuple, seg)) for seg in segments])
+
+
+def _point_coords(polygon):
+    """RA, Dec of a point inside a polygon."""
+    p = polygon.representative_point()
+    return p.x, p.y
+
+
+def _sphere_centers(footprints):
+    """``(n, 2)`` RA, Dec of the mean unit vector of each closed
+    footprint's vertices, which unlike the centre of the RA, Dec bounding
+    box is right for footprints that cross RA = 0.
+    """
+    vec = _unit_vectors(footprints.vertices[:, 0], footprints.vertices[:, 1])
+    # Leave out the closing vertex, a repeat of the first
+    total = np.add.reduceat(vec, footprints.offsets[:-1], axis=0) \
+        - vec[footprints.offsets[1:] - 1]
+    ra = np.degrees(np.arctan2(total[:, 1], total[:, 0])) % 360.
+    dec = np.degrees(np.arctan2(total[:, 2], np.hypot(total[:, 0],
+                                                      total[:, 1])))
+    return np.column_stack([ra, dec])
+
+
+def _rasterize(footprints, max_order):
+    """Cells covering normalized footprints.
+
+    Returns
+    -------
+    orders, ipix : ndarray
+        Order and NESTED index of each covering cell (cells may repeat).
+    """
+    n_poly = len(footprints)
+    centers = _sphere_centers(footprints)
+    v = footprints.vertices
+    poly_of_vertex = np.repeat(np.arange(n_poly), footprints.counts)
+    # Angular radius of each footprint about its centre
+    dots = np.einsum('ij,ij->i', _unit_vectors(v[:, 0], v[:, 1]),
+                     _unit_vectors(centers[poly_of_vertex, 0],
+                                   centers[poly_of_vertex, 1]))
+    radius = np.degrees(np.arccos(np.clip(
+        np.minimum.reduceat(dots, footprints.offsets[:-1]), -1., 1.)))
+    # Vertices in the plane tangent at each footprint's centre
+    xi, eta = eq_to_tan(v[:, 0], v[:, 1], ra0=centers[poly_of_vertex, 0],
+                        dec0=centers[poly_of_vertex, 1])
+    edge_counts = footprints.counts - 1
+    center_vec = _unit_vectors(centers[:, 0], centers[:, 1])
+
+    out_orders = []
+    out_ipix = []
+    poly = np.repeat(np.arange(n_poly), 12)
+    ipix = np.tile(np.arange(12), n_poly)
+    for order in range(max_order + 1):
+        if len(ipix) == 0:
+            break
+        # Overlapping footprints share cells; find each cell's geometry once
+        cells, which = np.unique(ipix, return_inverse=True)
+        which = which.ravel()
+        cra, cdec = cell_centers(order, cells)
+        r_cell = _cell_radii(order, cells, cra, cdec)[which]
+        cell_vec = _unit_vectors(cra, cdec)[which]
+        cra = cra[which]
+        cdec = cdec[which]
+        d = np.degrees(np.arccos(np.clip(np.einsum(
+            'ij,ij->i', cell_vec, center_vec[poly]), -1., 1.)))
+        near = d <= radius[poly] + r_cell
+        poly, ipix, which, cra, cdec, r_cell, d = [
+            a[near] for a in (poly, ipix, which, cra, cdec, r_cell, d)]
+        split = np.ones(len(ipix), dtype=bool)
+        if order >= PLANE_ORDER:
+            plane = d + r_cell < 45.
+            last = order == max_order
+            inside, dist = _plane_test(
+                footprints.offsets, edge_counts, xi, eta, poly[plane],
+                cra[plane], cdec[plane], centers, distance=not last)
+            if last:
+                keep = inside
+                clear = np.ones(len(keep), dtype=bool)
+            else:
+                # Gnomonic distances stretch by up to sec^2 away from the
+                # tangent point
+                r_plane = r_cell[plane] \
+                    / np.cos(np.radians(d[plane] + r_cell[plane])) ** 2
+                clear = dist > r_plane
+                keep = inside & clear
+            out_orders.append(np.repeat(order, keep.sum()))
+            out_ipix.append(ipix[plane][keep])
+            split[plane] = ~clear
+            # Cells inside one footprint need no refining for the others
+            covered = np.zeros(len(cells), dtype=bool)
+            covered[which[plane][keep]] = True
+            split &= ~covered[which]
+        if order == max_order:
+            break
+        poly = np.repeat(poly[split], 4)
+        ipix = (np.repeat(ipix[split], 4) << 2) \
+            + np.tile(np.arange(4), split.sum())
+    if not out_ipix:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(out_orders), np.concatenate(out_ipix)
+
+
+def _plane_test(offsets, edge_counts, xi, eta, poly, ra, dec, centers,
+                distance=True):
+    """Test points against footprints in each footprint's tangent plane.
+
+    Returns
+    -------
+    inside : ndarray
+        Whether each point ``ra``, ``dec`` is inside footprint ``poly``.
+    dist : ndarray
+        Distance (degrees in the tangent plane) from each point to the
+        footprint's boundary, or ``None`` unless ``distance``.
+    """
+    if len(poly) == 0:
+        return np.zeros(0, dtype=bool), np.zeros(0)
+    px, py = eq_to_tan(ra, dec, ra0=centers[poly, 0], dec0=centers[poly, 1])
+    n_edges = edge_counts[poly]
+    pair = np.repeat(np.arange(len(poly)), n_edges)
+    a = _expand(offsets[poly], n_edges)
+    x1, y1, x2, y2 = xi[a], eta[a], xi[a + 1], eta[a + 1]
+    qx = px[pair]
+    qy = py[pair]
+    # Even-odd rule
+    crosses = ((y1 > qy) != (y2 > qy)) \
+        & (qx < x1 + (qy - y1) * (x2 - x1) / np.where(y2 != y1, y2 - y1, 1.))
+    first = np.cumsum(n_edges) - n_edges
+    inside = np.add.reduceat(crosses.astype(np.int64), first) % 2 == 1
+    if not distance:
+        return inside, None
+    # Distance to each edge segment
+    dx = x2 - x1
+    dy = y2 - y1
+    t = np.clip(((qx - x1) * dx + (qy - y1) * dy) / (dx * dx + dy * dy),
+                0., 1.)
+    dist = np.hypot(qx - x1 - t * dx, qy - y1 - t * dy)
+    return inside, np.minimum.reduceat(dist, first)
+
+
+def image_moc(sel, max_order=DEFAULT_MAX_ORDER):
+    """Coverage of the image log footprints matching a selector."""
+    footprints = get_image_footprints(sel)
+    if footprints is None:
+        return MOC(max_order=max_order)
+    return MOC.from_polygons(footprints, max_order=max_order)
+
+
+def narrowband_moc(names=None, max_order=DEFAULT_MAX_ORDER):
+    """Coverage of the narrowband fields (all fields by default)."""
+    data_path = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                             "data/narrowband_fields.json")
+    with open(data_path) as f:
+        field_data = json.loads(f.read())
+    if names is None:
+        names = sorted(field_data.keys())
+    return MOC.from_polygons(dict((n, field_data[n]) for n in names),
+                             max_order=max_order)
@@ -6,27 +6,316 @@ Tools for working with polygons through shapely
 2013-12-11 - Created by Jonathan Sick
 """
 
+import itertools
+import multiprocessing
+
+from shapely import wkb
 from shapely.geometry import Polygon, MultiPolygon
-from shapely.ops import cascaded_union
+from shapely.ops import unary_union
 import numpy as np
 
+from .constants import M31RA0, M31DEC0
+from .footprintset import FootprintSet
+from .tanproj import eq_to_tan
+
 
 def close_vertices(polygon):
-    """Make the last vertex the same as the first."""
-    polygon.append(polygon[0])
-    return polygon
+    """Make the last vertex the same as the first.
+
+    Returns a new Nx2 array; the input is left untouched and an already
+    closed polygon comes back unchanged, so cached vertices can be closed
+    any number of times. Use
+    :meth:`andromap.footprintset.FootprintSet.normalize` to close many
+    polygons at once.
+    """
+    polygon = np.array(polygon, dtype=np.float64).reshape(-1, 2)
+    if len(polygon) == 0 or (len(polygon) > 1
+                             and np.array_equal(polygon[0], polygon[-1])):
+        return polygon
+    return np.vstack((polygon, polygon[:1]))
 
 
-def polygon_union(polygons):
-    """Make the union of polygons. Returns a list of all isolated polygon
-    unions."""
+def polygon_union(polygons, processes=1):
+    """Make the union of polygons (a list of vertex arrays or a
+    :class:`andromap.footprintset.FootprintSet`). Returns a list of all
+    isolated polygon unions.
+
+    With ``processes`` greater than one the union is computed on a process
+    pool by :func:`parallel_union`.
+    """
+    if isinstance(polygons, FootprintSet):
+        polygons = polygons.polygons()
+    if processes is None or processes > 1:
+        return exterior_vertices(parallel_union(polygons,
+                                                processes=processes))
     shapely_polys = [Polygon(p) for p in polygons]
     multipoly = MultiPolygon(shapely_polys)
-    u = cascaded_union(multipoly)
-    if isinstance(u, MultiPolygon):
-        vert_seq = []
-        for p in u:
-            vert_seq.append(np.array(p.exterior.coords[:]))
-        return vert_seq
-    else:
-        return [np.array(u.exterior.coords[:])]
+    u = unary_union(multipoly)
+    return exterior_vertices(u)
+
+
+def stream_union(chunks):
+    """Fold chunks of polygons (lists of Nx2 vertex arrays) into a running
+    union, so that only one chunk need be in memory at a time.
+
+    Returns
+    -------
+    union : shapely geometry
+        The union (a Polygon or MultiPolygon; empty if there were no
+        polygons).
+    """
+    union = Polygon()
+    for chunk in chunks:
+        part = unary_union([Polygon(p) for p in chunk])
+        union = part if union.is_empty else union.union(part)
+    return union
+
+
+def _union_tile(packed):
+    """Union the polygons packed as ``(vertices, counts)``; returns WKB."""
+    vertices, counts = packed
+    ends = np.cumsum(counts)
+    polys = [Polygon(vertices[i1 - n:i1]) for n, i1 in zip(counts, ends)]
+    return unary_union(polys).wkb
+
+
+def _union_wkb(parts):
+    """Union geometries given as WKB; returns WKB."""
+    return unary_union([wkb.loads(p) for p in parts]).wkb
+
+
+def parallel_union(polygons, processes=None, tiles_per_process=4,
+                   ra0=M31RA0, dec0=M31DEC0):
+    """Union polygons with RA, Dec vertices on a process pool.
+
+    Polygons are assigned to a grid of tiles by the position of their mean
+    vertex in the plane tangent at ``ra0``, ``dec0``. Each tile is unioned
+    by a worker, then the tile unions are merged in 2x2 blocks, level by
+    level, also in the pool. Vertices are sent to the workers as packed
+    arrays and unions are returned as WKB, so holes are preserved.
+
+    Parameters
+    ----------
+    polygons : list
+        Nx2 vertex arrays, or a :class:`andromap.footprintset.FootprintSet`.
+    processes : int
+        Number of worker processes; all CPUs if ``None``.
+    tiles_per_process : int
+        Approximate number of tiles per worker.
+
+    Returns
+    -------
+    union : shapely geometry
+        The union (a Polygon or MultiPolygon).
+    """
+    if not isinstance(polygons, FootprintSet):
+        polygons = FootprintSet.from_polygons(range(len(polygons)), polygons)
+    if len(polygons) == 0:
+        return Polygon()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    counts = polygons.counts
+    vertices = polygons.vertices
+    means = np.add.reduceat(vertices, polygons.offsets[:-1], axis=0) \
+        / counts[:, None]
+    xi, eta = eq_to_tan(means[:, 0], means[:, 1], ra0=ra0, dec0=dec0)
+
+    n_side = int(np.ceil(np.sqrt(processes * tiles_per_process)))
+    ix = _grid_index(xi, n_side)
+    iy = _grid_index(eta, n_side)
+    tile_ids = ix * n_side + iy
+    order = np.argsort(tile_ids, kind='mergesort')
+    bounds = np.nonzero(np.diff(tile_ids[order]))[0] + 1
+    tiles = []
+    packs = []
+    for members in np.split(order, bounds):
+        tile = tile_ids[members[0]]
+        tiles.append((tile // n_side, tile % n_side))
+        packed = polygons.subset(members)
+        packs.append((packed.vertices, packed.counts))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        nodes = dict(zip(tiles, pool.map(_union_tile, packs)))
+        while len(nodes) > 1:
+            blocks = {}
+            for (bx, by), part in nodes.items():
+                blocks.setdefault((bx >> 1, by >> 1), []).append(part)
+            keys = list(blocks.keys())
+            nodes = dict(zip(keys, pool.map(_union_wkb,
+                                            [blocks[k] for k in keys])))
+    finally:
+        pool.close()
+        pool.join()
+    return wkb.loads(list(nodes.values())[0])
+
+
+def _grid_index(x, n):
+    """Index of ``x`` values in ``n`` equal bins spanning their range."""
+    span = x.max() - x.min()
+    if span == 0:
+        return np.zeros(len(x), dtype=int)
+    i = ((x - x.min()) / span * n).astype(int)
+    return np.minimum(i, n - 1)
+
+
+def exterior_vertices(geometry):
+    """List the exterior vertices of each isolated polygon of a (multi)polygon
+    as Nx2 numpy arrays.
+    """
+    if geometry.is_empty:
+        return []
+    if isinstance(geometry, MultiPolygon):
+        return [np.array(p.exterior.coords[:]) for p in geometry.geoms]
+    return [np.array(geometry.exterior.coords[:])]
+
+
+class CoverageUnion(object):
+    """Union of polygons that can be updated incrementally.
+
+    Polygons are assigned to square tiles by the centre of their bounding
+    box. The union of each tile is cached, as is the union of each 2x2 block
+    of tiles, of each 2x2 block of blocks, and so on up to the root.
+    Adding or removing a polygon only re-unions its tile and the blocks
+    above it.
+
+    Blocks are found by halving tile indices, rounding down, so tiles on
+    either side of zero meet only at the top of the tree, where up to four
+    blocks (those with indices -1 and 0) are unioned into the root.
+
+    Parameters
+    ----------
+    polygons : list or dict
+        Optional initial polygons (see :meth:`add_many`).
+    tile_size : float
+        Width of the tiles, in the units of the vertices (degrees). Tiles
+        should hold a few to a few tens of polygons.
+    """
+    def __init__(self, polygons=None, tile_size=0.5):
+        super(CoverageUnion, self).__init__()
+        self.tile_size = tile_size
+        self._polygons = {}  # key: (tile, shapely Polygon)
+        self._tiles = {}  # tile: set of keys
+        self._unions = {}  # (level, ix, iy): union geometry
+        self._root = None
+        self._counter = itertools.count()
+        if polygons is not None:
+            self.add_many(polygons)
+
+    def __len__(self):
+        return len(self._polygons)
+
+    def __contains__(self, key):
+        return key in self._polygons
+
+    @property
+    def n_tiles(self):
+        """Number of occupied tiles."""
+        return len(self._tiles)
+
+    def _tile(self, poly):
+        minx, miny, maxx, maxy = poly.bounds
+        return (int(np.floor(0.5 * (minx + maxx) / self.tile_size)),
+                int(np.floor(0.5 * (miny + maxy) / self.tile_size)))
+
+    def _invalidate(self, tile):
+        """Drop the cached unions of a tile and of the blocks above it."""
+        self._root = None
+        ix, iy = tile
+        level = 0
+        while (level, ix, iy) in self._unions:
+            del self._unions[(level, ix, iy)]
+            level += 1
+            ix >>= 1
+            iy >>= 1
+
+    def add(self, polygon, key=None):
+        """Add a polygon (Nx2 vertices or a shapely Polygon).
+
+        Parameters
+        ----------
+        key : hashable
+            Name of the polygon, used to remove it. If ``None`` a new integer
+            key is made. An existing polygon with the same key is replaced.
+
+        Returns
+        -------
+        key : hashable
+            The polygon's key.
+        """
+        if key is None:
+            key = next(self._counter)
+        elif key in self._polygons:
+            self.remove(key)
+        if not isinstance(polygon, Polygon):
+            polygon = Polygon(polygon)
+        if not polygon.is_valid:
+            polygon = polygon.buffer(0)
+        tile = self._tile(polygon)
+        self._polygons[key] = (tile, polygon)
+        self._tiles.setdefault(tile, set()).add(key)
+        self._invalidate(tile)
+        return key
+
+    def add_many(self, polygons, keys=None):
+        """Add several polygons, given as a list, a dictionary of keys
+        mapping to polygons or a FootprintSet. Returns the list of keys.
+        """
+        if isinstance(polygons, (dict, FootprintSet)):
+            keys = list(polygons.keys())
+            polygons = [polygons[k] for k in keys]
+        if keys is None:
+            keys = [None] * len(polygons)
+        return [self.add(p, key=k) for p, k in zip(polygons, keys)]
+
+    def remove(self, key):
+        """Remove the polygon with ``key``; raises ``KeyError`` if absent."""
+        tile, polygon = self._polygons.pop(key)
+        members = self._tiles[tile]
+        members.discard(key)
+        if not members:
+            del self._tiles[tile]
+        self._invalidate(tile)
+
+    def _node_union(self, level, ix, iy):
+        node = (level, ix, iy)
+        if node not in self._unions:
+            if level == 0:
+                keys = self._tiles.get((ix, iy), ())
+                parts = [self._polygons[k][1] for k in keys]
+            else:
+                parts = [self._node_union(level - 1, 2 * ix + dx, 2 * iy + dy)
+                         for dx in (0, 1) for dy in (0, 1)]
+                parts = [p for p in parts if not p.is_empty]
+            self._unions[node] = unary_union(parts)
+        return self._unions[node]
+
+    @property
+    def geometry(self):
+        """The union as a shapely geometry."""
+        if not self._tiles:
+            return Polygon()
+        if self._root is None:
+            # Climb until a single block covers every tile, or until only
+            # the blocks either side of zero are left; -1 >> 1 is -1
+            level = 0
+            nodes = set(self._tiles.keys())
+            while len(nodes) > 1:
+                parents = set((ix >> 1, iy >> 1) for ix, iy in nodes)
+                if parents == nodes:
+                    break
+                level += 1
+                nodes = parents
+            parts = [self._node_union(level, ix, iy) for ix, iy in nodes]
+            if len(parts) == 1:
+                self._root = parts[0]
+            else:
+                self._root = unary_union([p for p in parts
+                                          if not p.is_empty])
+        return self._root
+
+    def exteriors(self):
+        """List the exterior vertices of each isolated part of the union as
+        Nx2 numpy arrays, as :func:`polygon_union` does.
+        """
+        return exterior_vertices(self.geometry)
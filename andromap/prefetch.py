@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Concurrent prefetch of map layer geometry.
+
+The queries and unions behind independent map layers are computed on a
+thread pool, e.g. while aplpy reads the basemap; the ``plot_*`` methods of
+:class:`andromap.Andromap` then only draw the results. MongoDB I/O and the
+GEOS operations of shapely release the GIL, so layers overlap with each
+other and with image loading.
+
+A layer is specified as the name of an ``Andromap.plot_<name>`` method
+followed by its geometry arguments::
+
+    Andromap(fitspath, prefetch=[
+        ('combined_fields', {"INSTRUME": "WIRCam", "TYPE": "sci"}),
+        ('phat', {'union': True}),
+        ('hst_halo',)])
+
+A trailing dictionary in a spec is taken as keyword arguments, unless it
+is the selector of a ``fields`` layer.
+"""
+
+import time
+import inspect
+import logging
+from multiprocessing.pool import ThreadPool
+
+from .footprintcache import canonical_selector
+from .imagelogfootprints import get_image_footprints, \
+    get_combined_image_footprint, get_combined_image_footprints, \
+    get_phat_bricks, get_combined_phat_bricks, get_acs_halo_fields
+
+
+def get_phat_polygons(union=True):
+    """Get PHAT polygons: the union of bricks if ``union``, otherwise a list
+    of the brick polygons.
+    """
+    if union:
+        return get_combined_phat_bricks()
+    return list(get_phat_bricks().values())
+
+
+# Geometry function of each prefetchable Andromap.plot_<name> layer
+LAYERS = {'fields': get_image_footprints,
+          'combined_fields': get_combined_image_footprint,
+          'combined_fields_grouped': get_combined_image_footprints,
+          'phat': get_phat_polygons,
+          'hst_halo': get_acs_halo_fields}
+# Layers whose first argument is a Mongo selector
+SELECTOR_LAYERS = ('fields', 'combined_fields', 'combined_fields_grouped')
+
+
+def layer_key(name, args=(), kwargs=None):
+    """Hashable key of a layer, independent of whether arguments were given
+    positionally, by keyword or left at their defaults.
+    """
+    func = LAYERS[name]
+    callargs = inspect.getcallargs(getattr(func, '__wrapped__', func),
+                                   *args, **(kwargs or {}))
+    return (name, canonical_selector(callargs))
+
+
+def parse_spec(spec):
+    """Split a layer spec into ``(name, args, kwargs)``."""
+    if isinstance(spec, str):
+        spec = (spec,)
+    name = spec[0]
+    if name not in LAYERS:
+        raise ValueError("Cannot prefetch %s; choose from %s"
+                         % (name, ", ".join(sorted(LAYERS))))
+    args = list(spec[1:])
+    kwargs = {}
+    is_selector = name in SELECTOR_LAYERS and len(args) == 1
+    if args and isinstance(args[-1], dict) and not is_selector:
+        kwargs = args.pop()
+    return name, tuple(args), kwargs
+
+
+def _timed_call(func, args, kwargs):
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return result, t0, time.time()
+
+
+class LayerPrefetcher(object):
+    """Compute layer geometry on a thread pool.
+
+    One pool is shared by every :meth:`submit`. It is shut down once all
+    submitted layers have been collected with :meth:`get` (or by
+    :meth:`close`), and started again by the next :meth:`submit`.
+
+    Parameters
+    ----------
+    specs : list
+        Layer specs (see module docstring).
+    processes : int
+        Number of worker threads.
+    """
+    def __init__(self, specs=(), processes=4):
+        super(LayerPrefetcher, self).__init__()
+        self.processes = processes
+        self._pool = None
+        self._pending = {}  # key: (name, AsyncResult, submit time)
+        self._timings = []
+        self._log = logging.getLogger('andromap')
+        self.submit(specs)
+
+    def submit(self, specs):
+        """Start computing the geometry of more layers."""
+        specs = [parse_spec(s) for s in specs]
+        if len(specs) == 0:
+            return
+        if self._pool is None:
+            self._pool = ThreadPool(self.processes)
+        for name, args, kwargs in specs:
+            key = layer_key(name, args, kwargs)
+            if key in self._pending:
+                continue
+            result = self._pool.apply_async(_timed_call,
+                                            (LAYERS[name], args, kwargs))
+            self._pending[key] = (name, result, time.time())
+
+    def close(self):
+        """Wait for submitted layers to finish and stop the worker threads.
+        Results not yet collected can still be got.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def get(self, name, *args, **kwargs):
+        """Get the geometry of a layer, waiting for it if it was prefetched
+        and computing it now otherwise.
+        """
+        key = layer_key(name, args, kwargs)
+        t0 = time.time()
+        if key not in self._pending:
+            result = LAYERS[name](*args, **kwargs)
+            self._timings.append({'layer': name, 'prefetched': False,
+                                  'fetch': time.time() - t0, 'wait': None})
+            return result
+        name, async_result, t_submit = self._pending.pop(key)
+        try:
+            result, t_start, t_end = async_result.get()
+        finally:
+            # Shut the pool down once every layer is collected, even if
+            # this one failed
+            if not self._pending:
+                self.close()
+        wait = time.time() - t0
+        self._timings.append({'layer': name, 'prefetched': True,
+                              'queued': t_start - t_submit,
+                              'fetch': t_end - t_start, 'wait': wait})
+        self._log.debug("Layer %s: fetched in %.2f s, waited %.2f s"
+                        % (name, t_end - t_start, wait))
+        return result
+
+    @property
+    def timings(self):
+        """List of dictionaries with the ``layer`` name, whether it was
+        ``prefetched``, the seconds it ``queued`` for a worker, took to
+        ``fetch`` and that drawing had to ``wait`` for it, in the order that
+        layers were drawn.
+        """
+        return list(self._timings)
+
+    def report(self):
+        """Format the layer timings as text."""
+        lines = ["%-24s %8s %8s" % ("layer", "fetch s", "wait s")]
+        for t in self._timings:
+            if t['prefetched']:
+                wait = "%8.2f" % t['wait']
+            else:
+                wait = "%8s" % "-"
+            lines.append("%-24s %8.2f %s" % (t['layer'], t['fetch'], wait))
+        return "\n".join(lines)
@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Vectorized evaluation of Mongo-style selectors on columnar metadata.
+
+Image log metadata is held as one NumPy array per (dotted) field plus a
+boolean array flagging the documents that have the field; text fields are
+dictionary encoded as integer codes into their sorted distinct values, so
+matching them compares integers rather than strings. A selector is
+evaluated into a boolean mask over the documents with whole-column
+operations, following Mongo's matching rules for the subset of the query
+language andromap uses:
+
+- equality, ``$eq`` and ``$ne``;
+- ``$in`` and ``$nin``;
+- ``$exists``;
+- ``$gt``, ``$gte``, ``$lt`` and ``$lte``;
+- dotted paths into embedded documents (``"lsb_mosaic.kind"``);
+- top-level ``$and``, ``$or`` and ``$nor``.
+
+As in Mongo, values only match fields of a comparable type (numbers match
+integer and float fields, strings match text fields), a missing field
+matches ``None`` and ``$ne``/``$nin`` match documents without the field.
+A field holding values of several types keeps one column part per type
+(booleans, numbers, text and ObjectIds), so each value is only compared
+with the documents of its type. Values of other types (dates, binary
+data, ...) are stored as text, can never equal a boolean, number, text or
+ObjectId, and come back as text. Explicit nulls are recorded apart from
+missing fields: both match ``None``, but only nulls satisfy ``$exists``.
+
+Anything else raises ``NotImplementedError`` so the query can be sent to
+the database instead: other operators, selector values of other types and
+selectors on fields that hold arrays in any document (or on paths into
+them).
+"""
+
+import numbers
+
+import numpy as np
+from bson import ObjectId
+
+
+try:
+    _isin_values = np.isin
+except AttributeError:  # numpy < 1.13
+    _isin_values = np.in1d
+
+COMPARISONS = {'$gt': np.greater, '$gte': np.greater_equal,
+               '$lt': np.less, '$lte': np.less_equal}
+
+
+class ColumnTable(object):
+    """In-memory columnar table of document fields.
+
+    Parameters
+    ----------
+    n_rows : int
+        Number of documents.
+    columns : dict
+        Dictionary of dotted field names mapping to :class:`Column`.
+    array_fields : set
+        Names of fields holding arrays, which cannot be matched locally.
+    fields : list
+        Fields the table was restricted to, or ``None`` if it holds every
+        field of the documents.
+    """
+    def __init__(self, n_rows, columns=None, array_fields=(), fields=None):
+        super(ColumnTable, self).__init__()
+        self.n_rows = n_rows
+        self._columns = dict(columns or {})
+        self.array_fields = set(array_fields)
+        self.fields = None if fields is None else set(fields)
+
+    @classmethod
+    def from_documents(cls, docs, fields=None, skip=None):
+        """Build a table from an iterable of documents (dicts).
+
+        Every scalar field (or only ``fields``) becomes a column; the
+        ``skip`` field is left out and fields holding lists are recorded
+        in ``array_fields``.
+        """
+        columns = {}  # name: (row indices, values)
+        arrays = set()
+        n_rows = 0
+        for i, doc in enumerate(docs):
+            n_rows = i + 1
+            for name, value in flatten_document(doc, skip=skip,
+                                                arrays=arrays):
+                if fields is not None and name not in fields:
+                    continue
+                rows, values = columns.setdefault(name, ([], []))
+                rows.append(i)
+                values.append(value)
+        return cls(n_rows, dict((name, make_column(n_rows, rows, values))
+                                for name, (rows, values)
+                                in columns.items()),
+                   array_fields=arrays, fields=fields)
+
+    @property
+    def column_names(self):
+        """Names of the fields held by the table."""
+        return sorted(self._columns.keys())
+
+    def column(self, name):
+        """Get a :class:`Column`, or ``None`` if no row has the field.
+        Raises ``NotImplementedError`` for fields the table left out.
+        """
+        if self.fields is not None and name not in self.fields:
+            raise NotImplementedError("Field %s was left out of the table"
+                                      % name)
+        return self._columns.get(name)
+
+    def select(self, sel):
+        """Boolean mask of rows matching the selector."""
+        return evaluate(self, sel)
+
+
+def flatten_document(doc, prefix='', skip=None, arrays=None):
+    """Yield ``(dotted name, value)`` for every scalar field of a document,
+    including explicit nulls (as ``None``). Lists and the ``skip`` field are
+    left out; the names of lists are added to the ``arrays`` set, if given.
+    """
+    for k, v in doc.items():
+        name = prefix + k
+        if name == skip:
+            continue
+        if isinstance(v, dict):
+            for item in flatten_document(v, prefix=name + '.', skip=skip,
+                                         arrays=arrays):
+                yield item
+        elif isinstance(v, (list, tuple)):
+            if arrays is not None:
+                arrays.add(name)
+        else:
+            yield name, v
+
+
+class Column(object):
+    """One field of a columnar table.
+
+    Parameters
+    ----------
+    values : ndarray
+        Value of each row. For text columns, indices into ``categories``.
+    present : ndarray
+        Boolean array, ``True`` where the row has a (non-null) value.
+    categories : ndarray
+        Sorted unicode array of the distinct values of a text column
+        (dictionary encoding), or ``None``.
+    null : ndarray
+        Optional boolean array, ``True`` where the row has the field set to
+        null.
+    kind : str
+        Type of the values (see :func:`value_kind`). By default it follows
+        from ``values`` and ``categories``; text encoded ObjectIds and
+        values of other types must be given as ``'o'`` and ``'x'``.
+    """
+    def __init__(self, values, present, categories=None, null=None,
+                 kind=None):
+        super(Column, self).__init__()
+        self.values = values
+        self.present = present
+        self.categories = categories
+        self.null = null
+        if kind is None:
+            if categories is not None:
+                kind = 'U'
+            elif values.dtype.kind in 'iuf':
+                kind = 'n'
+            else:
+                kind = values.dtype.kind
+        self.kind = kind
+
+    @property
+    def parts(self):
+        """Columns of a single type making up this column."""
+        return [self]
+
+    @property
+    def exists(self):
+        """Boolean array, ``True`` where the row has the field, even if it
+        is null.
+        """
+        if self.null is None:
+            return np.asarray(self.present, dtype=bool)
+        return self.present | self.null
+
+    def comparable(self, value):
+        """Whether a scalar can match entries of this column."""
+        if isinstance(value, (dict, list, tuple)):
+            raise NotImplementedError("Matching embedded documents or arrays "
+                                      "is not supported")
+        kind = value_kind(value)
+        if kind == 'x':
+            raise NotImplementedError("Matching %s values is not supported"
+                                      % type(value).__name__)
+        return kind == self.kind
+
+    def _encode(self, value):
+        """A comparable scalar as stored in the column."""
+        if self.kind == 'o':
+            return u'%s' % value
+        return value
+
+    def _code(self, value):
+        """Category index of a text value, or -1."""
+        value = self._encode(value)
+        i = int(np.searchsorted(self.categories, value))
+        if i < len(self.categories) and self.categories[i] == value:
+            return i
+        return -1
+
+    def equals(self, value):
+        """Mask of rows equal to a comparable scalar."""
+        if self.categories is not None:
+            return (self.values == self._code(value)) & self.present
+        return (self.values == value) & self.present
+
+    def isin(self, values):
+        """Mask of rows equal to any of the comparable scalars."""
+        if self.categories is not None:
+            codes = [self._code(v) for v in values]
+            values = [c for c in codes if c >= 0]
+            if not values:
+                return np.zeros(len(self.present), dtype=bool)
+        return _isin_values(self.values, np.array(values)) & self.present
+
+    def compare(self, op, value):
+        """Mask of rows for which ``op(row, value)`` is true."""
+        if self.categories is not None:
+            # Categories are sorted, so compare their order; the hex text of
+            # ObjectIds sorts as they do
+            matches = op(self.categories, self._encode(value))
+            return matches[self.values] & self.present
+        return op(self.values, value) & self.present
+
+    def decode(self, index):
+        """Python values at the given rows (``None`` where missing or
+        null).
+        """
+        values = self.values[index]
+        if self.categories is not None:
+            values = self.categories[values]
+        values = values.tolist()
+        if self.kind == 'o':
+            values = [ObjectId(v) for v in values]
+        return [v if p else None for v, p
+                in zip(values, self.present[index].tolist())]
+
+
+class MixedColumn(object):
+    """A field holding values of several types, as one :class:`Column` per
+    type whose ``present`` flags the rows of that type.
+
+    Parameters
+    ----------
+    parts : list
+        Single-type :class:`Column` of each type.
+    null : ndarray
+        Optional boolean array, ``True`` where the field is null.
+    """
+    def __init__(self, parts, null=None):
+        super(MixedColumn, self).__init__()
+        self.parts = list(parts)
+        self.null = null
+
+    @property
+    def present(self):
+        """Boolean array, ``True`` where the row has a (non-null) value."""
+        present = np.zeros(len(self.parts[0].present), dtype=bool)
+        for part in self.parts:
+            present |= part.present
+        return present
+
+    @property
+    def exists(self):
+        """Boolean array, ``True`` where the row has the field."""
+        if self.null is None:
+            return self.present
+        return self.present | self.null
+
+    def decode(self, index):
+        """Python values at the given rows (``None`` where missing or
+        null).
+        """
+        values = [None] * len(index)
+        for part in self.parts:
+            for i, v in enumerate(part.decode(index)):
+                if v is not None:
+                    values[i] = v
+        return values
+
+
+def value_kind(value):
+    """Type bracket of a scalar: ``'b'`` (boolean), ``'n'`` (number),
+    ``'U'`` (text), ``'o'`` (ObjectId) or ``'x'`` (any other type).
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return 'b'
+    elif isinstance(value, (numbers.Number, np.number)):
+        return 'n'
+    elif isinstance(value, str):
+        return 'U'
+    elif isinstance(value, ObjectId):
+        return 'o'
+    return 'x'
+
+
+def make_column(n_rows, rows, values):
+    """Make a column holding ``values`` at ``rows``.
+
+    Booleans, integers and floats keep their type (integers are promoted to
+    float if mixed with floats); text, ObjectIds and values of any other
+    type are stored as dictionary encoded unicode text, in a part of their
+    own. ``None`` values are recorded as nulls. A field with values of
+    several types becomes a :class:`MixedColumn`.
+    """
+    null = None
+    groups = {}  # kind: (rows, values)
+    for i, v in zip(rows, values):
+        if v is None:
+            if null is None:
+                null = np.zeros(n_rows, dtype=bool)
+            null[i] = True
+            continue
+        r, vs = groups.setdefault(value_kind(v), ([], []))
+        r.append(i)
+        vs.append(v)
+    parts = [_make_part(n_rows, r, vs, kind)
+             for kind, (r, vs) in sorted(groups.items())]
+    if len(parts) == 1:
+        parts[0].null = null
+        return parts[0]
+    elif not parts:
+        return Column(np.zeros(n_rows, dtype=bool),
+                      np.zeros(n_rows, dtype=bool), null=null)
+    return MixedColumn(parts, null=null)
+
+
+def _make_part(n_rows, rows, values, kind):
+    """Make a :class:`Column` of values of one type bracket."""
+    present = np.zeros(n_rows, dtype=bool)
+    present[rows] = True
+    categories = None
+    if kind == 'b':
+        data = np.zeros(n_rows, dtype=bool)
+    elif kind == 'n' and all(isinstance(v, (numbers.Integral, np.integer))
+                             for v in values):
+        data = np.zeros(n_rows, dtype=np.int64)
+    elif kind == 'n':
+        data = np.zeros(n_rows, dtype=np.float64)
+    else:
+        text = np.array([u'%s' % v for v in values])
+        categories, values = np.unique(text, return_inverse=True)
+        data = np.zeros(n_rows, dtype=np.int32)
+    data[rows] = values
+    return Column(data, present, categories=categories, kind=kind)
+
+
+def evaluate(table, sel):
+    """Evaluate a selector into a boolean mask over a table's rows.
+
+    Parameters
+    ----------
+    table : object
+        Anything with an ``n_rows`` attribute, an ``array_fields`` set and a
+        ``column(name)`` method returning a :class:`Column` or ``None``,
+        such as a :class:`ColumnTable` or
+        :class:`andromap.snapshot.SnapshotCollection`.
+    sel : dict
+        Mongo selector.
+
+    Returns
+    -------
+    mask : ndarray
+        Boolean array, ``True`` for matching rows.
+    """
+    mask = np.ones(table.n_rows, dtype=bool)
+    for name, cond in sel.items():
+        if name == '$and':
+            for s in cond:
+                mask &= evaluate(table, s)
+        elif name == '$or':
+            m = np.zeros(table.n_rows, dtype=bool)
+            for s in cond:
+                m |= evaluate(table, s)
+            mask &= m
+        elif name == '$nor':
+            for s in cond:
+                mask &= ~evaluate(table, s)
+        elif name.startswith('$'):
+            raise NotImplementedError("Unsupported query operator %s" % name)
+        else:
+            mask &= _evaluate_field(table, name, cond)
+    return mask
+
+
+def _evaluate_field(table, name, cond):
+    path = name.split('.')
+    for i in range(1, len(path) + 1):
+        if '.'.join(path[:i]) in table.array_fields:
+            raise NotImplementedError("Field %s holds arrays"
+                                      % '.'.join(path[:i]))
+    col = table.column(name)
+    n = table.n_rows
+    if not (isinstance(cond, dict) and cond
+            and all(k.startswith('$') for k in cond)):
+        return _equals(col, cond, n)
+    mask = np.ones(n, dtype=bool)
+    for op, arg in cond.items():
+        if op == '$eq':
+            mask &= _equals(col, arg, n)
+        elif op == '$ne':
+            mask &= ~_equals(col, arg, n)
+        elif op == '$in':
+            mask &= _isin(col, arg, n)
+        elif op == '$nin':
+            mask &= ~_isin(col, arg, n)
+        elif op == '$exists':
+            if arg:
+                mask &= _exists(col, n)
+            else:
+                mask &= ~_exists(col, n)
+        elif op in COMPARISONS:
+            mask &= _compare(col, arg, n, COMPARISONS[op])
+        else:
+            raise NotImplementedError("Unsupported query operator %s" % op)
+    return mask
+
+
+def _present(col, n):
+    """Rows with a non-null value of the field."""
+    if col is None:
+        return np.zeros(n, dtype=bool)
+    return np.asarray(col.present, dtype=bool)
+
+
+def _exists(col, n):
+    """Rows that have the field, null or not."""
+    if col is None:
+        return np.zeros(n, dtype=bool)
+    return np.asarray(col.exists, dtype=bool)
+
+
+def _equals(col, value, n):
+    if value is None:
+        return ~_present(col, n)
+    mask = np.zeros(n, dtype=bool)
+    if col is None:
+        return mask
+    for part in col.parts:
+        if part.comparable(value):
+            mask |= part.equals(value)
+    return mask
+
+
+def _isin(col, args, n):
+    mask = np.zeros(n, dtype=bool)
+    args = list(args)
+    if any(a is None for a in args):
+        mask |= ~_present(col, n)
+    if col is None:
+        return mask
+    for part in col.parts:
+        candidates = [a for a in args
+                      if a is not None and part.comparable(a)]
+        if candidates:
+            mask |= part.isin(candidates)
+    return mask
+
+
+def _compare(col, value, n, op):
+    mask = np.zeros(n, dtype=bool)
+    if col is None or value is None:
+        return mask
+    for part in col.parts:
+        if part.comparable(value):
+            mask |= part.compare(op, value)
+    return mask
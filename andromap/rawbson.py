@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Decode polygon vertices directly from raw BSON batches.
+
+``Collection.find_raw_batches`` hands back each server batch as the raw bytes
+of its concatenated BSON documents. The decoder here walks those bytes and
+copies the ``[[ra, dec], ...]`` vertex arrays straight into a float64 buffer,
+so no Python dict, list or float is built per vertex. Only the top-level
+elements of each document are walked in Python; vertex positions are
+derived from the array length and checked, and all coordinates of a batch
+are gathered, with vectorized NumPy indexing. Vertex arrays written by the
+image log pipelines are lists of two doubles; arrays in any other layout
+fall back to a slower per-vertex path.
+"""
+
+import struct
+
+import numpy as np
+from bson.objectid import ObjectId
+
+
+# BSON element type codes
+_DOUBLE = 1
+_STRING = 2
+_DOCUMENT = 3
+_ARRAY = 4
+_BINARY = 5
+_UNDEFINED = 6
+_OBJECTID = 7
+_BOOLEAN = 8
+_DATETIME = 9
+_NULL = 10
+_REGEX = 11
+_DBPOINTER = 12
+_CODE = 13
+_SYMBOL = 14
+_CODE_W_SCOPE = 15
+_INT32 = 16
+_TIMESTAMP = 17
+_INT64 = 18
+_DECIMAL128 = 19
+_MINKEY = 255
+_MAXKEY = 127
+
+_FIXED_SIZES = {_DOUBLE: 8, _UNDEFINED: 0, _OBJECTID: 12, _BOOLEAN: 1,
+                _DATETIME: 8, _NULL: 0, _INT32: 4, _TIMESTAMP: 8,
+                _INT64: 8, _DECIMAL128: 16, _MINKEY: 0, _MAXKEY: 0}
+
+# Layout of a vertex sub-document {"0": x, "1": y} holding two doubles:
+# int32 length, type, "0\x00", x, type, "1\x00", y, terminating null.
+_VERTEX_DOC_LEN = 27
+_VERTEX_DOC_HEAD = np.frombuffer(
+    struct.pack('<iB', _VERTEX_DOC_LEN, 1) + b'0\x00', dtype=np.uint8)
+_VERTEX_DOC_MID = np.frombuffer(b'\x011\x00', dtype=np.uint8)
+_X_OFFSET = 7  # from the start of the sub-document to x
+_Y_OFFSET = 18  # from the start of the sub-document to y
+
+# When every vertex is laid out as above, the element of vertex i takes
+# 1 (type) + len(str(i)) + 1 (null) + 27 bytes, so the length of the whole
+# array determines the vertex count and every vertex position.
+_MAX_FAST_VERTS = 4096
+_KEY_DIGITS = np.array([len(str(i)) for i in range(_MAX_FAST_VERTS)],
+                       dtype=np.intp)
+_ELEMENT_START = np.zeros(_MAX_FAST_VERTS + 1, dtype=np.intp)
+np.cumsum(_KEY_DIGITS + 2 + _VERTEX_DOC_LEN, out=_ELEMENT_START[1:])
+# Array byte length (int32 length + elements + null) -> vertex count
+_FAST_ARRAY_COUNTS = dict((int(l) + 5, n)
+                          for n, l in enumerate(_ELEMENT_START))
+
+_int32 = struct.Struct('<i')
+_int64 = struct.Struct('<q')
+_double = struct.Struct('<d')
+_BYTE_RANGE = np.arange(8)
+
+
+class VertexBuffer(object):
+    """Growable, contiguous ``(N, 2)`` float64 vertex buffer.
+
+    Capacity is reserved once per batch, so appending a batch reallocates at
+    most once, and grows geometrically.
+    """
+    def __init__(self, capacity=1024):
+        super(VertexBuffer, self).__init__()
+        self._data = np.empty((max(capacity, 1), 2), dtype=np.float64)
+        self.size = 0
+
+    def reserve(self, n):
+        """Ensure room for ``n`` more vertices."""
+        needed = self.size + n
+        if needed > len(self._data):
+            capacity = max(needed, 2 * len(self._data))
+            data = np.empty((capacity, 2), dtype=np.float64)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+
+    def compact(self):
+        """Release unused capacity."""
+        if len(self._data) > self.size:
+            self._data = self._data[:max(self.size, 1)].copy()
+
+    @property
+    def data(self):
+        """Writable view of the whole allocated buffer."""
+        return self._data
+
+    @property
+    def vertices(self):
+        """View of the filled ``(N, 2)`` vertices."""
+        return self._data[:self.size]
+
+
+def _cstring_end(data, pos):
+    return data.index(b'\x00', pos)
+
+
+def _element_size(data, etype, pos):
+    """Number of bytes taken by an element value starting at ``pos``."""
+    try:
+        return _FIXED_SIZES[etype]
+    except KeyError:
+        pass
+    if etype in (_STRING, _CODE, _SYMBOL):
+        return 4 + _int32.unpack_from(data, pos)[0]
+    elif etype in (_DOCUMENT, _ARRAY, _CODE_W_SCOPE):
+        return _int32.unpack_from(data, pos)[0]
+    elif etype == _BINARY:
+        return 5 + _int32.unpack_from(data, pos)[0]
+    elif etype == _REGEX:
+        end = _cstring_end(data, _cstring_end(data, pos) + 1)
+        return end + 1 - pos
+    elif etype == _DBPOINTER:
+        return 4 + _int32.unpack_from(data, pos)[0] + 12
+    raise ValueError("Unknown BSON element type %i" % etype)
+
+
+def _decode_scalar(data, etype, pos):
+    """Decode a scalar element value, or return ``None``."""
+    if etype == _STRING:
+        n = _int32.unpack_from(data, pos)[0]
+        return data[pos + 4:pos + 3 + n].decode('utf-8')
+    elif etype == _OBJECTID:
+        return ObjectId(bytes(data[pos:pos + 12]))
+    elif etype == _INT32:
+        return _int32.unpack_from(data, pos)[0]
+    elif etype == _INT64:
+        return _int64.unpack_from(data, pos)[0]
+    elif etype == _DOUBLE:
+        return _double.unpack_from(data, pos)[0]
+    elif etype == _BOOLEAN:
+        return data[pos:pos + 1] != b'\x00'
+    return None
+
+
+def _decode_number(data, etype, pos):
+    if etype == _DOUBLE:
+        return _double.unpack_from(data, pos)[0]
+    elif etype == _INT32:
+        return float(_int32.unpack_from(data, pos)[0])
+    elif etype == _INT64:
+        return float(_int64.unpack_from(data, pos)[0])
+    raise ValueError("Vertex coordinate has non-numeric BSON type %i"
+                     % etype)
+
+
+def _iter_elements(data, start, end):
+    """Yield ``(etype, key, value_pos, value_size)`` of a document's
+    elements, where ``start`` is the document's first byte and ``end`` its
+    terminating null.
+    """
+    pos = start + 4
+    while pos < end:
+        etype = ord(data[pos:pos + 1])
+        key_end = _cstring_end(data, pos + 1)
+        key = data[pos + 1:key_end]
+        value_pos = key_end + 1
+        size = _element_size(data, etype, value_pos)
+        yield etype, key, value_pos, size
+        pos = value_pos + size
+
+
+def _decode_vertex_array(data, start):
+    """Decode the BSON vertex array at ``start`` element by element.
+
+    This is the fallback for arrays that are not a plain list of
+    ``[double, double]`` pairs. Returns a list of ``(x, y)`` tuples.
+    """
+    end = start + _int32.unpack_from(data, start)[0] - 1
+    verts = []
+    for etype, key, pos, size in _iter_elements(data, start, end):
+        if etype != _ARRAY:
+            raise ValueError("Vertex is not an array")
+        coords = [_decode_number(data, t, p) for t, k, p, s
+                  in _iter_elements(data, pos, pos + size - 1)]
+        verts.append((coords[0], coords[1]))
+    return verts
+
+
+def _fast_vertex_positions(raw, array_pos, counts):
+    """Byte positions of each vertex sub-document, for arrays assumed to be
+    in the fast layout, plus a per-array flag confirming that layout.
+    """
+    total = counts.sum()
+    first = np.zeros(len(counts), dtype=np.intp)
+    np.cumsum(counts[:-1], out=first[1:])
+    index = np.arange(total) - np.repeat(first, counts)
+    element = np.repeat(array_pos + 4, counts) + _ELEMENT_START[index]
+    doc = element + _KEY_DIGITS[index] + 2
+    ok = raw[element] == _ARRAY
+    ok &= raw[element + 2 + _KEY_DIGITS[index] - 1] == 0
+    for i, b in enumerate(_VERTEX_DOC_HEAD):
+        ok &= raw[doc + i] == b
+    for i, b in enumerate(_VERTEX_DOC_MID):
+        ok &= raw[doc + 15 + i] == b
+    # An array is in the fast layout only if all of its vertices are
+    array_ok = np.ones(len(counts), dtype=bool)
+    bad = np.nonzero(~ok)[0]
+    if len(bad):
+        array_ok[np.searchsorted(first, bad, side='right') - 1] = False
+    return doc, array_ok
+
+
+def decode_vertex_batch(data, poly_key, key_fields, buf, close=True):
+    """Decode one raw BSON batch into a :class:`VertexBuffer`.
+
+    Parameters
+    ----------
+    data : bytes
+        Concatenated BSON documents, as yielded by ``find_raw_batches``.
+    poly_key : str
+        Field holding the ``[[x, y], ...]`` vertex array. Documents without
+        it are skipped.
+    key_fields : list
+        Top-level (or dotted) fields to decode for each document, e.g.
+        ``['_id']``. Missing fields decode as ``None``.
+    buf : :class:`VertexBuffer`
+        Buffer that the vertices are appended to.
+    close : bool
+        Append the first vertex to the end of each polygon, as
+        :func:`andromap.polytools.close_vertices` does.
+
+    Returns
+    -------
+    keys : list
+        One tuple of ``key_fields`` values per decoded polygon.
+    counts : list
+        Number of vertices of each decoded polygon (including the closing
+        vertex).
+    """
+    poly_key = poly_key.encode('utf-8')
+    paths = [tuple(f.encode('utf-8').split(b'.')) for f in key_fields]
+    top_keys = set(p[0] for p in paths)
+    raw = np.frombuffer(data, dtype=np.uint8)
+    bdata = bytearray(data)
+    unpack_int32 = _int32.unpack_from
+    find = data.index
+    keys = []
+    array_pos = []
+    counts = []
+    pos = 0
+    n_data = len(data)
+    while pos < n_data:
+        doc_len = unpack_int32(data, pos)[0]
+        end = pos + doc_len - 1
+        p = pos + 4
+        values = {}
+        poly_pos = None
+        while p < end:
+            etype = bdata[p]
+            key_end = find(b'\x00', p + 1)
+            key = data[p + 1:key_end]
+            vpos = key_end + 1
+            if etype == _ARRAY or etype == _DOCUMENT:
+                size = unpack_int32(data, vpos)[0]
+            elif etype == _STRING:
+                size = 4 + unpack_int32(data, vpos)[0]
+            else:
+                size = _element_size(data, etype, vpos)
+            if key == poly_key and etype == _ARRAY:
+                poly_pos = vpos
+            elif key in top_keys:
+                _collect_keys(data, etype, (key,), vpos, size, paths, values)
+            p = vpos + size
+        if poly_pos is not None:
+            n = _FAST_ARRAY_COUNTS.get(_int32.unpack_from(data, poly_pos)[0],
+                                       -1)
+            if n != 0:
+                keys.append(tuple(values.get(k) for k in paths))
+                array_pos.append(poly_pos)
+                counts.append(n)
+        pos += doc_len
+
+    array_pos = np.array(array_pos, dtype=np.intp)
+    counts = np.array(counts, dtype=np.intp)
+    # Arrays whose length matches the fast layout are checked and gathered
+    # in bulk; everything else is decoded element by element.
+    fast = counts > 0
+    if fast.any():
+        fast_counts = counts[fast]
+        doc, fast_ok = _fast_vertex_positions(raw, array_pos[fast],
+                                              fast_counts)
+        doc = doc[np.repeat(fast_ok, fast_counts)]
+        fast[fast] = fast_ok
+    slow = [_decode_vertex_array(data, a) for a in array_pos[~fast]]
+    counts[~fast] = [len(v) for v in slow]
+
+    # Lay the polygons out contiguously after what is already in the buffer
+    sizes = counts + 1 if close else counts.copy()
+    out_start = np.zeros(len(counts), dtype=np.intp)
+    np.cumsum(sizes[:-1], out=out_start[1:])
+    out_start += buf.size
+    buf.reserve(int(sizes.sum()))
+    out = buf.data
+    if fast.any():
+        # Gather every [x, y] double pair of the batch with one fancy index
+        fc = counts[fast]
+        out_idx = np.repeat(out_start[fast] - (np.cumsum(fc) - fc), fc) \
+            + np.arange(fc.sum())
+        doc = doc[:, np.newaxis]
+        byte_idx = np.hstack((doc + _X_OFFSET + _BYTE_RANGE,
+                              doc + _Y_OFFSET + _BYTE_RANGE))
+        out[out_idx] = raw[byte_idx].view('<f8')
+    for start, verts in zip(out_start[~fast], slow):
+        if len(verts):
+            out[start:start + len(verts)] = verts
+    if close:
+        out[out_start + counts] = out[out_start]
+    if len(sizes):
+        buf.size = int(out_start[-1] + sizes[-1])
+    return keys, [int(n) for n in sizes]
+
+
+def _collect_keys(data, etype, path, pos, size, paths, values):
+    """Decode the element at ``path`` if it, or something beneath it, is one
+    of the requested key ``paths``.
+    """
+    for p in paths:
+        if p == path:
+            values[p] = _decode_scalar(data, etype, pos)
+        elif etype == _DOCUMENT and p[:len(path)] == path:
+            end = pos + size - 1
+            for t, k, vpos, s in _iter_elements(data, pos, end):
+                _collect_keys(data, t, path + (k,), vpos, s, paths, values)
+            return
@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Offline snapshots of the image log.
+
+A snapshot is a directory holding, for each exported collection, every
+polygon's vertices in one float64 ``(N, 2)`` array with an offsets index, and
+the documents' scalar header fields as one NumPy array per column (text is
+dictionary encoded, see :mod:`andromap.query`). All arrays are ``.npy``
+files opened memory-mapped, so a snapshot opens without reading its data
+and maps can be rendered without a MongoDB server::
+
+    export_snapshot('~/andromap/imagelog')          # where Mongo is running
+    use_backend(SnapshotBackend('~/andromap/imagelog'))   # anywhere else
+"""
+
+import os
+import json
+import logging
+
+import numpy as np
+from shapely.geometry import Polygon
+
+from .connection import get_connection
+from .footprintset import FootprintSet, normalize_rings
+from .rawbson import VertexBuffer
+from .query import Column, MixedColumn, evaluate, flatten_document, \
+    make_column
+
+
+SNAPSHOT_VERSION = 3
+# Older versions that can still be read
+READABLE_VERSIONS = (2, 3)
+
+# Field holding the polygon vertices in each collection
+POLY_KEYS = {'images': 'footprint', 'footprints': 'radec_poly'}
+
+
+def export_snapshot(path, kinds=('images', 'footprints'), fields=None,
+                    sel=None):
+    """Export image log collections from MongoDB into a snapshot.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the snapshot. It is created if necessary and existing
+        collections in it are overwritten.
+    kinds : list
+        Collection roles to export (see :mod:`andromap.connection`).
+    fields : list
+        Header fields (dotted for nested fields) to export. By default every
+        scalar field found in the documents is exported.
+    sel : dict
+        Optional Mongo selector restricting the exported documents.
+    """
+    conn = get_connection()
+    for kind in kinds:
+        docs = conn.collection(kind).find(sel or {})
+        write_snapshot_collection(path, kind, docs, POLY_KEYS[kind],
+                                  fields=fields)
+
+
+def write_snapshot_collection(path, kind, docs, poly_key, fields=None):
+    """Write documents as one collection of a snapshot.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the snapshot.
+    kind : str
+        Collection role, e.g. ``'images'``.
+    docs : iterable
+        Documents (dicts), e.g. a Mongo cursor.
+    poly_key : str
+        Document field holding the ``[[x, y], ...]`` polygon vertices.
+        Polygons are stored normalized, as
+        :func:`andromap.footprintset.normalize_rings` makes them. Documents
+        without a polygon are kept (with no vertices).
+    fields : list
+        Header fields to export; by default all scalar fields. ``_id`` is
+        always exported. Selectors on fields left out raise
+        ``NotImplementedError`` rather than match as if they were missing.
+    """
+    log = logging.getLogger('andromap')
+    if fields is not None:
+        fields = set(fields) | set(['_id'])
+    path = os.path.expanduser(path)
+    coll_dir = os.path.join(path, kind)
+    col_dir = os.path.join(coll_dir, 'columns')
+    if not os.path.exists(col_dir):
+        os.makedirs(col_dir)
+
+    buf = VertexBuffer()
+    counts = []
+    columns = {}  # name: (row indices, values)
+    arrays = set()
+    for i, doc in enumerate(docs):
+        poly = doc.get(poly_key)
+        n = 0
+        if poly:
+            verts = np.asarray(poly, dtype=np.float64).reshape(-1, 2)
+            n = len(verts)
+            buf.reserve(n)
+            buf.data[buf.size:buf.size + n] = verts
+            buf.size += n
+        counts.append(n)
+        for name, value in flatten_document(doc, skip=poly_key,
+                                            arrays=arrays):
+            if fields is not None and name not in fields:
+                continue
+            rows, values = columns.setdefault(name, ([], []))
+            rows.append(i)
+            values.append(value)
+    n_docs = len(counts)
+
+    offsets = np.zeros(n_docs + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    vertices, offsets = normalize_rings(buf.vertices, offsets)
+    np.save(os.path.join(coll_dir, 'vertices.npy'), vertices)
+    np.save(os.path.join(coll_dir, 'offsets.npy'),
+            offsets.astype(np.int64))
+    dtypes = {}
+    nulls = []
+    for name, (rows, values) in columns.items():
+        col = make_column(n_docs, rows, values)
+        if isinstance(col, MixedColumn):
+            # One set of files per type, e.g. OBJECT.part1.npy
+            dtypes[name] = [_save_column(col_dir, '%s.part%i' % (name, i),
+                                         part)
+                            for i, part in enumerate(col.parts)]
+        else:
+            dtypes[name] = _save_column(col_dir, name, col)
+        if col.null is not None:
+            np.save(os.path.join(col_dir, name + '.null.npy'), col.null)
+            nulls.append(name)
+
+    meta = _read_meta(path)
+    meta['version'] = SNAPSHOT_VERSION
+    meta['collections'][kind] = {'poly_key': poly_key, 'n_docs': n_docs,
+                                 'n_vertices': int(offsets[-1]),
+                                 'columns': dtypes, 'nulls': sorted(nulls),
+                                 'arrays': sorted(arrays),
+                                 'fields': (None if fields is None
+                                            else sorted(fields))}
+    with open(os.path.join(path, 'snapshot.json'), 'w') as f:
+        f.write(json.dumps(meta, indent=2, sort_keys=True))
+    log.debug("Wrote %i %s documents to snapshot %s" % (n_docs, kind, path))
+
+
+# Labels of dictionary encoded columns, by value kind
+TEXT_LABELS = {'U': 'text', 'o': 'objectid', 'x': 'other'}
+
+
+def _save_column(col_dir, name, col):
+    """Save the arrays of a single-type column; returns its dtype label."""
+    np.save(os.path.join(col_dir, name + '.npy'), col.values)
+    np.save(os.path.join(col_dir, name + '.present.npy'), col.present)
+    if col.categories is not None:
+        np.save(os.path.join(col_dir, name + '.categories.npy'),
+                col.categories)
+        return TEXT_LABELS[col.kind]
+    return col.values.dtype.str
+
+
+def _load_column(col_dir, name, dtype):
+    """Open the arrays of a single-type column, memory-mapped."""
+    values = np.load(os.path.join(col_dir, name + '.npy'), mmap_mode='r')
+    present = np.load(os.path.join(col_dir, name + '.present.npy'),
+                      mmap_mode='r')
+    categories = None
+    kind = None
+    for k, label in TEXT_LABELS.items():
+        if dtype == label:
+            categories = np.load(os.path.join(col_dir,
+                                              name + '.categories.npy'))
+            kind = k
+    return Column(values, present, categories=categories, kind=kind)
+
+
+def _read_meta(path):
+    meta_path = os.path.join(path, 'snapshot.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.loads(f.read())
+        if meta.get('version') not in READABLE_VERSIONS:
+            raise ValueError("Unsupported snapshot version %s"
+                             % meta.get('version'))
+        return meta
+    return {'version': SNAPSHOT_VERSION, 'collections': {}}
+
+
+class SnapshotCollection(object):
+    """One memory-mapped collection of a snapshot.
+
+    Vertices of document ``i`` are ``vertices[offsets[i]:offsets[i + 1]]``.
+    Columns are loaded (memory-mapped) on first use.
+    """
+    def __init__(self, path, kind, meta):
+        super(SnapshotCollection, self).__init__()
+        self.kind = kind
+        self.poly_key = meta['poly_key']
+        self.n_docs = meta['n_docs']
+        self._dir = os.path.join(path, kind)
+        self._dtypes = meta['columns']
+        self._nulls = set(meta.get('nulls', ()))
+        self.array_fields = set(meta.get('arrays', ()))
+        # Fields the export was restricted to, or None for all fields
+        self.fields = meta.get('fields')
+        self._columns = {}
+        self._bboxes = None
+        self.vertices = np.load(os.path.join(self._dir, 'vertices.npy'),
+                                mmap_mode='r')
+        self.offsets = np.load(os.path.join(self._dir, 'offsets.npy'),
+                               mmap_mode='r')
+
+    @property
+    def column_names(self):
+        """Names of the exported header fields."""
+        return sorted(self._dtypes.keys())
+
+    @property
+    def n_rows(self):
+        """Number of documents."""
+        return self.n_docs
+
+    def column(self, name):
+        """Get a :class:`andromap.query.Column`, or ``None`` if no document
+        has the field.
+
+        The polygon field is only represented by its presence. Raises
+        ``NotImplementedError`` for fields the snapshot did not export.
+        """
+        if name == self.poly_key:
+            has = self.has_polygon
+            return Column(np.zeros(len(has), dtype=bool), has)
+        if name not in self._dtypes:
+            if self.fields is not None and name not in self.fields:
+                raise NotImplementedError("Snapshot %s collection did not "
+                                          "export field %s"
+                                          % (self.kind, name))
+            return None
+        if name not in self._columns:
+            col_dir = os.path.join(self._dir, 'columns')
+            dtype = self._dtypes[name]
+            if isinstance(dtype, list):
+                col = MixedColumn([_load_column(col_dir,
+                                                '%s.part%i' % (name, i), d)
+                                   for i, d in enumerate(dtype)])
+            else:
+                col = _load_column(col_dir, name, dtype)
+            if name in self._nulls:
+                col.null = np.load(os.path.join(col_dir, name + '.null.npy'),
+                                   mmap_mode='r')
+            self._columns[name] = col
+        return self._columns[name]
+
+    @property
+    def has_polygon(self):
+        """Boolean array flagging documents that have a polygon."""
+        return np.diff(self.offsets) > 0
+
+    def polygon(self, i):
+        """Zero-copy view of the vertices of document ``i``."""
+        return self.vertices[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def bboxes(self):
+        """``(n_docs, 4)`` array of ``[xmin, xmax, ymin, ymax]`` of each
+        document's polygon (NaN where there is no polygon).
+        """
+        if self._bboxes is None:
+            bboxes = np.empty((self.n_docs, 4))
+            bboxes.fill(np.nan)
+            has = self.has_polygon
+            if has.any():
+                starts = np.asarray(self.offsets[:-1])[has]
+                x = np.asarray(self.vertices[:, 0])
+                y = np.asarray(self.vertices[:, 1])
+                bboxes[has, 0] = np.minimum.reduceat(x, starts)
+                bboxes[has, 1] = np.maximum.reduceat(x, starts)
+                bboxes[has, 2] = np.minimum.reduceat(y, starts)
+                bboxes[has, 3] = np.maximum.reduceat(y, starts)
+            self._bboxes = bboxes
+        return self._bboxes
+
+    def values(self, name, index):
+        """Python values of a column at the given rows (``None`` where the
+        field is missing). Booleans, numbers, text and ObjectIds come back
+        as the types Mongo returns; values of other types (such as dates)
+        come back as text.
+        """
+        col = self.column(name)
+        if col is None:
+            return [None] * len(index)
+        return col.decode(index)
+
+    def select(self, sel):
+        """Boolean mask of documents matching a Mongo selector (see
+        :mod:`andromap.query` for the supported operators).
+        """
+        return evaluate(self, sel)
+
+
+class Snapshot(object):
+    """A snapshot directory written by :func:`export_snapshot`.
+
+    Opening a snapshot only reads its ``snapshot.json``; arrays are
+    memory-mapped as they are needed.
+    """
+    def __init__(self, path):
+        super(Snapshot, self).__init__()
+        self.path = os.path.expanduser(path)
+        self._meta = _read_meta(self.path)
+        self._collections = {}
+
+    @property
+    def kinds(self):
+        """Collection roles held by the snapshot."""
+        return sorted(self._meta['collections'].keys())
+
+    def collection(self, kind):
+        """Get a :class:`SnapshotCollection` by its role."""
+        if kind not in self._collections:
+            try:
+                meta = self._meta['collections'][kind]
+            except KeyError:
+                raise KeyError("Snapshot %s has no %s collection"
+                               % (self.path, kind))
+            self._collections[kind] = SnapshotCollection(self.path, kind,
+                                                         meta)
+        return self._collections[kind]
+
+
+class SnapshotBackend(object):
+    """Image log backend answering queries from a :class:`Snapshot`.
+
+    Install it with :func:`andromap.imagelogfootprints.use_backend`.
+
+    Parameters
+    ----------
+    snapshot : str or :class:`Snapshot`
+        Snapshot, or the path to one.
+    """
+    def __init__(self, snapshot):
+        super(SnapshotBackend, self).__init__()
+        if not isinstance(snapshot, Snapshot):
+            snapshot = Snapshot(snapshot)
+        self.snapshot = snapshot
+        self._log = logging.getLogger('andromap')
+
+    def _select(self, coll, sel, poly_key):
+        if poly_key != coll.poly_key:
+            raise ValueError("Snapshot %s polygons are stored from %s, not %s"
+                             % (coll.kind, coll.poly_key, poly_key))
+        mask = coll.select(sel)
+        mask &= coll.has_polygon
+        return np.nonzero(mask)[0]
+
+    def _in_region(self, coll, index, region, within):
+        """Filter rows by a region with planar tests in RA, Dec, which is
+        adequate for regions (and footprints) far from the poles and less
+        than 180 degrees wide. Regions and footprints that cross RA = 0 are
+        unwrapped, and each footprint is tested at the turn of RA nearest
+        the region.
+        """
+        region = np.asarray(region, dtype=np.float64)
+        ra = np.degrees(np.unwrap(np.radians(region[:, 0])))
+        area = Polygon(np.column_stack([ra, region[:, 1]]))
+        ra_min, dec_min, ra_max, dec_max = area.bounds
+        ra_c = 0.5 * (ra_min + ra_max)
+        b = coll.bboxes[index]
+        # Footprints crossing RA = 0 span nearly 360 degrees of RA as stored
+        wraps = b[:, 1] - b[:, 0] > 180.
+        turn = 360. * np.round((ra_c - 0.5 * (b[:, 0] + b[:, 1])) / 360.)
+        near = (((b[:, 0] + turn <= ra_max) & (b[:, 1] + turn >= ra_min))
+                | wraps) & (b[:, 2] <= dec_max) & (b[:, 3] >= dec_min)
+        keep = []
+        for i in index[near]:
+            verts = np.array(coll.polygon(i))
+            verts[:, 0] = np.degrees(np.unwrap(np.radians(verts[:, 0])))
+            verts[:, 0] += 360. * np.round((ra_c - verts[:, 0].mean())
+                                           / 360.)
+            poly = Polygon(verts)
+            if area.contains(poly) if within else area.intersects(poly):
+                keep.append(i)
+        return np.array(keep, dtype=np.intp)
+
+    def fetch_polygons(self, kind, sel, poly_key='footprint',
+                       name_key='_id', group_by=None, region=None,
+                       within=False):
+        """Gather the polygons of the selected documents from the snapshot's
+        vertex array into a FootprintSet. See
+        :func:`andromap.imagelogfootprints.fetch_polygons`.
+        """
+        coll = self.snapshot.collection(kind)
+        index = self._select(coll, sel, poly_key)
+        if region is not None:
+            index = self._in_region(coll, index, region, within)
+        self._log.debug("Found %i footprints in snapshot for %s"
+                        % (len(index), str(sel)))
+        footprints = FootprintSet.from_ranges(coll.vertices,
+                                              coll.offsets[index],
+                                              coll.offsets[index + 1],
+                                              coll.values(name_key, index))
+        if group_by is None:
+            return footprints
+        return footprints.groupby(coll.values(group_by, index))
+
+    def iter_polygons(self, kind, sel, poly_key='footprint', name_key='_id',
+                      chunk_size=1000, region=None, within=False):
+        """Iterate over polygons of the selected documents in FootprintSets
+        of up to ``chunk_size``. See
+        :func:`andromap.imagelogfootprints.iter_polygons`.
+        """
+        coll = self.snapshot.collection(kind)
+        index = self._select(coll, sel, poly_key)
+        if region is not None:
+            index = self._in_region(coll, index, region, within)
+        verts = coll.vertices
+        for i in range(0, len(index), chunk_size):
+            rows = index[i:i + chunk_size]
+            yield FootprintSet.from_ranges(verts, coll.offsets[rows],
+                                           coll.offsets[rows + 1],
+                                           coll.values(name_key, rows))
+
+    def compare_with_mongo(self, sel, kind='images'):
+        """Check that a selector matches the same documents in the snapshot
+        as on the MongoDB server (which must be reachable).
+
+        Returns
+        -------
+        missing : list
+            ``_id`` (as text) of documents only Mongo matched.
+        extra : list
+            ``_id`` (as text) of documents only the snapshot matched.
+        """
+        coll = self.snapshot.collection(kind)
+        index = np.nonzero(coll.select(sel))[0]
+        local = set(u'%s' % v for v in coll.values('_id', index))
+        c = get_connection().collection(kind)
+        remote = set(u'%s' % d['_id'] for d in c.find(sel, projection=[]))
+        return sorted(remote - local), sorted(local - remote)
+
+    def field_centers(self, sel, group_by=None, poly_key='footprint'):
+        """Compute footprint centres and bounding boxes per group from the
+        snapshot. See :func:`andromap.imagelogfootprints.get_field_centers`.
+        """
+        coll = self.snapshot.collection('images')
+        index = self._select(coll, sel, poly_key)
+        if len(index) == 0:
+            return {}
+        bboxes = coll.bboxes[index]
+        if group_by is None:
+            values = [None] * len(index)
+        else:
+            values = coll.values(group_by, index)
+        groups = {}
+        for i, value in enumerate(values):
+            groups.setdefault(value, []).append(i)
+        centers = {}
+        for value, rows in groups.items():
+            b = bboxes[rows]
+            centers[value] = {
+                'ra': float((0.5 * (b[:, 0] + b[:, 1])).mean()),
+                'dec': float((0.5 * (b[:, 2] + b[:, 3])).mean()),
+                'ra_min': float(b[:, 0].min()),
+                'ra_max': float(b[:, 1].max()),
+                'dec_min': float(b[:, 2].min()),
+                'dec_max': float(b[:, 3].max()),
+                'count': len(rows)}
+        return centers
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Spatial index of image footprints for region and cone queries.
+
+Footprints are held in a shapely STRtree built over their bounding boxes;
+candidates returned by the tree are refined with exact polygon tests, so a
+query costs time proportional to the number of footprints near the region
+rather than to the size of the selection.
+"""
+
+import numpy as np
+from shapely.geometry import MultiPolygon, Point, Polygon, box
+from shapely.strtree import STRtree
+
+from .footprintcache import cached_query
+from .footprintset import FootprintSet
+from .imagelogfootprints import get_image_footprints
+from .tanproj import eq_to_tan
+
+
+def ra_boxes(ra_min, ra_max, dec_min, dec_max):
+    """Boxes covering an RA, Dec range, split at RA = 0 so that their RA
+    lie in [0, 360] as footprint vertices do.
+
+    ``ra_min`` may be negative, ``ra_max`` beyond 360, or ``ra_min`` greater
+    than ``ra_max`` for a range that crosses RA = 0 (e.g. 359 to 1).
+    """
+    width = ra_max - ra_min
+    if width < 0.:
+        width += 360.
+    if width >= 360.:
+        return [box(0., dec_min, 360., dec_max)]
+    lo = ra_min % 360.
+    hi = lo + width
+    if hi <= 360.:
+        return [box(lo, dec_min, hi, dec_max)]
+    return [box(lo, dec_min, 360., dec_max),
+            box(0., dec_min, hi - 360., dec_max)]
+
+
+class FootprintIndex(object):
+    """Spatial index over a set of footprints.
+
+    Parameters
+    ----------
+    footprints : :class:`andromap.footprintset.FootprintSet` or dict
+        Footprints by name, as returned by
+        :func:`andromap.imagelogfootprints.get_image_footprints`.
+    """
+    def __init__(self, footprints):
+        super(FootprintIndex, self).__init__()
+        self.footprints = FootprintSet.from_dict(footprints or {})
+        self._vertices = self.footprints.polygons()
+        self._polygons = [Polygon(v) for v in self._vertices]
+        self.n_vertices = self.footprints.n_vertices
+        if len(self._polygons) > 0:
+            self._tree = STRtree(self._polygons)
+        else:
+            self._tree = None
+
+    def __len__(self):
+        return len(self.footprints)
+
+    def _candidates(self, geometry):
+        """Indices of footprints whose bounding boxes intersect that of
+        ``geometry``.
+        """
+        if self._tree is None:
+            return []
+        hits = self._tree.query(geometry)
+        if isinstance(hits, np.ndarray) and hits.dtype.kind in 'iu':
+            # Shapely >= 2 returns indices
+            return hits.tolist()
+        # Shapely 1.x returns the geometries themselves
+        index = dict((id(p), i) for i, p in enumerate(self._polygons))
+        return [index[id(p)] for p in hits]
+
+    def _result(self, indices):
+        return self.footprints.subset(sorted(indices))
+
+    def query(self, geometry):
+        """Footprints intersecting a shapely geometry or an ``(N, 2)`` RA, Dec
+        vertex array.
+
+        Returns
+        -------
+        footprints : :class:`andromap.footprintset.FootprintSet`
+            The intersecting footprints.
+        """
+        if not hasattr(geometry, 'geom_type'):
+            geometry = Polygon(geometry)
+        return self._result(i for i in self._candidates(geometry)
+                            if self._polygons[i].intersects(geometry))
+
+    def in_box(self, ra_min, ra_max, dec_min, dec_max):
+        """Footprints intersecting an RA, Dec box (degrees).
+
+        A box crossing RA = 0 is given with ``ra_min`` greater than
+        ``ra_max`` (or with ``ra_min`` negative) and is split there. The
+        test is planar in RA, Dec, so footprints that themselves cross RA =
+        0 are only found by :meth:`in_region`.
+        """
+        boxes = ra_boxes(ra_min, ra_max, dec_min, dec_max)
+        if len(boxes) == 1:
+            return self.query(boxes[0])
+        return self.query(MultiPolygon(boxes))
+
+    def in_region(self, ra, dec, radius):
+        """Footprints intersecting a cone of ``radius`` degrees (less than 90)
+        around ``ra``, ``dec``.
+
+        Candidates are found from the cone's RA, Dec bounding box, split at
+        RA = 0 if the cone crosses it. Each is then tested exactly by
+        projecting it onto the plane tangent at the cone's centre, where
+        footprint edges (great circles) are straight and the cone is a
+        circle of radius ``tan(radius)``.
+        """
+        dec_min = max(dec - radius, -90.)
+        dec_max = min(dec + radius, 90.)
+        if abs(dec) + radius >= 90.:
+            ra_min, ra_max = 0., 360.
+        else:
+            half_width = np.degrees(np.arcsin(np.sin(np.radians(radius))
+                                              / np.cos(np.radians(dec))))
+            ra_min, ra_max = ra - half_width, ra + half_width
+        r_tan = np.degrees(np.tan(np.radians(radius)))
+        centre = Point(0., 0.)
+        candidates = set()
+        for b in ra_boxes(ra_min, ra_max, dec_min, dec_max):
+            candidates.update(self._candidates(b))
+        matches = []
+        for i in sorted(candidates):
+            verts = self._vertices[i]
+            xi, eta = eq_to_tan(verts[:, 0], verts[:, 1], ra0=ra, dec0=dec)
+            poly = Polygon(np.column_stack([xi, eta]))
+            if poly.distance(centre) <= r_tan:
+                matches.append(i)
+        return self._result(matches)
+
+
+@cached_query
+def get_footprint_index(sel):
+    """Get a :class:`FootprintIndex` of the image footprints matching a
+    selector. Indices are cached alongside the footprint queries.
+    """
+    return FootprintIndex(get_image_footprints(sel))
+
+
+def footprints_in_box(ra_min, ra_max, dec_min, dec_max, sel=None):
+    """Image footprints intersecting an RA, Dec box (degrees).
+
+    Parameters
+    ----------
+    sel : dict
+        Mongo selector for the images to search (all images by default).
+    """
+    return get_footprint_index(sel or {}).in_box(ra_min, ra_max,
+                                                 dec_min, dec_max)
+
+
+def footprints_in_region(ra, dec, radius, sel=None):
+    """Image footprints intersecting a cone of ``radius`` degrees around
+    ``ra``, ``dec``.
+
+    Parameters
+    ----------
+    sel : dict
+        Mongo selector for the images to search (all images by default).
+    """
+    return get_footprint_index(sel or {}).in_region(ra, dec, radius)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark coverage-depth rasterization against per-pixel polygon tests.
+
+Survey-like footprints are filled into an exposure-count image by
+:func:`andromap.coverage.rasterize_depth` (vectorized scanlines into a
+difference array). A subset is also rasterized by testing the pixel centres
+in each footprint's bounding box with shapely, and the two are checked to
+agree.
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+from shapely.geometry import Polygon
+
+from andromap.constants import M31RA0, M31DEC0
+from andromap.coverage import tan_wcs, rasterize_depth, DepthMap
+
+try:
+    from shapely import contains_xy  # Shapely >= 2
+except ImportError:
+    contains_xy = None
+
+
+def make_footprints(n, size=0.5, extent=3., seed=0):
+    """Dithered MegaCam-sized square footprints around M31."""
+    rng = np.random.RandomState(seed)
+    centres = rng.uniform(-extent, extent, (n, 2)) / [
+        np.cos(np.radians(M31DEC0)), 1.] + [M31RA0, M31DEC0]
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * size \
+        * [1. / np.cos(np.radians(M31DEC0)), 1.]
+    return [c + corners for c in centres]
+
+
+def pixel_depth(polygons, wcs, shape):
+    """Count polygons by testing the pixel centres in their bounding boxes,
+    with edges straight in pixel space as the scanline fill has them.
+    """
+    depth = np.zeros(shape)
+    for p in polygons:
+        x, y = wcs.all_world2pix(p[:, 0], p[:, 1], 0)
+        x0, x1 = [int(np.clip(v, 0, shape[1])) for v in
+                  (np.ceil(x.min()), np.ceil(x.max()))]
+        y0, y1 = [int(np.clip(v, 0, shape[0])) for v in
+                  (np.ceil(y.min()), np.ceil(y.max()))]
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        depth[y0:y1, x0:x1] += contains_xy(Polygon(np.c_[x, y]), xx, yy)
+    return depth
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=10000)
+    parser.add_argument('--npix', type=int, default=4096)
+    parser.add_argument('--n-ref', type=int, default=100)
+    args = parser.parse_args()
+
+    shape = (args.npix, args.npix)
+    wcs = tan_wcs(M31RA0, M31DEC0, 7. / args.npix, shape)
+    polygons = make_footprints(args.n)
+
+    t0 = time.time()
+    depth = rasterize_depth(polygons, wcs, shape)
+    t_scan = time.time() - t0
+    print("%i footprints on a %i x %i grid: scanlines %.2f s, max depth %i"
+          % (args.n, args.npix, args.npix, t_scan, depth.max()))
+
+    t0 = time.time()
+    weights = np.random.RandomState(1).uniform(30., 600., args.n)
+    rasterize_depth(polygons, wcs, shape, weights=weights)
+    print("  summed exposure time %.2f s" % (time.time() - t0))
+
+    path = os.path.join(tempfile.mkdtemp(), 'depth.fits')
+    t0 = time.time()
+    depth_map = DepthMap(np.rint(depth).astype(np.int32), wcs)
+    depth_map.write(path)
+    assert (DepthMap.read(path).data == depth_map.data).all()
+    print("  FITS round trip %.2f s" % (time.time() - t0))
+
+    if contains_xy is not None and args.n_ref > 0:
+        subset = polygons[:args.n_ref]
+        t0 = time.time()
+        scan = rasterize_depth(subset, wcs, shape)
+        t_scan = time.time() - t0
+        t0 = time.time()
+        ref = pixel_depth(subset, wcs, shape)
+        t_ref = time.time() - t0
+        assert (scan == ref).all(), np.abs(scan - ref).max()
+        print("%i footprints: scanlines %.2f s, per-pixel tests %.2f s"
+              % (args.n_ref, t_scan, t_ref))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark binning a large, memory-mapped star catalog onto a map grid.
+
+:func:`andromap.density.bin_catalog` (tangent-plane projection and one
+``bincount`` per chunk) is timed on float32 RA, Dec columns mapped from
+disk, with and without weights. A subset is also binned by projecting with
+astropy and histogramming with ``np.histogram2d``, and the two are checked
+to agree.
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from andromap.constants import M31RA0, M31DEC0
+from andromap.coverage import tan_wcs
+from andromap.density import bin_catalog
+
+
+def write_catalog(path, n, seed=0):
+    """A disk-like distribution of stars around M31, as float32 columns."""
+    catalog = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                        shape=(2, n))
+    rng = np.random.RandomState(seed)
+    pa = np.radians(38.)
+    for i0 in range(0, n, 5000000):
+        m = min(5000000, n - i0)
+        u = rng.laplace(0., 0.6, m)
+        v = rng.laplace(0., 0.15, m)
+        xi = u * np.sin(pa) + v * np.cos(pa)
+        eta = u * np.cos(pa) - v * np.sin(pa)
+        catalog[0, i0:i0 + m] = M31RA0 + xi / np.cos(np.radians(M31DEC0))
+        catalog[1, i0:i0 + m] = M31DEC0 + eta
+    catalog.flush()
+    del catalog
+    return np.load(path, mmap_mode='r')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=100000000)
+    parser.add_argument('--npix', type=int, default=4096)
+    parser.add_argument('--n-ref', type=int, default=5000000)
+    args = parser.parse_args()
+
+    shape = (args.npix, args.npix)
+    wcs = tan_wcs(M31RA0, M31DEC0, 6. / args.npix, shape)
+    path = os.path.join(tempfile.mkdtemp(), 'catalog.npy')
+    t0 = time.time()
+    catalog = write_catalog(path, args.n)
+    print("wrote %i points in %.1f s" % (args.n, time.time() - t0))
+
+    t0 = time.time()
+    image = bin_catalog(catalog[0], catalog[1], wcs, shape)
+    t_bin = time.time() - t0
+    print("binned onto %i x %i: %.1f s (%.1f Mpoints/s), %i points on the "
+          "grid" % (args.npix, args.npix, t_bin, args.n / t_bin / 1e6,
+                    image.sum()))
+    t0 = time.time()
+    bin_catalog(catalog[0], catalog[1], wcs, shape, weights=catalog[1])
+    t_bin = time.time() - t0
+    print("  weighted: %.1f s (%.1f Mpoints/s)"
+          % (t_bin, args.n / t_bin / 1e6))
+
+    ra = np.asarray(catalog[0, :args.n_ref], dtype=np.float64)
+    dec = np.asarray(catalog[1, :args.n_ref], dtype=np.float64)
+    t0 = time.time()
+    x, y = wcs.wcs_world2pix(ra, dec, 0)
+    edges = np.arange(args.npix + 1) - 0.5
+    ref = np.histogram2d(y, x, bins=[edges, edges])[0]
+    t_ref = time.time() - t0
+    t0 = time.time()
+    image = bin_catalog(ra, dec, wcs, shape)
+    t_bin = time.time() - t0
+    assert (image == ref).all(), np.abs(image - ref).sum()
+    print("%i points: bin_catalog %.2f s, astropy + histogram2d %.2f s"
+          % (args.n_ref, t_bin, t_ref))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark building a dense grid of profile ellipses.
+
+The original loop (interpolating PA and ellipticity, building a
+1000-vertex ellipse and projecting it, one radius at a time) is timed
+against :mod:`andromap.ellipses`, which interpolates, lays out and projects
+all radii at once, with 1000 vertices each and with vertex counts adapted
+to the pixel scale. The batched ellipses are checked against the loop, and
+the adaptive ones against the drawing tolerance.
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from andromap.constants import D_KPC, M31RA0, M31DEC0
+from andromap.ellipses import profile_ellipses, adaptive_vertex_counts, \
+    ellipse_polygons, ellipse_grid
+from andromap.tanproj import tan_to_eq
+
+
+def make_profile(n=400):
+    """An XVISTA-like profile with a twisting, flattening disk."""
+    R = np.logspace(0.5, 4., n)
+    PA = 50. + 10. * np.tanh((R - 3000.) / 1000.)
+    ELL = 0.3 + 0.4 * R / R.max()
+    return {'R': R, 'PA': PA, 'ELL': ELL}
+
+
+def legacy_ellipse_grid(prof, radii, n_verts=1000):
+    """The original per-radius loop."""
+    R = D_KPC * np.tan(prof['R'] / 3600. * np.pi / 180.)
+    polygons = []
+    for r0 in radii:
+        pa = np.interp(r0, R, prof['PA'])
+        ell = np.interp(r0, R, prof['ELL'])
+        r_deg = np.arctan(r0 / D_KPC) * 180. / np.pi
+        b_deg = (1. - ell) * r_deg
+        p = (90. - pa) * np.pi / 180.
+        t = np.linspace(0., 2. * np.pi, num=n_verts, endpoint=False)
+        X = - (r_deg * np.cos(t) * np.cos(p) - b_deg * np.sin(t) * np.sin(p))
+        Y = r_deg * np.cos(t) * np.sin(p) + b_deg * np.sin(t) * np.cos(p)
+        ras, decs = tan_to_eq(X, Y, ra0Deg=M31RA0, dec0Deg=M31DEC0)
+        polygons.append(np.vstack([ras, decs]).T)
+    return polygons
+
+
+def max_departure(a, b, pa, n_verts):
+    """Greatest distance, in the tangent plane, between the chords of the
+    polygons and the ellipse midway between their vertices.
+    """
+    vertices, offsets = ellipse_grid(a, b, pa, n_verts=n_verts)
+    mids, _ = ellipse_grid(a, b, pa, n_verts=2 * n_verts)
+    mids = mids[1::2]
+    ends = np.roll(vertices, -1, axis=0)
+    ends[offsets[1:] - 1] = vertices[offsets[:-1]]
+    d = ends - vertices
+    rel = mids - vertices
+    cross = np.abs(d[:, 0] * rel[:, 1] - d[:, 1] * rel[:, 0])
+    return (cross / np.hypot(d[:, 0], d[:, 1])).max()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-radii', type=int, default=500)
+    parser.add_argument('--pix-scale', type=float, default=4e-3,
+                        help="Device pixel, degrees")
+    args = parser.parse_args()
+
+    prof = make_profile()
+    radii = np.linspace(0.5, 60., args.n_radii)
+
+    t0 = time.time()
+    legacy = legacy_ellipse_grid(prof, radii)
+    t_legacy = time.time() - t0
+
+    t0 = time.time()
+    a, b, pa = profile_ellipses(prof, radii)
+    fixed = ellipse_polygons(a, b, pa, n_verts=1000)
+    t_fixed = time.time() - t0
+    err = max(np.abs(p - q).max() for p, q in zip(legacy, fixed))
+    assert err < 1e-9, err
+
+    t0 = time.time()
+    a, b, pa = profile_ellipses(prof, radii)
+    n_verts = adaptive_vertex_counts(a, args.pix_scale)
+    adaptive = ellipse_polygons(a, b, pa, n_verts=n_verts)
+    t_adaptive = time.time() - t0
+    departure = max_departure(a, b, pa, n_verts) / args.pix_scale
+
+    print("%i ellipses: loop %.1f ms, batched %.1f ms, adaptive %.1f ms"
+          % (args.n_radii, t_legacy * 1e3, t_fixed * 1e3, t_adaptive * 1e3))
+    print("vertices: %i fixed, %i adaptive (%i to %i per ellipse); "
+          "max departure %.2f px"
+          % (1000 * args.n_radii, sum(len(p) for p in adaptive),
+             n_verts.min(), n_verts.max(), departure))
+    assert departure <= 0.5 + 1e-6
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark the raw BSON footprint fetch path against the original
+document-decoding path for 10k-document selections.
+
+By default only the client-side decoding is timed, on BSON batches encoded
+locally. With ``--mongo`` the synthetic documents are also written to a
+scratch database on a local mongod and both full query paths are timed.
+"""
+
+import time
+import argparse
+
+import numpy as np
+import bson
+
+from andromap.polytools import close_vertices
+from andromap.rawbson import VertexBuffer, decode_vertex_batch
+
+
+def make_documents(n_docs, n_verts=4, seed=0):
+    """Synthetic image log documents with MegaCam-sized footprints."""
+    rng = np.random.RandomState(seed)
+    ra = rng.uniform(8., 13., n_docs)
+    dec = rng.uniform(39., 43., n_docs)
+    t = np.linspace(0., 2. * np.pi, n_verts, endpoint=False)
+    docs = []
+    for i in range(n_docs):
+        verts = np.vstack([ra[i] + 0.5 * np.cos(t),
+                           dec[i] + 0.5 * np.sin(t)]).T
+        docs.append({'_id': 'image%06i' % i,
+                     'INSTRUME': 'MegaPrime',
+                     'OBJECT': 'M31_SB_%i' % (i % 22),
+                     'footprint': verts.tolist()})
+    return docs
+
+
+def encode_batches(docs, batch_size):
+    """Encode documents as a server would return them for a footprint
+    query, i.e. projected onto ``_id`` and ``footprint``.
+    """
+    batches = []
+    for i in range(0, len(docs), batch_size):
+        batches.append(b''.join(
+            bson.encode({'_id': d['_id'], 'footprint': d['footprint']})
+            for d in docs[i:i + batch_size]))
+    return batches
+
+
+def decode_legacy(batches):
+    footprints = {}
+    for batch in batches:
+        for d in bson.decode_all(batch):
+            footprints[d['_id']] = close_vertices(d['footprint'])
+    return footprints
+
+
+def decode_raw(batches):
+    buf = VertexBuffer()
+    names = []
+    counts = []
+    for batch in batches:
+        keys, n = decode_vertex_batch(batch, 'footprint', ['_id'], buf)
+        names.extend(k[0] for k in keys)
+        counts.extend(n)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    verts = buf.vertices
+    return {name: verts[i0:i1]
+            for name, i0, i1 in zip(names, offsets[:-1], offsets[1:])}
+
+
+def best_time(func, *args, **kwargs):
+    repeat = kwargs.pop('repeat', 5)
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        result = func(*args)
+        times.append(time.time() - t0)
+    return min(times), result
+
+
+def bench_decode(docs, batch_size):
+    batches = encode_batches(docs, batch_size)
+    t_legacy, legacy = best_time(decode_legacy, batches)
+    t_raw, raw = best_time(decode_raw, batches)
+    assert sorted(legacy.keys()) == sorted(raw.keys())
+    for k, v in legacy.items():
+        assert np.array_equal(v, raw[k])
+    print("decode only, %i docs" % len(docs))
+    print("  legacy:  %8.1f ms" % (t_legacy * 1e3))
+    print("  raw:     %8.1f ms  (%.1fx)" % (t_raw * 1e3, t_legacy / t_raw))
+
+
+def bench_mongo(docs, batch_size):
+    from andromap.connection import connection
+    from andromap.imagelogfootprints import MongoBackend, \
+        fetch_polygons_legacy
+
+    with connection(db='andromap_bench') as conn:
+        c = conn.collection('images')
+        c.drop()
+        c.insert_many(docs)
+        sel = {'INSTRUME': 'MegaPrime'}
+        t_legacy, legacy = best_time(fetch_polygons_legacy, 'images', sel)
+        backend = MongoBackend(batch_size=batch_size)
+        t_raw, raw = best_time(backend.fetch_polygons, 'images', sel)
+        conn.db.client.drop_database('andromap_bench')
+    assert len(legacy) == len(raw) == len(docs)
+    print("mongod query, %i docs" % len(docs))
+    print("  legacy:  %8.1f ms" % (t_legacy * 1e3))
+    print("  raw:     %8.1f ms  (%.1fx)" % (t_raw * 1e3, t_legacy / t_raw))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-docs', type=int, default=10000)
+    parser.add_argument('--n-verts', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--mongo', action='store_true',
+                        help='Also benchmark against a local mongod')
+    args = parser.parse_args()
+
+    docs = make_documents(args.n_docs, n_verts=args.n_verts)
+    bench_decode(docs, args.batch_size)
+    if args.mongo:
+        bench_mongo(docs, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
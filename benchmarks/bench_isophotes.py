@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark elliptical galactocentric radii of a large catalog.
+
+Points are read from memory-mapped RA, Dec columns and their radii solved
+by :class:`andromap.ellipses.IsophoteModel` chunk by chunk. A sample is
+checked against a per-point bisection with the profile interpolated by
+:func:`andromap.ellipses.interp_ellipses`, and points on the ellipses that
+:func:`andromap.ellipses.ellipse_polygons` draws are checked to get back
+the radii they were drawn at.
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from andromap.constants import D_KPC, M31RA0, M31DEC0
+from andromap.ellipses import IsophoteModel, profile_ellipses, \
+    ellipse_polygons, interp_ellipses, profile_radii
+from andromap.tanproj import eq_to_tan
+
+
+def make_profile(n=400):
+    """An XVISTA-like profile with a twisting, flattening disk, whose
+    ellipses are nested.
+    """
+    R = np.logspace(0.5, 4., n)
+    PA = 50. + 10. * np.tanh((R - 3000.) / 1000.)
+    ELL = 0.7 - 0.4 * np.exp(-R / 2000.)
+    return {'R': R, 'PA': PA, 'ELL': ELL}
+
+
+def point_radius(prof, xi, eta, r_max=500., tolerance=1e-6):
+    """Solve for one point's radius by bisection, interpolating the
+    profile at every step.
+    """
+    R = profile_radii(prof)
+    lo, hi = 0., r_max
+    while hi - lo > tolerance:
+        r = 0.5 * (lo + hi)
+        pa, ell = interp_ellipses(R, prof['PA'], prof['ELL'], [r])
+        p = np.radians(90. - pa[0])
+        u = eta * np.sin(p) - xi * np.cos(p)
+        v = (xi * np.sin(p) + eta * np.cos(p)) / (1. - ell[0])
+        a = np.degrees(np.arctan(r / D_KPC))
+        if a - np.sqrt(u * u + v * v) <= 0.:
+            lo = r
+        else:
+            hi = r
+    return 0.5 * (lo + hi)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=10000000)
+    parser.add_argument('--n-ref', type=int, default=500)
+    args = parser.parse_args()
+
+    prof = make_profile()
+    model = IsophoteModel.from_profile(prof)
+
+    # Consistency with the drawn ellipses
+    radii = np.linspace(0.5, 80., 60)
+    a, b, pa = profile_ellipses(prof, radii)
+    polygons = ellipse_polygons(a, b, pa, n_verts=64)
+    err = max(np.abs(model.radius(p[:, 0], p[:, 1]) - r).max()
+              for r, p in zip(radii, polygons))
+    print("radii of drawn ellipses recovered to %.1e kpc" % err)
+    assert err < 1e-4
+
+    # A memory-mapped catalog
+    path = os.path.join(tempfile.mkdtemp(), 'catalog.npy')
+    catalog = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                        shape=(2, args.n))
+    rng = np.random.RandomState(0)
+    for i0 in range(0, args.n, 1000000):
+        m = min(1000000, args.n - i0)
+        catalog[0, i0:i0 + m] = M31RA0 + rng.uniform(-4., 4., m)
+        catalog[1, i0:i0 + m] = M31DEC0 + rng.uniform(-3., 3., m)
+    catalog.flush()
+    catalog = np.load(path, mmap_mode='r')
+
+    t0 = time.time()
+    r = model.radius(catalog[0], catalog[1])
+    t_model = time.time() - t0
+    print("%i points: %.1f s (%.2f Mpoints/s), median radius %.1f kpc"
+          % (args.n, t_model, args.n / t_model / 1e6, np.median(r)))
+
+    ra, dec = catalog[0, :args.n_ref], catalog[1, :args.n_ref]
+    xi, eta = eq_to_tan(ra, dec)
+    t0 = time.time()
+    ref = np.array([point_radius(prof, x, e) for x, e in zip(xi, eta)])
+    t_ref = time.time() - t0
+    err = np.abs(r[:args.n_ref] - ref).max()
+    print("%i points by per-point bisection: %.1f s (%.4f Mpoints/s); "
+          "max difference %.1e kpc"
+          % (args.n_ref, t_ref, args.n_ref / t_ref / 1e6, err))
+    assert err < 1e-4
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark layer algebra against overlaying the whole unions with shapely.
+
+A survey-like layer of many separate fields is intersected and differenced
+with a small layer over its centre and with a layer as large as itself,
+using :class:`andromap.layeralgebra.Layer` (STRtree candidates and prepared
+geometry tests per part) and directly with the MultiPolygon overlay
+operations. Results are checked to agree.
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from andromap.constants import M31RA0, M31DEC0
+from andromap.layeralgebra import Layer
+
+
+def make_footprints(n, size=0.1, offset=(0., 0.), seed=0):
+    """Square footprints dithered over a grid of separate fields."""
+    rng = np.random.RandomState(seed)
+    n_side = int(np.ceil(np.sqrt(n / 8.)))
+    fields = np.array([(i, j) for i in range(n_side) for j in range(n_side)
+                       if (i * 7 + j * 3) % 11],
+                      dtype=float) * 2.6 * size
+    fields -= fields.mean(axis=0)
+    centres = fields[rng.randint(0, len(fields), n)] \
+        + rng.normal(0., 0.05 * size, (n, 2)) + [M31RA0, M31DEC0] + offset
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * size
+    return [c + corners for c in centres]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=20000)
+    args = parser.parse_args()
+
+    a = Layer.from_polygons(make_footprints(args.n, seed=1))
+    # A small layer over the centre, as PHAT is to a wide survey, and one as
+    # large as ``a``
+    for n_b in (args.n // 100, args.n):
+        b = Layer.from_polygons(make_footprints(n_b, size=0.08,
+                                                offset=(0.1, 0.05), seed=2))
+        print("layers of %i and %i parts" % (len(a), len(b)))
+        for name in ('intersection', 'difference', 'symmetric_difference'):
+            t0 = time.time()
+            result = getattr(a, name)(b)
+            t_layer = time.time() - t0
+            t0 = time.time()
+            reference = getattr(a.geometry, name)(b.geometry)
+            t_shapely = time.time() - t0
+            diff = result.geometry.symmetric_difference(reference).area
+            assert diff < 1e-9 * reference.area, diff
+            print("  %-21s Layer %7.1f ms, MultiPolygon %7.1f ms (%i parts)"
+                  % (name, t_layer * 1e3, t_shapely * 1e3, len(result)))
+        print("  area of difference: %.3f deg2, %.1f kpc2"
+              % ((a - b).area(), (a - b).area_kpc2()))
+
+
+if __name__ == '__main__':
+    main()
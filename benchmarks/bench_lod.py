@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark level-of-detail simplification of map layers.
+
+A union of survey-like footprints and a grid of 1000-vertex isophote
+ellipses are simplified to half a device pixel of a 3.5 inch figure at
+300 dpi showing a 3 degree field. Vertex counts and simplification times
+(cold, then from the cache) are reported; with ``--pdf`` both versions are
+also drawn with matplotlib and saved as PDF.
+"""
+
+import io
+import time
+import argparse
+
+import numpy as np
+from shapely.geometry import MultiPolygon, Polygon
+
+from andromap.constants import M31RA0, M31DEC0
+from andromap.lod import get_lod_cache, simplify_polygons
+from andromap.polytools import polygon_union
+
+
+def make_footprints(n, size=0.25, seed=0):
+    """Square footprints dithered over a grid of fields, like a mosaic."""
+    rng = np.random.RandomState(seed)
+    n_side = int(np.ceil(np.sqrt(n / 4.)))
+    fields = np.array([(i, j) for i in range(n_side) for j in range(n_side)],
+                      dtype=float) * 0.9 * size * 2.
+    centres = fields[rng.randint(0, len(fields), n)] \
+        + rng.normal(0., 0.05 * size, (n, 2)) + [M31RA0 - 1., M31DEC0 - 1.]
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * size
+    return [c + corners for c in centres]
+
+
+def make_ellipses(radii, ell=0.7, pa=38., n_verts=1000):
+    """Ellipses around M31 of semi-major axes ``radii`` (degrees)."""
+    t = np.linspace(0., 2. * np.pi, num=n_verts, endpoint=False)
+    p = np.radians(pa)
+    polygons = []
+    for a in radii:
+        b = (1. - ell) * a
+        x = -(a * np.cos(t) * np.cos(p) - b * np.sin(t) * np.sin(p))
+        y = a * np.cos(t) * np.sin(p) + b * np.sin(t) * np.cos(p)
+        polygons.append(np.column_stack(
+            [M31RA0 + x / np.cos(np.radians(M31DEC0)), M31DEC0 + y]))
+    return polygons
+
+
+def draw_pdf(polygons):
+    """Draw polygons with matplotlib; returns PDF bytes and save time."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import PolyCollection
+    fig = plt.figure(figsize=(3.5, 3.5))
+    ax = fig.add_subplot(111)
+    ax.add_collection(PolyCollection(polygons, facecolor='none'))
+    ax.set_xlim(M31RA0 + 2., M31RA0 - 2.)
+    ax.set_ylim(M31DEC0 - 1.5, M31DEC0 + 1.5)
+    out = io.BytesIO()
+    t0 = time.time()
+    fig.savefig(out, format='pdf', dpi=300)
+    t_save = time.time() - t0
+    plt.close(fig)
+    return len(out.getvalue()), t_save
+
+
+def area(vert_seq):
+    return MultiPolygon([Polygon(v) for v in vert_seq]).area
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=5000)
+    parser.add_argument('--dpi', type=float, default=300.)
+    parser.add_argument('--pdf', action='store_true')
+    args = parser.parse_args()
+
+    union = polygon_union(make_footprints(args.n))
+    ellipses = make_ellipses(np.linspace(0.1, 1.5, 15))
+    polygons = union + ellipses
+    # Half a device pixel of a 3 degree field across 0.8 of 3.5 inches
+    tolerance = 0.5 * 3. / (0.8 * 3.5 * args.dpi)
+
+    t0 = time.time()
+    simple = simplify_polygons(polygons, tolerance)
+    t_cold = time.time() - t0
+    t0 = time.time()
+    simplify_polygons(polygons, tolerance)
+    t_warm = time.time() - t0
+    assert get_lod_cache().stats['hits'] > 0
+
+    n_full = sum(len(p) for p in polygons)
+    n_simple = sum(len(p) for p in simple)
+    change = abs(area(simple) - area(polygons)) / area(polygons)
+    print("tolerance %.2e deg" % tolerance)
+    print("vertices:  %8i full, %8i simplified" % (n_full, n_simple))
+    print("area change: %.2e" % change)
+    print("simplify: %8.1f ms cold, %8.1f ms cached"
+          % (t_cold * 1e3, t_warm * 1e3))
+    if args.pdf:
+        for label, polys in (('full', polygons), ('simplified', simple)):
+            size, t_save = draw_pdf(polys)
+            print("PDF %-10s %8i bytes, saved in %6.1f ms"
+                  % (label, size, t_save * 1e3))
+
+
+if __name__ == '__main__':
+    main()
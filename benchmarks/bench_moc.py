@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark set operations on HEALPix coverage maps against polygon layers.
+
+Two survey-like sets of footprints are rasterized into MOCs once (and
+written to and read back from FITS); their union, intersection and
+difference are then timed as range operations and compared, in area, with
+the same operations on :class:`andromap.layeralgebra.Layer` polygons.
+Footprints crossing RA = 0 are checked to rasterize as they do elsewhere.
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from andromap.constants import M31RA0, M31DEC0
+from andromap.layeralgebra import Layer
+from andromap.moc import MOC
+
+
+def make_footprints(n, size=0.1, offset=(0., 0.), seed=0):
+    """Square footprints dithered over a grid of separate fields."""
+    rng = np.random.RandomState(seed)
+    n_side = int(np.ceil(np.sqrt(n / 8.)))
+    fields = np.array([(i, j) for i in range(n_side) for j in range(n_side)
+                       if (i * 7 + j * 3) % 11],
+                      dtype=float) * 2.6 * size
+    fields -= fields.mean(axis=0)
+    centres = fields[rng.randint(0, len(fields), n)] \
+        + rng.normal(0., 0.05 * size, (n, 2)) + [M31RA0, M31DEC0] + offset
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * size
+    return [c + corners for c in centres]
+
+
+def check_wrap(order=12):
+    """A box across RA = 0 covers the same area as one away from it."""
+    box = np.array([[-0.5, 39.5], [0.5, 39.5], [0.5, 40.5], [-0.5, 40.5]])
+    wrapped = box.copy()
+    wrapped[:, 0] %= 360.
+    moc = MOC.from_polygons([wrapped], max_order=order)
+    ref = MOC.from_polygons([box + [10., 0.]], max_order=order)
+    assert abs(moc.area() - ref.area()) < 0.01 * ref.area(), moc
+    assert moc.contains(np.array([0., 359.8]), np.array([40., 40.2])).all()
+    other = MOC.from_polygons([box + [10., 0.]], max_order=order)
+    assert abs(moc.union(other).area() - moc.area() - other.area()) < 1e-9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=20000)
+    parser.add_argument('--order', type=int, default=12)
+    args = parser.parse_args()
+
+    check_wrap()
+
+    polys_a = make_footprints(args.n, seed=1)
+    polys_b = make_footprints(args.n, size=0.08, offset=(0.1, 0.05), seed=2)
+
+    t0 = time.time()
+    a = MOC.from_polygons(polys_a, max_order=args.order)
+    b = MOC.from_polygons(polys_b, max_order=args.order)
+    t_moc = time.time() - t0
+    path = os.path.join(tempfile.mkdtemp(), 'a.fits')
+    a.write(path)
+    assert MOC.read(path) == a
+    t0 = time.time()
+    layer_a = Layer.from_polygons(polys_a)
+    layer_b = Layer.from_polygons(polys_b)
+    t_layer = time.time() - t0
+    print("%i + %i footprints, max order %i" % (args.n, args.n, args.order))
+    print("build:                MOC %8.1f ms, Layer %8.1f ms"
+          % (t_moc * 1e3, t_layer * 1e3))
+
+    for name in ('union', 'intersection', 'difference'):
+        t0 = time.time()
+        m = getattr(a, name)(b)
+        t_moc = time.time() - t0
+        t0 = time.time()
+        layer = getattr(layer_a, name)(layer_b)
+        t_layer = time.time() - t0
+        print("%-21s MOC %8.1f ms, Layer %8.1f ms; area %.3f vs %.3f deg2"
+              % (name, t_moc * 1e3, t_layer * 1e3, m.area(), layer.area()))
+
+    t0 = time.time()
+    outline = a.to_layer()
+    print("outline of %i parts in %.1f ms"
+          % (len(outline), (time.time() - t0) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark bulk ring normalization of packed footprints against closing
+each footprint in Python.
+
+Footprints are made as the image log holds them: some already closed, some
+with repeated vertices, wound either way.
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from andromap.footprintset import FootprintSet
+from andromap.polytools import close_vertices
+
+
+def make_footprints(n, seed=0):
+    rng = np.random.RandomState(seed)
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * 0.1
+    polys = []
+    for c in rng.uniform([9., 40.], [12., 43.], (n, 2)):
+        v = c + corners
+        if rng.rand() < 0.5:
+            v = v[::-1]
+        if rng.rand() < 0.2:
+            v = np.vstack((v[:2], v[1:]))
+        if rng.rand() < 0.5:
+            v = np.vstack((v, v[:1]))
+        polys.append(v)
+    return polys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=100000)
+    args = parser.parse_args()
+
+    polys = make_footprints(args.n)
+    footprints = FootprintSet.from_polygons(range(args.n), polys)
+
+    t0 = time.time()
+    closed = [close_vertices(p) for p in polys]
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    normalized = footprints.normalize()
+    t_bulk = time.time() - t0
+
+    again = normalized.normalize()
+    assert np.array_equal(again.vertices, normalized.vertices)
+    assert np.array_equal(again.offsets, normalized.offsets)
+    assert (normalized.counts == 5).all()
+    assert np.allclose(normalized.areas(), FootprintSet.from_polygons(
+        range(args.n), closed).areas())
+
+    print("%i footprints, %i vertices" % (args.n, footprints.n_vertices))
+    print("close_vertices per footprint: %8.1f ms" % (t_loop * 1e3))
+    print("FootprintSet.normalize:       %8.1f ms" % (t_bulk * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark the parallel tiled union against the serial polygon union on a
+synthetic survey of 50k footprints, at 1, 2, 4 and 8 worker processes.
+
+The parallel union is checked against the serial one: the area of their
+symmetric difference must be a negligible fraction of the union's area.
+"""
+
+import time
+import argparse
+
+import numpy as np
+from shapely.geometry import MultiPolygon, Polygon
+from shapely.ops import unary_union
+
+from andromap.constants import M31RA0, M31DEC0
+from andromap.polytools import parallel_union
+
+
+def make_footprints(n, size=0.1, seed=0):
+    """Square footprints dithered over a grid of separate fields around
+    M31, so that the union has many parts.
+    """
+    rng = np.random.RandomState(seed)
+    n_side = int(np.ceil(np.sqrt(n / 8.)))
+    fields = np.array([(i, j) for i in range(n_side) for j in range(n_side)
+                       if (i * 7 + j * 3) % 11],
+                      dtype=float) * 2.6 * size
+    fields -= fields.mean(axis=0)
+    centres = fields[rng.randint(0, len(fields), n)] \
+        + rng.normal(0., 0.05 * size, (n, 2)) + [M31RA0, M31DEC0]
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * size
+    return [c + corners for c in centres]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=50000)
+    parser.add_argument('--workers', type=int, nargs='*',
+                        default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    polys = make_footprints(args.n)
+    t0 = time.time()
+    serial = unary_union(MultiPolygon([Polygon(p) for p in polys]))
+    t_serial = time.time() - t0
+    n_parts = len(serial.geoms) if hasattr(serial, 'geoms') else 1
+    print("%i footprints, union of %i parts" % (args.n, n_parts))
+    print("serial:     %8.2f s" % t_serial)
+
+    for n in args.workers:
+        t0 = time.time()
+        union = parallel_union(polys, processes=n)
+        t = time.time() - t0
+        diff = union.symmetric_difference(serial).area / serial.area
+        assert diff < 1e-9, diff
+        print("%2i workers: %8.2f s  (%.2fx, rel. diff %.1e)"
+              % (n, t, t_serial / t, diff))
+
+
+if __name__ == '__main__':
+    main()
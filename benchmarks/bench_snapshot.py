@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Time opening and querying a synthetic 100k-footprint image log snapshot,
+including the rate at which selectors are evaluated locally. Fields with
+mixed types, ObjectIds and explicit nulls are checked to match as they do
+in Mongo, and selectors on dates or arrays to be refused.
+"""
+
+import time
+import datetime
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+from bson import ObjectId
+
+from andromap.query import ColumnTable
+from andromap.snapshot import write_snapshot_collection, SnapshotBackend
+
+
+INSTRUMENTS = ['MegaPrime', 'WIRCam', 'ACS']
+
+
+def make_documents(n_docs, seed=0):
+    rng = np.random.RandomState(seed)
+    ra = rng.uniform(8., 13., n_docs)
+    dec = rng.uniform(39., 43., n_docs)
+    box = np.array([[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5]])
+    for i in range(n_docs):
+        yield {'_id': 'image%07i' % i,
+               'INSTRUME': INSTRUMENTS[i % len(INSTRUMENTS)],
+               'OBJECT': 'M31_SB_%i' % (i % 22),
+               'EXPTIME': float(rng.uniform(30., 600.)),
+               'footprint': (box + [ra[i], dec[i]]).tolist()}
+
+
+def check_matching():
+    """Match mixed-type, ObjectId and null fields as Mongo does."""
+    oid = ObjectId()
+    docs = [{'_id': 'a', 'FIELD': 3, 'INSTRUME': None, 'REF': oid},
+            {'_id': 'b', 'FIELD': '3', 'INSTRUME': 'WIRCam',
+             'REF': u'%s' % oid},
+            {'_id': 'c', 'FIELD': 4.5, 'TAGS': ['x']},
+            {'_id': 'd', 'DATE': datetime.datetime(2010, 1, 1)}]
+    expected = [({'FIELD': 3}, 'a'),
+                ({'FIELD': '3'}, 'b'),
+                ({'FIELD': {'$gt': 3}}, 'c'),
+                ({'FIELD': {'$in': [3, '3']}}, 'ab'),
+                ({'FIELD': None}, 'd'),
+                ({'INSTRUME': {'$exists': True}}, 'ab'),
+                ({'INSTRUME': None}, 'acd'),
+                ({'INSTRUME': {'$ne': None}}, 'b'),
+                ({'REF': oid}, 'a'),
+                ({'REF': {'$in': [u'%s' % oid]}}, 'b'),
+                ({'DATE': '2010-01-01 00:00:00'}, '')]
+    table = ColumnTable.from_documents(docs)
+    for sel, ids in expected:
+        mask = table.select(sel)
+        assert ''.join(d['_id'] for d, m in zip(docs, mask) if m) == ids, sel
+    for sel in ({'TAGS': 'x'}, {'TAGS': {'$ne': 'x'}},
+                {'DATE': datetime.datetime(2010, 1, 1)}):
+        try:
+            table.select(sel)
+        except NotImplementedError:
+            continue
+        raise AssertionError("%s was evaluated locally" % sel)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-docs', type=int, default=100000)
+    args = parser.parse_args()
+
+    check_matching()
+
+    path = tempfile.mkdtemp()
+    try:
+        t0 = time.time()
+        write_snapshot_collection(path, 'images',
+                                  make_documents(args.n_docs), 'footprint')
+        print("write %i docs:     %8.1f ms"
+              % (args.n_docs, (time.time() - t0) * 1e3))
+
+        t0 = time.time()
+        backend = SnapshotBackend(path)
+        backend.snapshot.collection('images')
+        print("open:              %8.1f ms" % ((time.time() - t0) * 1e3))
+
+        t0 = time.time()
+        polys = backend.fetch_polygons('images', {'INSTRUME': 'WIRCam'})
+        print("select %6i polys: %7.1f ms"
+              % (len(polys), (time.time() - t0) * 1e3))
+
+        coll = backend.snapshot.collection('images')
+        sels = [{'INSTRUME': 'MegaPrime', 'OBJECT': 'M31_SB_%i' % i}
+                for i in range(22)]
+        sels += [{'OBJECT': {'$in': ['M31_SB_%i' % i, 'M31_SB_%i' % j]},
+                  'INSTRUME': {'$nin': ['ACS']},
+                  'footprint': {'$exists': 1}}
+                 for i, j in zip(range(22), range(1, 23))]
+        n_sel = 0
+        t0 = time.time()
+        while time.time() - t0 < 1.:
+            for sel in sels:
+                coll.select(sel)
+            n_sel += len(sels)
+        print("selectors/second:  %8.0f" % (n_sel / (time.time() - t0)))
+
+        t0 = time.time()
+        centers = backend.field_centers({}, group_by='OBJECT')
+        print("centres of %i groups: %5.1f ms"
+              % (len(centers), (time.time() - t0) * 1e3))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
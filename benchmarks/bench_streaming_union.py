@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark peak memory of the streaming footprint union against the
+original fetch-everything-then-union path.
+
+Raw BSON batches are encoded on the fly, as a cursor would deliver them, so
+the input itself is never held in full. Each path runs in a fresh process
+and reports the peak of the Python heap (tracemalloc, which does not see
+GEOS allocations) and the process's peak resident set size.
+"""
+
+import time
+import argparse
+import resource
+import tracemalloc
+import multiprocessing
+
+import numpy as np
+import bson
+from shapely.geometry import MultiPolygon, Polygon
+from shapely.ops import unary_union
+
+from andromap.imagelogfootprints import decode_polygon_chunks
+from andromap.polytools import exterior_vertices, stream_union
+
+
+def iter_batches(n_docs, batch_size, n_verts=5, seed=0):
+    """Yield raw BSON batches of synthetic footprint documents."""
+    rng = np.random.RandomState(seed)
+    ra = rng.uniform(8., 13., n_docs)
+    dec = rng.uniform(39., 43., n_docs)
+    t = np.linspace(0., 2. * np.pi, n_verts, endpoint=False)
+    for i0 in range(0, n_docs, batch_size):
+        yield b''.join(
+            bson.encode({'_id': 'image%07i' % i,
+                         'footprint': np.vstack(
+                             [ra[i] + 0.1 * np.cos(t),
+                              dec[i] + 0.1 * np.sin(t)]).T.tolist()})
+            for i in range(i0, min(i0 + batch_size, n_docs)))
+
+
+def union_all(n_docs, batch_size):
+    """The original path: a dict of every footprint, then a list, then a
+    MultiPolygon, then the union.
+    """
+    footprints = {}
+    for chunk in decode_polygon_chunks(iter_batches(n_docs, batch_size)):
+        footprints.update(chunk)
+    polygons = [p for k, p in footprints.items()]
+    u = unary_union(MultiPolygon([Polygon(p) for p in polygons]))
+    return exterior_vertices(u)
+
+
+def union_streaming(n_docs, chunk_size):
+    chunks = decode_polygon_chunks(iter_batches(n_docs, chunk_size))
+    return exterior_vertices(stream_union(list(c.values()) for c in chunks))
+
+
+def _measure(args):
+    name, n_docs, size = args
+    func = {'all': union_all, 'streaming': union_streaming}[name]
+    tracemalloc.start()
+    t0 = time.time()
+    parts = func(n_docs, size)
+    elapsed = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    area = sum(Polygon(p).area for p in parts)
+    return elapsed, peak, maxrss, area
+
+
+def measure(name, n_docs, size):
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(_measure, ((name, n_docs, size),))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-docs', type=int, default=50000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--chunk-sizes', type=int, nargs='*',
+                        default=[500, 1000, 5000])
+    args = parser.parse_args()
+
+    print("%i footprints" % args.n_docs)
+    print("%-18s %8s %12s %12s" % ("path", "time s", "heap MB", "maxrss MB"))
+    t, peak, rss, area = measure('all', args.n_docs, args.batch_size)
+    print("%-18s %8.2f %12.1f %12.1f"
+          % ('all at once', t, peak / 1e6, rss / 1e3))
+    for chunk_size in args.chunk_sizes:
+        t, peak, rss, a = measure('streaming', args.n_docs, chunk_size)
+        assert abs(a - area) < 1e-6 * area, (a, area)
+        print("%-18s %8.2f %12.1f %12.1f"
+              % ('chunks of %i' % chunk_size, t, peak / 1e6, rss / 1e3))
+
+
+if __name__ == '__main__':
+    main()
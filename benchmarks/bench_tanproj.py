@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark tangent-plane projections of many points.
+
+:class:`andromap.tanproj.TangentProjection` (blocked evaluation into
+``out=`` buffers, in float64, in float32 and in place) is timed against the
+original expression-per-term functions. Forward transforms are checked
+against the original and against astropy's TAN WCS, and round trips are
+checked to return the input coordinates. Finally, many small polygons are
+projected one at a time and in one batched call.
+"""
+
+import time
+import argparse
+
+import numpy as np
+from astropy.wcs import WCS
+
+from andromap.constants import M31RA0, M31DEC0
+from andromap.tanproj import TangentProjection, eq_to_tan, tan_to_eq, \
+    tan_to_eq_polygons
+
+
+def legacy_eq_to_tan(ra, dec, ra0=M31RA0, dec0=M31DEC0):
+    """The original forward transform."""
+    r = ra * np.pi / 180.
+    d = dec * np.pi / 180.
+    r0 = ra0 * np.pi / 180.
+    d0 = dec0 * np.pi / 180.
+    xi = np.cos(d) * np.sin(r - r0) \
+        / (np.sin(d0) * np.sin(d)
+           + np.cos(d0) * np.cos(d) * np.cos(r - r0))
+    eta = (np.cos(d0) * np.sin(d)
+           - np.sin(d0) * np.cos(d) * np.cos(r - r0)) \
+        / (np.sin(d0) * np.sin(d) + np.cos(d0) * np.cos(d) * np.cos(r - r0))
+    return xi * 180. / np.pi, eta * 180. / np.pi
+
+
+def legacy_tan_to_eq(xiDeg, etaDeg, ra0Deg=M31RA0, dec0Deg=M31DEC0):
+    """The original inverse transform, with the cos(ra - ra0) factor moved
+    inside the arctangent where it belongs.
+    """
+    xi = xiDeg * np.pi / 180.
+    eta = etaDeg * np.pi / 180.
+    ra0 = ra0Deg * np.pi / 180.
+    dec0 = dec0Deg * np.pi / 180.
+    ra = np.arctan(xi / (np.cos(dec0) - eta * np.sin(dec0))) + ra0
+    dec = np.arctan((np.sin(dec0) + eta * np.cos(dec0)) * np.cos(ra - ra0)
+                    / (np.cos(dec0) - eta * np.sin(dec0)))
+    return ra * 180. / np.pi, dec * 180. / np.pi
+
+
+def timed(f, *args, **kwargs):
+    t0 = time.time()
+    result = f(*args, **kwargs)
+    return result, time.time() - t0
+
+
+def check_accuracy(extent=5.):
+    """Compare with astropy and the original transforms, and round trip."""
+    rng = np.random.RandomState(1)
+    n = 100000
+    ra = M31RA0 + rng.uniform(-extent, extent, n) \
+        / np.cos(np.radians(M31DEC0))
+    dec = M31DEC0 + rng.uniform(-extent, extent, n)
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [M31RA0, M31DEC0]
+    wcs.wcs.crpix = [1., 1.]
+    wcs.wcs.cdelt = [1., 1.]
+    xi_ref, eta_ref = wcs.wcs_world2pix(ra, dec, 0)
+    # The WCS x axis (xi) is positive towards increasing RA, as here
+    xi, eta = eq_to_tan(ra, dec)
+    err = max(np.abs(xi - xi_ref).max(), np.abs(eta - eta_ref).max())
+    print("forward vs astropy TAN:   %.1e arcsec" % (err * 3600.))
+    assert err * 3600. < 1e-6
+    xi_old, eta_old = legacy_eq_to_tan(ra, dec)
+    err = max(np.abs(xi - xi_old).max(), np.abs(eta - eta_old).max())
+    print("forward vs original:      %.1e arcsec" % (err * 3600.))
+    assert err * 3600. < 1e-6
+
+    ra2, dec2 = tan_to_eq(xi, eta)
+    err = max(np.abs(ra2 - ra).max(), np.abs(dec2 - dec).max())
+    print("round trip, float64:      %.1e arcsec" % (err * 3600.))
+    assert err * 3600. < 1e-6
+    ra_ref, dec_ref = wcs.wcs_pix2world(xi, eta, 0)
+    err = max(np.abs(ra2 - ra_ref).max(), np.abs(dec2 - dec_ref).max())
+    print("inverse vs astropy TAN:   %.1e arcsec" % (err * 3600.))
+    assert err * 3600. < 1e-6
+    ra_fixed, dec_fixed = legacy_tan_to_eq(xi, eta)
+    err = max(np.abs(ra2 - ra_fixed).max(), np.abs(dec2 - dec_fixed).max())
+    print("inverse vs corrected original: %.1e arcsec" % (err * 3600.))
+    assert err * 3600. < 1e-6
+
+    proj = TangentProjection(M31RA0, M31DEC0, dtype=np.float32)
+    xi32, eta32 = proj.forward(ra, dec)
+    ra32, dec32 = proj.inverse(xi32, eta32)
+    err = max(np.abs(ra32 - ra).max(), np.abs(dec32 - dec).max())
+    print("round trip, float32:      %.2f arcsec" % (err * 3600.))
+    assert err * 3600. < 0.5
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=10000000)
+    parser.add_argument('--n-polygons', type=int, default=10000)
+    args = parser.parse_args()
+
+    check_accuracy()
+
+    rng = np.random.RandomState(0)
+    ra = M31RA0 + rng.uniform(-3., 3., args.n)
+    dec = M31DEC0 + rng.uniform(-3., 3., args.n)
+    proj = TangentProjection(M31RA0, M31DEC0)
+    print("%i points (Mpoints/s)" % args.n)
+
+    (xi, eta), t_old = timed(legacy_eq_to_tan, ra, dec)
+    _, t_new = timed(proj.forward, ra, dec)
+    out = (np.empty_like(ra), np.empty_like(dec))
+    _, t_out = timed(proj.forward, ra, dec, out=out)
+    ra32, dec32 = ra.astype(np.float32), dec.astype(np.float32)
+    _, t_32 = timed(proj.forward, ra32, dec32)
+    _, t_in = timed(proj.forward, ra32, dec32, inplace=True)
+    print("forward: original %5.1f, new %5.1f, out= %5.1f, float32 %5.1f, "
+          "float32 in place %5.1f"
+          % tuple(args.n / t / 1e6
+                  for t in (t_old, t_new, t_out, t_32, t_in)))
+
+    _, t_old = timed(legacy_tan_to_eq, xi, eta)
+    _, t_new = timed(proj.inverse, xi, eta)
+    _, t_out = timed(proj.inverse, xi, eta, out=out)
+    xi32, eta32 = xi.astype(np.float32), eta.astype(np.float32)
+    _, t_32 = timed(proj.inverse, xi32, eta32)
+    _, t_in = timed(proj.inverse, xi32, eta32, inplace=True)
+    print("inverse: original %5.1f, new %5.1f, out= %5.1f, float32 %5.1f, "
+          "float32 in place %5.1f"
+          % tuple(args.n / t / 1e6
+                  for t in (t_old, t_new, t_out, t_32, t_in)))
+
+    # Boxes of four corners, as narrowband fields are made
+    boxes = [c + [[-0.35, -0.23], [0.35, -0.23], [0.35, 0.23], [-0.35, 0.23]]
+             for c in rng.uniform(-2., 2., (args.n_polygons, 2))]
+    t0 = time.time()
+    loop = [np.array([tan_to_eq(x, y) for x, y in box]) for box in boxes]
+    t_loop = time.time() - t0
+    t0 = time.time()
+    loop_arrays = [np.vstack(tan_to_eq(box[:, 0], box[:, 1])).T
+                   for box in boxes]
+    t_arrays = time.time() - t0
+    batch, t_batch = timed(tan_to_eq_polygons, boxes)
+    assert all(np.allclose(p, q, rtol=0., atol=1e-12)
+               for p, q in zip(loop, batch))
+    assert all(np.allclose(p, q, rtol=0., atol=1e-12)
+               for p, q in zip(loop_arrays, batch))
+    print("%i boxes: per vertex %.3f s, per polygon %.3f s, batched %.4f s"
+          % (args.n_polygons, t_loop, t_arrays, t_batch))
+
+
+if __name__ == '__main__':
+    main()
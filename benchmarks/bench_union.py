@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark incremental updates of a CoverageUnion against re-running
+polygon_union on the whole selection.
+
+A survey-like set of footprints is unioned once; then a few exposures are
+added (and removed) at a time, as when a selection is refined
+interactively. Footprints either side of zero, as in tangent-plane
+coordinates, are also checked to union correctly.
+"""
+
+import time
+import argparse
+
+import numpy as np
+from shapely.geometry import MultiPolygon, Polygon
+
+from andromap.polytools import CoverageUnion, polygon_union
+
+
+def make_footprints(n, size=0.25, seed=0):
+    """Square footprints dithered over a grid of fields, like a mosaic."""
+    rng = np.random.RandomState(seed)
+    n_side = int(np.ceil(np.sqrt(n / 4.)))
+    fields = np.array([(i, j) for i in range(n_side) for j in range(n_side)],
+                      dtype=float) * 0.9 * size * 2.
+    centres = fields[rng.randint(0, len(fields), n)] \
+        + rng.normal(0., 0.05 * size, (n, 2)) + [10., 40.]
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * size
+    return [c + corners for c in centres]
+
+
+def area(vert_seq):
+    return MultiPolygon([Polygon(v) for v in vert_seq]).area
+
+
+def check_signs(size=0.25):
+    """Union footprints with negative and non-negative tile indices."""
+    sq = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * size
+    polys = [sq + c for c in [[-1., -1.], [1., 1.], [-3., 2.], [0., 0.]]]
+    cu = CoverageUnion(polys[:2])
+    assert abs(area(cu.exteriors()) - area(polys[:2])) < 1e-12
+    cu.add_many(polys[2:])
+    check = polygon_union(polys)
+    assert abs(area(cu.exteriors()) - area(check)) < 1e-12
+    cu.remove(0)
+    check = polygon_union(polys[1:])
+    assert abs(area(cu.exteriors()) - area(check)) < 1e-12
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=5000)
+    parser.add_argument('--batch', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    check_signs()
+
+    polys = make_footprints(args.n + args.batch * args.repeat)
+    base, extra = polys[:args.n], polys[args.n:]
+
+    t0 = time.time()
+    full = polygon_union(base)
+    t_full = time.time() - t0
+
+    t0 = time.time()
+    cu = CoverageUnion(base)
+    initial = cu.exteriors()
+    t_initial = time.time() - t0
+    assert abs(area(initial) - area(full)) < 1e-9 * area(full)
+
+    t_add = []
+    t_remove = []
+    selection = list(base)
+    for i in range(args.repeat):
+        batch = extra[i * args.batch:(i + 1) * args.batch]
+        t0 = time.time()
+        keys = cu.add_many(batch)
+        cu.exteriors()
+        t_add.append(time.time() - t0)
+        t0 = time.time()
+        for k in keys[:1]:
+            cu.remove(k)
+        cu.exteriors()
+        t_remove.append(time.time() - t0)
+        selection.extend(batch[1:])
+    check = polygon_union(selection)
+    assert abs(area(cu.exteriors()) - area(check)) < 1e-9 * area(check)
+
+    print("%i footprints, %i tiles" % (args.n, cu.n_tiles))
+    print("polygon_union from scratch: %8.1f ms" % (t_full * 1e3))
+    print("CoverageUnion initial:      %8.1f ms" % (t_initial * 1e3))
+    print("add %3i footprints:         %8.1f ms (median)"
+          % (args.batch, np.median(t_add) * 1e3))
+    print("remove 1 footprint:         %8.1f ms (median)"
+          % (np.median(t_remove) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,10 +11,9 @@ import logging
 
 import numpy as np
 
-from pymongo import MongoClient
-
 from andromap import Andromap
 from andromap.constants import M31RA0, M31DEC0
+from andromap.imagelogfootprints import get_field_centers
 
 from andromass.profile.datasets import read_release
 
@@ -39,9 +38,6 @@ def main():
 
 
 def plot_archive_fields():
-    client = MongoClient(host='localhost', port=27017)
-    c = client.m31.images
-
     pngpath = os.path.expanduser("~/andromap/Elixir_B3_r.resamp.inverted.png")
     fitspath = os.path.expanduser("~/andromap/Elixir_B3_r.resamp.fits")
     m = Andromap(fitspath, figsize=(7.5, 7.5))
@@ -61,15 +57,10 @@ def plot_archive_fields():
            "RUNID": {"$nin": androids_runids},
            "footprint": {"$exists": 1},
            "FILTER": {"$in": ['u', 'g', 'r', 'i']}}
-    fieldnames = c.find(sel).distinct("OBJECT")
-    for fieldname in fieldnames:
-        s = dict(sel)
-        s.update({"OBJECT": fieldname})
-        doc = c.find_one(s)
-        ra = doc['RA_DEG']
-        dec = doc['DEC_DEG']
-        # m.plot_combined_fields(s)
-        m.add_label(ra, dec, fieldname.replace(r"_", r"\_"),
+    centers = get_field_centers(sel, group_by="OBJECT")
+    for fieldname, center in centers.items():
+        m.add_label(center['ra'], center['dec'],
+                    fieldname.replace(r"_", r"\_"),
                     size=7, zorder=1000)
 
     radii = np.arange(10., 50., 10.)
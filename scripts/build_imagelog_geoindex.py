@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Add GeoJSON polygons and 2dsphere indexes to the m31 image log so that
+footprint queries can be restricted to a region on the server.
+
+With ``--check RA DEC RADIUS`` the server-side cone query is compared with
+the client-side spatial index afterwards.
+"""
+
+import logging
+import argparse
+
+from andromap.connection import configure
+from andromap.footprintcache import configure_cache
+from andromap.geoindex import build_geo_index, cone_region
+from andromap.imagelogfootprints import get_image_footprints
+from andromap.spatialindex import footprints_in_region
+
+
+def main():
+    log = logging.getLogger('andromap')
+    log.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    log.addHandler(ch)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--db', default='m31')
+    parser.add_argument('--kinds', nargs='*', default=['images', 'footprints'])
+    parser.add_argument('--check', nargs=3, type=float,
+                        metavar=('RA', 'DEC', 'RADIUS'))
+    args = parser.parse_args()
+
+    configure(host=args.host, port=args.port, db=args.db)
+    configure_cache(enabled=False)
+    counts = build_geo_index(kinds=args.kinds)
+    for kind, n in counts.items():
+        print("%s: %i converted, %i skipped, %i rejected"
+              % (kind, n['converted'], n['skipped'], n['rejected']))
+
+    if args.check:
+        ra, dec, radius = args.check
+        server = get_image_footprints({}, region=cone_region(ra, dec, radius))
+        client = footprints_in_region(ra, dec, radius)
+        server = set(server or {})
+        print("cone query: %i footprints from the server, %i from the "
+              "client index" % (len(server), len(client)))
+        print("  missing on the server: %i" % len(set(client) - server))
+        # The server's polygon encloses the cone, so it may match a few
+        # more footprints at the edge.
+        print("  extra on the server:   %i" % len(server - set(client)))
+
+
+if __name__ == '__main__':
+    main()
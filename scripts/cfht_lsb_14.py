@@ -60,7 +60,7 @@ def main():
     perimeter_fields = [
         {'ra': (0, 50, 19.185), 'dec': (43, 56, 57.26), 'n': 'N1'},
         {'ra': (0, 55, 15.200), 'dec': (43, 55, 12.99), 'n': 'N2'},
-        {'ra': (0, 56, 27.736), 'dec': (43, 03, 57.23), 'n': 'N3'},
+        {'ra': (0, 56, 27.736), 'dec': (43, 3, 57.23), 'n': 'N3'},
         {'ra': (0, 52, 25.926), 'dec': (41, 13, 58.31), 'n': 'E1'},
         {'ra': (0, 49, 42.631), 'dec': (40, 22, 23.89), 'n': 'E2'},
         {'ra': (0, 45, 49.648), 'dec': (39, 25, 19.53), 'n': 'E3'},
@@ -70,7 +70,7 @@ def main():
         {'ra': (0, 30, 25.494), 'dec': (40, 16, 08.21), 'n': 'W1'},
         {'ra': (0, 32, 54.665), 'dec': (41, 12, 46.38), 'n': 'W2'},
         {'ra': (0, 36, 46.869), 'dec': (42, 9, 03.14), 'n': 'W3'},
-        {'ra': (0, 41, 47.547), 'dec': (43, 05, 05.51), 'n': 'W4'}]
+        {'ra': (0, 41, 47.547), 'dec': (43, 5, 05.51), 'n': 'W4'}]
     new_sky_fields = [
         {'ra': (0, 42., 0.), 'dec': (45., 22., 0), 'n': 'S9'},
         {'ra': (1., 6., 0.), 'dec': (42., 15., 0), 'n': 'S10'},
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Export the m31 image log into an offline snapshot for rendering maps on
+machines without MongoDB.
+"""
+
+import os
+import logging
+import argparse
+
+from andromap.snapshot import export_snapshot
+from andromap.connection import configure
+
+
+def main():
+    log = logging.getLogger('andromap')
+    log.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    log.addHandler(ch)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', nargs='?',
+                        default=os.path.expanduser("~/andromap/imagelog"),
+                        help="Snapshot directory")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--fields', nargs='*',
+                        help="Header fields to export (default: all)")
+    args = parser.parse_args()
+
+    configure(host=args.host, port=args.port)
+    export_snapshot(args.path, fields=args.fields)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,16 +22,24 @@ def main():
 
     pngpath = os.path.expanduser("~/andromap/Elixir_B3_r.resamp.inverted.png")
     fitspath = os.path.expanduser("~/andromap/Elixir_B3_r.resamp.fits")
-    m = Andromap(fitspath, figsize=(3.5, 3.5))
+    wircam_sci_sel = {"INSTRUME": "WIRCam", "TYPE": "sci"}
+    wircam_sky_sel = {"INSTRUME": "WIRCam", "TYPE": "sky",
+        "RUNID": {"$in": ['07BC20', '07BH47']}}
+    megacam_sel = {"INSTRUME": "MegaPrime", "lsb_mosaic.kind": "sci"}
+    # Query and union the layers while the basemap loads
+    layers = [('combined_fields', wircam_sci_sel),
+              ('combined_fields', wircam_sky_sel),
+              ('combined_fields', megacam_sel),
+              ('phat', {'union': True}),
+              ('hst_halo',)]
+    m = Andromap(fitspath, figsize=(3.5, 3.5), prefetch=layers)
     m.fig.show_rgb(pngpath)
-    m.plot_combined_fields({"INSTRUME": "WIRCam", "TYPE": "sci"},
-        edgecolor='r')
-    m.plot_combined_fields({"INSTRUME": "WIRCam", "TYPE": "sky",
-        "RUNID": {"$in": ['07BC20', '07BH47']}}, edgecolor='r')
-    m.plot_combined_fields({"INSTRUME": "MegaPrime", "lsb_mosaic.kind": "sci"},
-        edgecolor='b')
+    m.plot_combined_fields(wircam_sci_sel, edgecolor='r')
+    m.plot_combined_fields(wircam_sky_sel, edgecolor='r')
+    m.plot_combined_fields(megacam_sel, edgecolor='b')
     m.plot_phat(union=True)
     m.plot_hst_halo(label=True)
+    m.prefetch_report()
 
     m.save("hst_footprint.pdf", format='pdf',
             dpi=300, transparent=True, adjust_bbox=True)
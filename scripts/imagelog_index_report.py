@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Report the query plans of image log selectors and recommend compound
+indexes for them.
+
+Selectors are read from a JSON file saved from a map-making run with
+``get_selector_log().save(path)``; by default the selectors of the map
+scripts in this directory are used. With ``--create`` the missing indexes
+are built and the selectors explained again, giving a before/after report.
+"""
+
+import json
+import logging
+import argparse
+
+from andromap.connection import configure
+from andromap.indexadvisor import SelectorLog, index_report, format_report
+
+
+# Selectors issued by the map scripts
+DEFAULT_SELECTORS = [
+    {"INSTRUME": "WIRCam", "TYPE": "sci"},
+    {"INSTRUME": "WIRCam", "TYPE": "sky",
+     "RUNID": {"$in": ['07BC20', '07BH47']}},
+    {"INSTRUME": "MegaPrime", "lsb_mosaic.kind": "sci"},
+    {"INSTRUME": "MegaPrime", "lsb_mosaic.kind": "sky"},
+    {"INSTRUME": "MegaPrime", "footprint": {"$exists": 1},
+     "FILTER": {"$in": ['u', 'g', 'r', 'i']}},
+    {"survey": "PHAT", "FILTER": "F160W"},
+    {"survey": "brown"},
+]
+DEFAULT_FOOTPRINT_SELECTORS = [
+    {"kind": "ph2", "instrument": "PHAT"},
+]
+
+
+def main():
+    log = logging.getLogger('andromap')
+    log.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    log.addHandler(ch)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('selectors', nargs='?',
+                        help="JSON file of recorded selectors")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--db', default='m31')
+    parser.add_argument('--create', action='store_true',
+                        help="Create the recommended indexes")
+    parser.add_argument('--json', help="Also write the report to this file")
+    args = parser.parse_args()
+
+    configure(host=args.host, port=args.port, db=args.db)
+    selectors = SelectorLog()
+    if args.selectors:
+        selectors.load(args.selectors)
+    else:
+        for sel in DEFAULT_SELECTORS:
+            selectors.record('images', sel)
+        for sel in DEFAULT_FOOTPRINT_SELECTORS:
+            selectors.record('footprints', sel)
+
+    report = index_report(selectors.entries(), create=args.create)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,10 +11,10 @@ import logging
 
 from andromap import Andromap
 import numpy as np
-from pymongo import MongoClient
 
 from andromass.profile.datasets import read_release
 from andromap.constants import M31RA0, M31DEC0
+from andromap.connection import get_connection, connection_stats
 
 BLUE = "#377eb8"
 RED = '#e41a1c'
@@ -62,38 +62,34 @@ def main():
     m = Andromap(fitspath, figsize=(6.5, 6.5))
     m.fig.show_rgb(pngpath)
 
-    client = MongoClient(host='localhost', port=27017)
-    c = client.m31.images
-
     # WIRCam mosaic footprint.
     m.plot_combined_fields({"INSTRUME": "WIRCam",
                             "TYPE": "sci",
                             "RUNID": {'$in': ['07BC20', '09BC29']}},
                            edgecolor=RED, lw=1, alpha=0.8)
 
+    # Sky fields observed in these runs, drawn with their exposures from
+    # every run
     wircam_sky_sel = {"INSTRUME": "WIRCam", "TYPE": "sky",
                       "RUNID": {"$in": ['07BC20', '07BH47', '09BC29']}}
-    for field in c.find(wircam_sky_sel).distinct('OBJECT'):
-        m.plot_combined_fields(
-            {"INSTRUME": "WIRCam", "TYPE": "sky", "OBJECT": field},
-            edgecolor=ORANGE, lw=1, alpha=0.8)
-
-    for field in MEGACAM_FIELD_NAMES:
-        m.plot_combined_fields(
-            {"INSTRUME": "MegaPrime", 'OBJECT': field},
-            edgecolor=BLUE, lw=2.)
-        coord = m.compute_mean_coordinate({"OBJECT": field})
-        m.add_label(coord.ra.value, coord.dec.value,
-                    field.split('_')[-1],
-                    size=14, weight='heavy',
-                    ha='center', va='center',
-                    color=BLUE)
-
-    for field in MEGACAM_SKY_NAMES:
-        m.plot_combined_fields(
-            {"INSTRUME": "MegaPrime", 'OBJECT': field},
-            edgecolor=BLUE, lw=1)
-        coord = m.compute_mean_coordinate({"OBJECT": field})
+    c = get_connection().collection('images')
+    m.plot_combined_fields_grouped({"INSTRUME": "WIRCam", "TYPE": "sky"},
+                                   group_by='OBJECT',
+                                   values=c.distinct('OBJECT', wircam_sky_sel),
+                                   edgecolor=ORANGE, lw=1, alpha=0.8)
+
+    m.plot_combined_fields_grouped({"INSTRUME": "MegaPrime"},
+                                   group_by='OBJECT',
+                                   values=MEGACAM_FIELD_NAMES,
+                                   edgecolor=BLUE, lw=2.)
+    m.plot_combined_fields_grouped({"INSTRUME": "MegaPrime"},
+                                   group_by='OBJECT',
+                                   values=MEGACAM_SKY_NAMES,
+                                   edgecolor=BLUE, lw=1)
+    coords = m.compute_mean_coordinates(
+        {"OBJECT": {"$in": MEGACAM_FIELD_NAMES + MEGACAM_SKY_NAMES}},
+        group_by='OBJECT')
+    for field, coord in coords.items():
         m.add_label(coord.ra.value, coord.dec.value,
                     field.split('_')[-1],
                     size=14, weight='heavy',
@@ -111,6 +107,7 @@ def main():
     m.fig.recenter(M31RA0, M31DEC0, radius=4)  # , width=9, height=9)
     m.save("megacam_lsb_fields.pdf", format='pdf',
            dpi=300, transparent=True, adjust_bbox=True)
+    log.debug("MongoDB connections: %s" % str(connection_stats()))
 
 
 if __name__ == '__main__':
@@ -10,7 +10,7 @@ from matplotlib.figure import Figure
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 import matplotlib.gridspec as gridspec
 
-from andromap.andromap import ellipse_generator
+from andromap.ellipses import ellipse_generator
 from andromap.constants import D_KPC, M31RA0, M31DEC0
 from andromass.profile.datasets import read_release
 
@@ -30,13 +30,13 @@ def main():
     PA = prof['PA']
     ELL = prof['ELL']
     # print prof['ELL']
-    print prof['KPC', 'ELL'][::50]
+    print(prof['KPC', 'ELL'][::50])
 
     polygons = []
     for r_kpc, pa, ell in ellipse_generator(R, PA, ELL, radii):
         r_deg = np.arctan(r_kpc / D_KPC) * 180. / np.pi
         b_deg = (1. - ell) * r_deg  # semi-minor axis
-        print r_kpc, r_deg, b_deg, ell, pa
+        print(r_kpc, r_deg, b_deg, ell, pa)
         # XVISTA pa is from +x axis (which points rightwards), out
         # PA must be CCW from north
         pa = 90. - pa  # THIS WORKS
@@ -11,7 +11,7 @@ be needed.
 import json
 import os
 import numpy as np
-from andromap.tanproj import eq_to_tan, tan_to_eq
+from andromap.tanproj import eq_to_tan, tan_to_eq_polygons
 
 
 def main():
@@ -42,8 +42,7 @@ def androids_nb_fields():
             [0.9, xi0 + 3. * (h - dh)]]
     names = ["AGB_%i" % n for n in range(1, len(xi_eta) + 1)]
     norig = len(names)
-    for name, (x, e) in zip(names, xi_eta):
-        fields[name] = make_nb_field_box(x, e)
+    fields.update(make_nb_field_boxes(names, xi_eta))
 
     xi_eta = [[1.4, 0.35],
             [0.7, 1.7],
@@ -62,8 +61,7 @@ def androids_nb_fields():
             [1.3, 0.8],  # 20 minor axis
             ]
     names = ["AGB_%i" % n for n in range(norig + 1, norig + len(xi_eta) + 1)]
-    for name, (x, e) in zip(names, xi_eta):
-        fields[name] = make_nb_field_box(x, e)
+    fields.update(make_nb_field_boxes(names, xi_eta))
     return fields
 
 def cntio_12k_fields():
@@ -72,21 +70,20 @@ def cntio_12k_fields():
     alpha = 15. * np.array([.672777778, .638138889, .617313889])
     delta = np.array([41.6853, 40.067497222, 39.680555556])
     xi, eta = eq_to_tan(alpha, delta)
-    fields = {}
-    for name, x, e in zip(names, xi, eta):
-        fields[name] = make_nb_field_box(x, e)
-    return fields
+    return make_nb_field_boxes(names, np.vstack([xi, eta]).T)
 
 
-def make_nb_field_box(xi, eta):
-    """Produce a box with vertices in RA, Dec given xi, eta coords."""
+def make_nb_field_boxes(names, xi_eta):
+    """Produce boxes with vertices in RA, Dec given the xi, eta coords of
+    their centres, projecting the corners of all boxes at once.
+    """
     hw = 42. / 60. / 2.  # half-width of NB FOV in deg
     hh = 28. / 60. / 2.  # half-height of NB FOV in deg
-    verts = [tan_to_eq(xi - hw, eta - hh),
-            tan_to_eq(xi + hw, eta - hh),
-            tan_to_eq(xi + hw, eta + hh),
-            tan_to_eq(xi - hw, eta + hh)]
-    return verts
+    corners = np.array([[-hw, -hh], [hw, -hh], [hw, hh], [-hw, hh]])
+    verts = np.asarray(xi_eta, dtype=float)[:, None, :] + corners
+    offsets = np.arange(len(verts) + 1) * len(corners)
+    boxes = tan_to_eq_polygons(verts.reshape(-1, 2), offsets)
+    return dict((name, box.tolist()) for name, box in zip(names, boxes))
 
 
 if __name__ == '__main__':
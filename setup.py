@@ -11,12 +11,14 @@ setup(
     packages=find_packages(),
     scripts=glob.glob('scripts/*.py'),
 
-    install_requires=['numpy',
+    python_requires=">=3.7",
+
+    install_requires=['numpy>=1.14',
                       'matplotlib',
-                      'astropy',
+                      'astropy>=1.3',
                       'aplpy',
-                      'pymongo',
-                      'shapely'],
+                      'pymongo>=3.6',
+                      'shapely>=2.0'],
 
     package_data={'': ['*.txt', '*.rst']},
 